@@ -0,0 +1,55 @@
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import Manager
+from cgrcompute.components.courserecommendation import CourseRecommendationModel, CosineSimRecommendationModel
+from cgrcompute.components.multiprocess import SharableCache, MappedSharableCache
+from tests.synthetic import generate_observations
+from benchmarks.report import add_json_argument, latency_stats, write_json
+
+KEY = 'model'
+
+
+def time_gets(cache: SharableCache, n: int) -> tuple[float, list[float]]:
+    # First get after an update loads the model; the others are served from the process-local copy
+    start = time.perf_counter()
+    cache.get(KEY)
+    first = time.perf_counter() - start
+    samples = []
+    for _ in range(n):
+        start = time.perf_counter()
+        cache.get(KEY)
+        samples.append(time.perf_counter() - start)
+    return first, samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SharableCache get/update cost across worker processes')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000], help='training events of the cached model')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--gets', type=int, default=2000)
+    add_json_argument(parser)
+    args = parser.parse_args()
+    results = []
+    with Manager() as manager, ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for n in args.sizes:
+            model = CourseRecommendationModel()
+            model.model = CosineSimRecommendationModel.train(generate_observations(n))
+            for (name, cache) in (('pickled', SharableCache(manager)), ('mapped', MappedSharableCache(manager))):
+                start = time.perf_counter()
+                cache.update(KEY, model)
+                update = time.perf_counter() - start
+                runs = [f.result() for f in [pool.submit(time_gets, cache, args.gets) for _ in range(args.workers)]]
+                first = [r[0] for r in runs]
+                res = {'events': n, 'items': len(model.model), 'cache': name, 'update_s': update,
+                    'first_get': latency_stats(first), 'get': latency_stats([s for r in runs for s in r[1]])}
+                results.append(res)
+                print('{:>8} events {:>7}  update {:8.2f} ms  first get p50 {:8.2f} ms  get p50 {:.4f} ms p99 {:.4f} ms'.format(
+                    n, name, update * 1000, res['first_get']['p50_ms'], res['get']['p50_ms'], res['get']['p99_ms']), flush=True)
+                if isinstance(cache, MappedSharableCache):
+                    cache.close()
+    write_json(args.json, 'cache', args, results)
+
+
+if __name__ == '__main__':
+    main()
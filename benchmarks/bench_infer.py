@@ -0,0 +1,42 @@
+import argparse
+import random
+import time
+from cgrcompute.components.courserecommendation import CosineSimRecommendationModel
+from tests.synthetic import generate_observations
+from benchmarks.report import add_json_argument, latency_stats, timed, write_json
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Single and batched inference latency of the cosine model')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000], help='training events')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--batch-size', type=int, default=32)
+    add_json_argument(parser)
+    args = parser.parse_args()
+    results = []
+    for n in args.sizes:
+        obsv = generate_observations(n)
+        model, train_time = timed(CosineSimRecommendationModel.train, obsv)
+        # Selections are drawn from real baskets, so popular courses dominate like in production
+        rng = random.Random(0)
+        selections = [rng.sample(sorted(o), min(len(o), rng.randint(1, 6))) for o in rng.choices(obsv, k=args.requests)]
+        single = []
+        for s in selections:
+            start = time.perf_counter()
+            model.rank(s)
+            single.append(time.perf_counter() - start)
+        batched = []
+        for i in range(0, len(selections), args.batch_size):
+            chunk = selections[i:i + args.batch_size]
+            start = time.perf_counter()
+            model.rank_batch(chunk)
+            batched.append((time.perf_counter() - start) / len(chunk))
+        res = {'events': n, 'items': len(model), 'train_s': train_time, 'rank': latency_stats(single), 'rank_batch_per_request': latency_stats(batched)}
+        results.append(res)
+        print('{:>8} events {:>5} items  rank p50 {:.3f} ms p99 {:.3f} ms  rank_batch {:.3f} ms/request'.format(
+            n, len(model), res['rank']['p50_ms'], res['rank']['p99_ms'], res['rank_batch_per_request']['mean_ms']), flush=True)
+    write_json(args.json, 'infer', args, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+import argparse
+from cgrcompute.components.courserecommendation import ObservationBuilder
+from cgrcompute.components.neighbours import exact_neighbours, LSHNeighbours, recall_at_k
+from tests.synthetic import generate_events
+from benchmarks.report import add_json_argument, timed, write_json
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recall@k and training time of LSH neighbours against the exact trainer')
+    parser.add_argument('--events', type=int, default=1000000)
+    parser.add_argument('--courses', type=int, default=20000)
+    parser.add_argument('--k', type=int, default=100)
+    parser.add_argument('--bits', type=int, nargs='+', default=[2, 4, 8])
+    parser.add_argument('--tables', type=int, nargs='+', default=[1, 2, 4])
+    add_json_argument(parser)
+    args = parser.parse_args()
+    builder = ObservationBuilder()
+    for e in generate_events(args.events, n_courses=args.courses):
+        builder.add(e['device_id'], (e['study_program'], e['course_id']))
+    _, itemobsv = builder.build()
+    exact, exact_time = timed(exact_neighbours, itemobsv, args.k)
+    print('{} items {} baskets  exact {:8.3f} s'.format(itemobsv.shape[0], itemobsv.shape[1], exact_time), flush=True)
+    results = [{'neighbours': 'exact', 'items': itemobsv.shape[0], 'baskets': itemobsv.shape[1], 'train_s': exact_time}]
+    for bits in args.bits:
+        for tables in args.tables:
+            approx, approx_time = timed(LSHNeighbours(bits=bits, tables=tables), itemobsv, args.k)
+            recall = recall_at_k(exact, approx)
+            results.append({'neighbours': 'lsh', 'bits': bits, 'tables': tables, 'train_s': approx_time, 'recall': recall})
+            print('bits {:>3} tables {:>3}  lsh {:8.3f} s  {:5.2f}x exact  recall@{} {:.3f}'.format(bits, tables, approx_time, approx_time / exact_time, args.k, recall), flush=True)
+    write_json(args.json, 'neighbours', args, results)
+
+
+if __name__ == '__main__':
+    main()
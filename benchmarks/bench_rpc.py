@@ -0,0 +1,152 @@
+import argparse
+import asyncio
+import random
+import threading
+import time
+import grpc
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Manager
+import cgrcompute.server as server
+import cgrcompute.components.courserecommendation as courserecommendation
+from cgrcompute.components.courserecommendation import CourseRecommendationModel, ObservationBuilder, MODEL_KEY
+from cgrcompute.components.multiprocess import MappedSharableCache
+from cgrcompute.components.batching import MicroBatcher
+from cgrcompute.components.pool import SupervisedPool
+from cgrcompute.components.resultcache import ResultCache
+from cgrcompute.grpc import cgrcompute_pb2, cgrcompute_pb2_grpc
+from tests.synthetic import generate_events
+from benchmarks.report import add_json_argument, latency_stats, write_json
+
+
+class FakeMongoService:
+    # Every course is offered and named, with no database round trip
+
+    preload = False
+
+    def cached_course_abbrs(self, course_nos, semester, study_program, academic_year):
+        return dict()
+
+    def get_course_abbrs(self, course_nos, semester, study_program, academic_year):
+        return dict((c, 'COURSE ' + c) for c in course_nos)
+
+
+def install_fake_mongo():
+    courserecommendation.get_mongo_service = FakeMongoService
+
+
+def make_requests(events: list[dict], n: int, seed: int = 0) -> list[cgrcompute_pb2.CourseRecommendationRequest]:
+    baskets = dict()
+    for e in events:
+        baskets.setdefault(e['device_id'], []).append((e['study_program'], e['course_id']))
+    baskets = [b for b in baskets.values() if len(b) > 1]
+    rng = random.Random(seed)
+    reqs = []
+    for b in rng.choices(baskets, k=n):
+        req = cgrcompute_pb2.CourseRecommendationRequest(variant='COSINE')
+        req.semesterKey.studyProgram = b[0][0]
+        req.semesterKey.semester = '1'
+        req.semesterKey.academicYear = '2565'
+        for (program, course_no) in rng.sample(b, rng.randint(1, min(len(b) - 1, 6))):
+            c = req.selectedCourses.add()
+            c.courseNo = course_no
+            c.semesterKey.studyProgram = program
+        reqs.append(req)
+    return reqs
+
+
+def start_server(mode: str, servicer_args: dict, threads: int):
+    if mode == 'aio':
+        loop = asyncio.new_event_loop()
+        started = threading.Event()
+        holder = dict()
+        async def run():
+            srv = grpc.aio.server(migration_thread_pool=ThreadPoolExecutor(max_workers=threads))
+            cgrcompute_pb2_grpc.add_CourseRecommendationServicer_to_server(server.AsyncCourseRecommendationServicer(**servicer_args), srv)
+            holder['port'] = srv.add_insecure_port('127.0.0.1:0')
+            await srv.start()
+            holder['server'] = srv
+            started.set()
+            await srv.wait_for_termination()
+        threading.Thread(target=lambda: loop.run_until_complete(run()), daemon=True).start()
+        started.wait()
+        return holder['port'], lambda: asyncio.run_coroutine_threadsafe(holder['server'].stop(None), loop).result()
+    srv = grpc.server(ThreadPoolExecutor(max_workers=threads))
+    cgrcompute_pb2_grpc.add_CourseRecommendationServicer_to_server(server.CourseRecommendationServicer(**servicer_args), srv)
+    port = srv.add_insecure_port('127.0.0.1:0')
+    srv.start()
+    return port, lambda: srv.stop(None)
+
+
+def load(stub, reqs: list, concurrency: int) -> tuple[float, list[float], int]:
+    latencies = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+    def client(i):
+        for req in reqs[i::concurrency]:
+            start = time.perf_counter()
+            try:
+                stub.Recommend(req)
+            except grpc.RpcError:
+                errors[i] += 1
+                continue
+            latencies[i].append(time.perf_counter() - start)
+    threads = [threading.Thread(target=client, args=(i, )) for i in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start, [s for l in latencies for s in l], sum(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end Recommend load against a local server with a fake Mongo')
+    parser.add_argument('--events', type=int, default=200000, help='training events of the served model')
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--mode', choices=['thread', 'aio'], default='aio')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--batch-delay-ms', type=float, default=0)
+    parser.add_argument('--result-cache-size', type=int, default=0)
+    add_json_argument(parser)
+    args = parser.parse_args()
+    events = generate_events(args.events)
+    builder = ObservationBuilder()
+    for e in events:
+        builder.add(e['device_id'], (e['study_program'], e['course_id']))
+    model = CourseRecommendationModel()
+    model.train_observations(*builder.build())
+    reqs = make_requests(events, args.requests)
+    results = []
+    with Manager() as manager:
+        cache = MappedSharableCache(manager)
+        cache.update(MODEL_KEY, model)
+        # The workers are forked here, before any gRPC thread runs
+        pool = server.pool = SupervisedPool(max_workers=args.workers, initializer=install_fake_mongo)
+        batcher = None
+        if args.batch_delay_ms > 0:
+            batcher = MicroBatcher(server.batch_dispatcher(cache), max_delay=args.batch_delay_ms / 1000)
+        result_cache = ResultCache(cache.generation, maxsize=args.result_cache_size) if args.result_cache_size > 0 else None
+        port, stop = start_server(args.mode, {'cache': cache, 'batcher': batcher, 'result_cache': result_cache}, args.threads)
+        channel = grpc.insecure_channel('127.0.0.1:{}'.format(port))
+        stub = cgrcompute_pb2_grpc.CourseRecommendationStub(channel)
+        try:
+            load(stub, reqs[:min(200, len(reqs))], args.workers)
+            for concurrency in args.concurrency:
+                elapsed, latencies, errors = load(stub, reqs, concurrency)
+                res = dict({'concurrency': concurrency, 'qps': len(latencies) / elapsed, 'errors': errors}, **latency_stats(latencies))
+                results.append(res)
+                print('concurrency {:>3}  {:8.1f} req/s  p50 {:.2f} ms  p95 {:.2f} ms  p99 {:.2f} ms  errors {}'.format(
+                    concurrency, res['qps'], res['p50_ms'], res['p95_ms'], res['p99_ms'], errors), flush=True)
+        finally:
+            channel.close()
+            stop()
+            if batcher is not None:
+                batcher.close()
+            pool.shutdown()
+            cache.close()
+    write_json(args.json, 'rpc', args, results)
+
+
+if __name__ == '__main__':
+    main()
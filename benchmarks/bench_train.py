@@ -0,0 +1,50 @@
+import argparse
+from scipy.sparse import lil_matrix
+from sklearn.metrics.pairwise import cosine_similarity
+from cgrcompute.components.courserecommendation import CosineSimRecommendationModel
+from tests.synthetic import generate_observations
+from benchmarks.report import add_json_argument, timed, write_json
+
+
+def train_legacy(observations):
+    # The original cell-by-cell trainer, kept here as the comparison baseline.
+    items = list(set(c for o in observations for c in o))
+    itemidx = dict((c, i) for (i, c) in enumerate(items))
+    itemobsv = lil_matrix((len(items), len(observations)))
+    for (i, o) in enumerate(observations):
+        for c in o:
+            itemobsv[itemidx[c], i] = 1
+    sim = cosine_similarity(itemobsv, dense_output=False)
+    ccmtx = dict()
+    for (i, cid) in enumerate(items):
+        neigh = []
+        for c in sim.getrow(i).nonzero()[1]:
+            neigh.append((items[c], sim[i, c]))
+        neigh = sorted(neigh, key=lambda x: x[1])[-100:]
+        ccmtx[cid] = dict(neigh)
+    return ccmtx
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the legacy and vectorized trainers')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--legacy-max', type=int, default=1000000, help='skip the legacy trainer above this many events')
+    add_json_argument(parser)
+    args = parser.parse_args()
+    results = []
+    for n in args.sizes:
+        obsv = generate_observations(n)
+        _, vectorized = timed(CosineSimRecommendationModel.train, obsv)
+        res = {'events': n, 'baskets': len(obsv), 'vectorized_s': vectorized}
+        line = '{:>8} events {:>7} baskets  vectorized {:8.2f} s'.format(n, len(obsv), vectorized)
+        if n <= args.legacy_max:
+            _, legacy = timed(train_legacy, obsv)
+            res['legacy_s'] = legacy
+            line += '  legacy {:8.2f} s  speedup {:6.1f}x'.format(legacy, legacy / vectorized)
+        results.append(res)
+        print(line, flush=True)
+    write_json(args.json, 'train', args, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+import argparse
+import numpy as np
+from cgrcompute.components.courserecommendation import CosineSimRecommendationModel, CourseRecommendationModel, ObservationBuilder, TimeDecay, read_event_log
+from cgrcompute.components.evaluation import evaluate, hide_items, split_baskets
+from cgrcompute.components.eventlog import EventLog
+from cgrcompute.components.external import ElasticService
+from cgrcompute.components.neighbours import LSHNeighbours
+from tests.synthetic import generate_events
+from benchmarks.report import add_json_argument, latency_stats, timed, write_json
+
+
+def load_observations(args):
+    decay = TimeDecay(args.half_life_days * 86400) if args.half_life_days > 0 else None
+    if args.source == 'elastic':
+        return CourseRecommendationModel().downloadobsvdata(ElasticService(), args.limit, decay)
+    builder = ObservationBuilder(decay=decay)
+    if args.source == 'eventlog':
+        read_event_log(EventLog(args.event_log), builder, args.limit)
+    else:
+        for e in generate_events(args.events, n_courses=args.courses):
+            builder.add(e['device_id'], (e['study_program'], e['course_id']))
+    return builder.build()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Hit rate, recall@k, NDCG@k, coverage and throughput of the cosine model on held-out baskets')
+    parser.add_argument('--source', choices=['synthetic', 'eventlog', 'elastic'], default='synthetic')
+    parser.add_argument('--event-log', metavar='DIR', help='event log directory for --source eventlog')
+    parser.add_argument('--limit', type=int, default=900000, help='events to read from the event log or Elasticsearch')
+    parser.add_argument('--events', type=int, default=200000, help='synthetic events')
+    parser.add_argument('--courses', type=int, default=3000, help='synthetic courses')
+    parser.add_argument('--half-life-days', type=float, default=0, help='train with time-decayed observations')
+    parser.add_argument('--neighbours', choices=['exact', 'lsh'], nargs='+', default=['exact', 'lsh'])
+    parser.add_argument('--lsh-bits', type=int, default=2)
+    parser.add_argument('--lsh-tables', type=int, default=1)
+    parser.add_argument('--test-fraction', type=float, default=0.1)
+    parser.add_argument('--hidden', type=int, default=1, help='courses hidden per test basket')
+    parser.add_argument('--k', type=int, nargs='+', default=[5, 10, 20])
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--seed', type=int, default=0)
+    add_json_argument(parser)
+    args = parser.parse_args()
+    if args.source == 'eventlog' and not args.event_log:
+        parser.error('--source eventlog needs --event-log')
+
+    (items, itemobsv), load_time = timed(load_observations, args)
+    train, test = split_baskets(itemobsv, args.test_fraction, args.seed)
+    known = np.asarray(train.sum(axis=1)).ravel() > 0
+    selected, hidden, _ = hide_items(test, known, args.hidden, args.seed)
+    print('{} items {} train baskets {} test baskets  loaded in {:.2f} s'.format(len(items), train.shape[1], selected.shape[0], load_time), flush=True)
+    results = []
+    for name in args.neighbours:
+        neighbours = LSHNeighbours(bits=args.lsh_bits, tables=args.lsh_tables) if name == 'lsh' else None
+        model, train_time = timed(CosineSimRecommendationModel.train_matrix, items, train, 100, neighbours)
+        res = evaluate(model, selected, hidden, args.k, args.batch_size)
+        results.append({'neighbours': name, 'items': len(items), 'train_baskets': train.shape[1], 'test_baskets': selected.shape[0], 'train_s': train_time,
+            'metrics': res['metrics'], 'baskets_per_s': res['baskets_per_s'], 'rank_batch': latency_stats(res['batch_latencies'])})
+        print('{:>6}  train {:8.2f} s  {:>9.0f} baskets/s'.format(name, train_time, res['baskets_per_s']), flush=True)
+        for m in res['metrics']:
+            print('        @{:<3} hit rate {:.3f}  recall {:.3f}  ndcg {:.3f}  coverage {:.3f}'.format(m['k'], m['hit_rate'], m['recall'], m['ndcg'], m['coverage']), flush=True)
+    write_json(args.json, 'evaluate', args, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+import scipy
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    res = fn(*args)
+    return res, time.perf_counter() - start
+
+
+def latency_stats(samples: list[float]) -> dict:
+    # Seconds in, milliseconds out
+    arr = np.asarray(samples) * 1000
+    if len(arr) == 0:
+        return {'count': 0}
+    return {
+        'count': len(arr),
+        'mean_ms': float(arr.mean()),
+        'p50_ms': float(np.percentile(arr, 50)),
+        'p95_ms': float(np.percentile(arr, 95)),
+        'p99_ms': float(np.percentile(arr, 99)),
+    }
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def add_json_argument(parser):
+    parser.add_argument('--json', metavar='PATH', help='also write the results to this JSON file')
+
+
+def write_json(path: str, benchmark: str, args, results: list[dict]):
+    # One file per run, so runs on different commits or machines can be diffed
+    if not path:
+        return
+    with open(path, 'w') as f:
+        json.dump({
+            'benchmark': benchmark,
+            'time': time.time(),
+            'args': vars(args),
+            'environment': environment(),
+            'results': results,
+        }, f, indent=2)
@@ -0,0 +1,25 @@
+import grpc
+from cgrcompute.components.profiling import Profiling
+from logging import getLogger
+
+from cgrcompute.grpc import admin_pb2_grpc, admin_pb2
+
+class AdminServicer(admin_pb2_grpc.AdminServicer):
+
+    def __init__(self, profiling: Profiling):
+        self.profiling = profiling
+        self.logger = getLogger("AdminServicer")
+
+    def SetProfiling(self, request, context: grpc.ServicerContext):
+        changes = dict((name, getattr(request, field)) for (name, field) in (('request_rate', 'requestRate'),
+            ('profiler', 'profiler'), ('training', 'training'), ('tracemalloc', 'tracemalloc')) if request.HasField(field))
+        self.logger.info(f"SetProfiling {changes}")
+        try:
+            self.profiling.configure(**changes)
+        except ValueError as e:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+        settings = self.profiling.settings()
+        if self.profiling.directory() is None:
+            context.set_details("No profiling directory is configured, nothing will be written")
+        return admin_pb2.ProfilingSettings(requestRate=settings['request_rate'], profiler=settings['profiler'],
+            training=settings['training'], tracemalloc=settings['tracemalloc'])
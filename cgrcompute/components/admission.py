@@ -0,0 +1,91 @@
+from collections import deque
+from concurrent.futures import Future
+from cgrcompute.components.metrics import REQUESTS_SHED
+from logging import getLogger
+from typing import Optional
+import threading
+import time
+
+
+class RejectedError(Exception):
+    # A request turned away before it reached the worker pool. reason is 'queue', 'wait' or 'deadline'.
+
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+class Ewma:
+    # Exponentially weighted moving average
+
+    def __init__(self, value: float, alpha: float = 0.2):
+        self.value = value
+        self.alpha = alpha
+
+    def update(self, x: float) -> float:
+        self.value += self.alpha * (x - self.value)
+        return self.value
+
+
+class AdmissionController:
+    # Front-process admission control for the worker pool. It counts the requests in flight and the
+    # rate at which they completed over the last `window` seconds; by Little's law, in flight / rate
+    # is about how long a request admitted now takes. A request is rejected when max_in_flight
+    # requests are already waiting, when the estimate exceeds max_wait, or when it would not finish
+    # before its own deadline anyway. Without completions to measure, only max_in_flight applies.
+
+    def __init__(self, max_in_flight: int = None, max_wait: float = None, window: float = 5):
+        self.max_in_flight = max_in_flight
+        self.max_wait = max_wait
+        self.window = window
+        self.in_flight = 0
+        self.logger = getLogger('AdmissionController')
+        self._completions = deque()
+        self._created_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _prune(self, now: float):
+        while self._completions and self._completions[0] < now - self.window:
+            self._completions.popleft()
+
+    def estimated_wait(self) -> Optional[float]:
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            if not self._completions:
+                return None
+            rate = len(self._completions) / min(self.window, max(now - self._created_at, 1e-3))
+            return (self.in_flight + 1) / rate
+
+    def admit(self, n: int = 1, deadline: float = None):
+        # deadline: time.time() by which the caller gives up. Raises RejectedError.
+        with self._lock:
+            in_flight = self.in_flight
+        if self.max_in_flight and in_flight + n > self.max_in_flight:
+            self._reject('queue', '{} requests in flight, the limit is {}'.format(in_flight, self.max_in_flight))
+        wait = self.estimated_wait()
+        if wait is None:
+            return
+        if self.max_wait and wait > self.max_wait:
+            self._reject('wait', 'estimated wait {:.3f} s is over the limit of {:.3f} s'.format(wait, self.max_wait))
+        if deadline is not None and time.time() + wait > deadline:
+            self._reject('deadline', 'estimated wait {:.3f} s exceeds the deadline'.format(wait))
+
+    def _reject(self, reason: str, message: str):
+        REQUESTS_SHED.inc(reason=reason)
+        raise RejectedError(reason, message)
+
+    def track(self, fut: Future, n: int = 1) -> Future:
+        # Counts an admitted task as in flight until fut is done
+        with self._lock:
+            self.in_flight += n
+        fut.add_done_callback(lambda f: self._done(n, not f.cancelled()))
+        return fut
+
+    def _done(self, n: int, completed: bool):
+        now = time.monotonic()
+        with self._lock:
+            self.in_flight -= n
+            if completed:
+                self._completions.extend([now] * n)
+            self._prune(now)
@@ -0,0 +1,85 @@
+from concurrent.futures import Future, InvalidStateError
+from logging import getLogger
+from queue import Queue, Empty
+from typing import Any, Callable
+import threading
+import time
+
+
+class MicroBatcher:
+    # Collects items submitted within `max_delay` seconds (up to `max_batch_size`) and hands them to
+    # `dispatch` as one list. dispatch returns a future of a list with one result per item, where
+    # an Exception entry fails only that item's future.
+
+    def __init__(self, dispatch: Callable[[list], Future], max_batch_size: int = 32, max_delay: float = 0.002):
+        self.dispatch = dispatch
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.logger = getLogger('MicroBatcher')
+        self._queue: Queue[tuple[Any, Future]] = Queue()
+        self._thread = threading.Thread(target=self._run, name='MicroBatcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, item: Any) -> Future:
+        fut = Future()
+        self._queue.put((item, fut))
+        return fut
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self, first) -> tuple[list, bool]:
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                e = self._queue.get(timeout=remaining)
+            except Empty:
+                break
+            if e is None:
+                return batch, True
+            batch.append(e)
+        return batch, False
+
+    def _run(self):
+        closed = False
+        while not closed:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch, closed = self._collect(first)
+            # Callers that gave up while the batch was collected are not sent to the workers
+            batch = [(item, fut) for (item, fut) in batch if not fut.cancelled()]
+            if not batch:
+                continue
+            futures = [fut for (_, fut) in batch]
+            try:
+                res = self.dispatch([item for (item, _) in batch])
+            except Exception as e:
+                for fut in futures:
+                    fut.set_exception(e)
+                continue
+            res.add_done_callback(lambda res, futures=futures: self._resolve(res, futures))
+
+    @staticmethod
+    def _resolve(res: Future, futures: list[Future]):
+        try:
+            results = res.result()
+        except Exception as e:
+            for fut in futures:
+                if not fut.cancelled():
+                    fut.set_exception(e)
+            return
+        for (fut, r) in zip(futures, results):
+            try:
+                if isinstance(r, Exception):
+                    fut.set_exception(r)
+                else:
+                    fut.set_result(r)
+            except InvalidStateError:
+                # Cancelled by a caller that stopped waiting
+                pass
@@ -1,116 +1,900 @@
-from scipy.sparse import lil_matrix
-from sklearn.metrics.pairwise import cosine_similarity
-from cgrcompute.components.external import ElasticService, get_mongo_service
-from typing import Hashable
+import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix
+from cgrcompute.components.external import ElasticService, get_mongo_service, parse_timestamp
+from typing import Callable, Collection, Hashable, Iterable, Optional
 from logging import getLogger
 from cgrcompute.grpc import cgrcompute_pb2 as grpcmsg
-from cgrcompute.components.multiprocess import SharableCache
+from cgrcompute.components.multiprocess import SharableCache, dump_mapped, load_mapped
+from cgrcompute.components.snapshot import save_snapshot, load_latest_snapshot
+from cgrcompute.components.eventlog import EventLog
+from cgrcompute.components.neighbours import topk_rows, exact_neighbours
+from cgrcompute.components.metrics import REQUEST_STAGE_SECONDS, REQUESTS_SHED, TRAINING_DOWNLOAD_RATE, TRAINING_OBSERVATIONS, TRAINING_DURATION, MODEL_SIZE
+from cgrcompute.components.profiling import PROFILING
+from cgrcompute.components.admission import Ewma
+from cgrcompute.components.lrucache import LRUCache, MISSING
+from array import array
+from urllib.parse import quote, unquote
+import os
 import random
 import time
 
+MODEL_KEY = 'recommend_course_model'
+STATE_FILE = 'state.snap'
+SHARD_STATE_FILE = 'shards.state.snap'
+SHARD_DIRECTORY = 'shards'
+
+Neighbours = Callable[[csr_matrix, int], csr_matrix]
+
+class ModelNotReadyError(Exception):
+    pass
+
+class DeadlineExceededError(Exception):
+    pass
+
+def row_positions(indptr: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    # Positions of every entry of the given CSR rows, concatenated in row order
+    starts, lengths = indptr[rows], indptr[rows + 1] - indptr[rows]
+    return np.arange(lengths.sum()) + np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+
 class CosineSimRecommendationModel:
+    # Top-k neighbours of every item are kept as a CSR matrix over an interned item vocabulary:
+    # the neighbours of items[i] are items[indices[indptr[i]:indptr[i+1]]] with scores data[indptr[i]:indptr[i+1]].
 
-    def __init__(self, ccmtx):
-        self.ccmtx = ccmtx
+    def __init__(self, items: list[Hashable], indptr: np.ndarray, indices: np.ndarray, data: np.ndarray, counts: np.ndarray = None):
+        self.items = items
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        # Number (or total weight) of baskets containing each item, if the trainer kept it
+        self.counts = counts
+        self.itemidx = dict((c, i) for (i, c) in enumerate(items))
 
     @staticmethod
-    def train(observations: list[set[Hashable]]) -> 'CosineSimRecommendationModel':
-        items = list(set(c for o in observations for c in o))
+    def from_ccmtx(ccmtx: dict[Hashable, dict[Hashable, float]]) -> 'CosineSimRecommendationModel':
+        items = list(ccmtx.keys())
         itemidx = dict((c, i) for (i, c) in enumerate(items))
-        itemobsv = lil_matrix((len(items), len(observations)))
-        for (i, o) in enumerate(observations):
-            for c in o:
-                itemobsv[itemidx[c], i] = 1
-        sim = cosine_similarity(itemobsv, dense_output=False)
+        for neigh in ccmtx.values():
+            for c in neigh:
+                if c not in itemidx:
+                    itemidx[c] = len(items)
+                    items.append(c)
+        indptr = np.zeros(len(items) + 1, dtype=np.int64)
+        indptr[1:len(ccmtx) + 1] = [len(neigh) for neigh in ccmtx.values()]
+        np.cumsum(indptr, out=indptr)
+        indices = np.fromiter((itemidx[c] for neigh in ccmtx.values() for c in neigh), dtype=np.int32, count=indptr[-1])
+        data = np.fromiter((s for neigh in ccmtx.values() for s in dict(neigh).values()), dtype=np.float32, count=indptr[-1])
+        return CosineSimRecommendationModel(items, indptr, indices, data)
+
+    @property
+    def ccmtx(self) -> dict[Hashable, dict[Hashable, float]]:
+        # Dict-of-dicts view of the model, as produced by the older trainer.
         ccmtx = dict()
-        for (i, cid) in enumerate(items):
-            neigh = []
-            for c in sim.getrow(i).nonzero()[1]:
-                neigh.append((items[c], sim[i, c]))
-            neigh = sorted(neigh, key=lambda x: x[1])[-100:]
-            ccmtx[cid] = dict(neigh)
-        return CosineSimRecommendationModel(ccmtx)
+        for (i, cid) in enumerate(self.items):
+            start, end = self.indptr[i], self.indptr[i + 1]
+            if start < end:
+                ccmtx[cid] = dict(zip([self.items[c] for c in self.indices[start:end]], self.data[start:end].tolist()))
+        return ccmtx
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getstate__(self):
+        return {'items': self.items, 'indptr': self.indptr, 'indices': self.indices, 'data': self.data, 'counts': self.counts}
+
+    def __setstate__(self, state):
+        if 'ccmtx' in state:
+            # Model pickled before the array representation
+            state = CosineSimRecommendationModel.from_ccmtx(state['ccmtx']).__getstate__()
+        self.__init__(state['items'], state['indptr'], state['indices'], state['data'], state.get('counts'))
+
+    def popularity(self) -> np.ndarray:
+        # Models trained before counts were kept fall back to how many items list an item as a neighbour
+        if self.counts is not None:
+            return self.counts
+        return np.bincount(self.indices, minlength=len(self.items))
+
+    @staticmethod
+    def train(observations: list[set[Hashable]], k: int = 100) -> 'CosineSimRecommendationModel':
+        items = list(set(c for o in observations for c in o))
+        itemidx = dict((c, i) for (i, c) in enumerate(items))
+        rows = np.fromiter((itemidx[c] for o in observations for c in o), dtype=np.int32)
+        cols = np.repeat(np.arange(len(observations), dtype=np.int32), [len(o) for o in observations])
+        itemobsv = coo_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(items), len(observations)))
+        return CosineSimRecommendationModel.train_matrix(items, itemobsv.tocsr(), k)
+
+    @staticmethod
+    def train_matrix(items: list[Hashable], itemobsv: csr_matrix, k: int = 100, neighbours: Neighbours = None) -> 'CosineSimRecommendationModel':
+        # neighbours: builds the top-k similarity rows, e.g. an approximate LSHNeighbours index
+        sim = (neighbours or exact_neighbours)(itemobsv, k)
+        counts = np.asarray(itemobsv.sum(axis=1), dtype=np.float32).ravel()
+        return CosineSimRecommendationModel(items, sim.indptr.astype(np.int64), sim.indices.astype(np.int32), sim.data.astype(np.float32), counts)
+
+    @staticmethod
+    def concatenate(models: list['CosineSimRecommendationModel']) -> 'CosineSimRecommendationModel':
+        # Block-diagonal union of models over disjoint item vocabularies, e.g. the study program shards
+        item_offsets = np.cumsum([0] + [len(m) for m in models])
+        entry_offsets = np.cumsum([0] + [m.indptr[-1] for m in models])
+        items = [item for m in models for item in m.items]
+        indptr = np.concatenate([m.indptr[:-1] + o for (m, o) in zip(models, entry_offsets)] + [entry_offsets[-1:]]).astype(np.int64)
+        indices = np.concatenate([np.zeros(0, dtype=np.int32)] + [m.indices + o for (m, o) in zip(models, item_offsets)]).astype(np.int32)
+        data = np.concatenate([np.zeros(0, dtype=np.float32)] + [m.data for m in models]).astype(np.float32)
+        counts = None
+        if all(m.counts is not None for m in models):
+            counts = np.concatenate([np.zeros(0, dtype=np.float32)] + [m.counts for m in models]).astype(np.float32)
+        return CosineSimRecommendationModel(items, indptr, indices, data, counts)
+
+    def _rows(self, selected_item: list[Hashable]) -> np.ndarray:
+        return np.fromiter((self.itemidx[c] for c in selected_item if c in self.itemidx), dtype=np.int64)
+
+    def _ranked(self, candidates: np.ndarray, scores: np.ndarray, k: int) -> list[tuple[Hashable, float]]:
+        if len(candidates) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            candidates, scores = candidates[top], scores[top]
+        order = np.argsort(-scores, kind='stable')
+        return [(self.items[c], scr) for (c, scr) in zip(candidates[order].tolist(), scores[order].tolist())]
+
+    @property
+    def matrix(self) -> csr_matrix:
+        try:
+            return self._matrix
+        except AttributeError:
+            self._matrix = csr_matrix((self.data, self.indices, self.indptr), shape=(len(self.items), len(self.items)))
+            return self._matrix
+
+    def rank(self, selected_item: list[Hashable], k: int = 100, allowed: np.ndarray = None) -> list[tuple[Hashable, float]]:
+        # allowed: optional boolean mask over items; other items are never returned
+        pos = row_positions(self.indptr, self._rows(selected_item))
+        neighbours = self.indices[pos]
+        scores = np.bincount(neighbours, weights=self.data[pos], minlength=len(self.items))
+        candidates = np.unique(neighbours)
+        if allowed is not None:
+            candidates = candidates[allowed[candidates]]
+        return self._ranked(candidates, scores[candidates], k)
+
+    def rank_batch(self, selected_items: list[list[Hashable]], k: int = 100, allowed: list[Optional[np.ndarray]] = None) -> list[list[tuple[Hashable, float]]]:
+        rows = [self._rows(s) for s in selected_items]
+        selection = csr_matrix(
+            (np.ones(sum(len(r) for r in rows), dtype=np.float32), np.concatenate(rows + [np.zeros(0, dtype=np.int64)]), np.cumsum([0] + [len(r) for r in rows])),
+            shape=(len(selected_items), len(self.items)))
+        scores = (selection @ self.matrix).tocsr()
+        res = []
+        for i in range(len(selected_items)):
+            start, end = scores.indptr[i], scores.indptr[i + 1]
+            candidates, scr = scores.indices[start:end], scores.data[start:end]
+            if allowed is not None and allowed[i] is not None:
+                keep = allowed[i][candidates]
+                candidates, scr = candidates[keep], scr[keep]
+            res.append(self._ranked(candidates, scr, k))
+        return res
 
     def infer(self, selected_item: list[Hashable]) -> dict[Hashable, float]:
-        d = dict()
-        for c in selected_item:
-            try:
-                cscr = self.ccmtx[c]
-                for (pcid, scr) in cscr.items():
-                    if pcid not in d:
-                        d[pcid] = 0
-                    d[pcid] += scr
-            except KeyError:
-                pass
-        return dict(sorted(d.items(), key=lambda x: x[1])[-100:])
+        return dict(self.rank(selected_item))
+
+class TimeDecay:
+    # Exponential time decay of observations: an event half_life seconds old weighs half as much as a
+    # new one. Events whose weight is below min_weight are dropped, so nothing older than horizon() is
+    # read at all and the cost of training stays bounded however long the history grows.
+
+    def __init__(self, half_life: float, min_weight: float = 0.01):
+        if half_life <= 0:
+            raise ValueError('half_life must be positive, got {}'.format(half_life))
+        if not 0 <= min_weight < 1:
+            raise ValueError('min_weight must be in [0, 1), got {}'.format(min_weight))
+        self.half_life = half_life
+        self.min_weight = min_weight
+
+    def weights(self, timestamps: np.ndarray, now: float) -> np.ndarray:
+        w = np.exp2(-np.maximum(now - timestamps, 0) / self.half_life)
+        # Events without a timestamp count fully
+        w[np.isnan(w)] = 1
+        return w
+
+    def horizon(self) -> Optional[float]:
+        # Age in seconds after which an event weighs less than min_weight
+        if self.min_weight <= 0:
+            return None
+        return self.half_life * float(np.log2(1 / self.min_weight))
+
+    def since(self, now: float) -> Optional[float]:
+        horizon = self.horizon()
+        return None if horizon is None else now - horizon
+
+class ObservationBuilder:
+    # Interns devices and items to integers as events stream in and keeps the (device, item) pairs in
+    # compact growable int arrays. build() deduplicates and applies the minimum basket size vectorized
+    # and returns the item x basket matrix ready for CosineSimRecommendationModel.train_matrix.
+    # With a TimeDecay, event times are kept too and every (item, basket) entry weighs as much as its
+    # newest event instead of 1.
+
+    def __init__(self, min_basket: int = 5, decay: TimeDecay = None):
+        self.min_basket = min_basket
+        self.decay = decay
+        self.items = []
+        self.itemidx = dict()
+        self.devices = dict()
+        self._devices = array('i')
+        self._items = array('i')
+        self._timestamps = array('d') if decay is not None else None
+
+    def __len__(self):
+        return len(self._items)
+
+    def _item(self, item: Hashable) -> int:
+        i = self.itemidx.get(item)
+        if i is None:
+            i = self.itemidx[item] = len(self.items)
+            self.items.append(item)
+        return i
+
+    def _device(self, device_id: Hashable) -> int:
+        d = self.devices.get(device_id)
+        if d is None:
+            d = self.devices[device_id] = len(self.devices)
+        return d
+
+    def add(self, device_id: Hashable, item: Hashable, timestamp: float = None):
+        self._devices.append(self._device(device_id))
+        self._items.append(self._item(item))
+        if self._timestamps is not None:
+            self._timestamps.append(np.nan if timestamp is None else timestamp)
+
+    def add_encoded(self, device_ids: list[Hashable], items: list[Hashable], devices: np.ndarray, item_codes: np.ndarray, timestamps: np.ndarray = None):
+        # Events already dictionary-encoded, e.g. an EventLog partition: only the dictionaries are interned
+        device_map = np.array([self._device(d) for d in device_ids], dtype=np.int32)
+        item_map = np.array([self._item(i) for i in items], dtype=np.int32)
+        self._devices.frombytes(device_map[devices].tobytes())
+        self._items.frombytes(item_map[item_codes].tobytes())
+        if self._timestamps is not None:
+            if timestamps is None:
+                timestamps = np.full(len(devices), np.nan)
+            self._timestamps.frombytes(np.asarray(timestamps, dtype=np.float64).tobytes())
+
+    def build(self, now: float = None) -> tuple[list[Hashable], csr_matrix]:
+        # now: the time the decay is measured from, the current time by default
+        n = max(len(self.items), 1)
+        devices = np.frombuffer(self._devices, dtype=np.int32).astype(np.int64)
+        pairs = devices * n + np.frombuffer(self._items, dtype=np.int32)
+        if self.decay is None:
+            pairs = np.unique(pairs)
+            weights = np.ones(len(pairs))
+        else:
+            weights = self.decay.weights(np.frombuffer(self._timestamps, dtype=np.float64), time.time() if now is None else now)
+            keep = weights >= self.decay.min_weight
+            pairs, weights = pairs[keep], weights[keep]
+            # The heaviest (newest) event of every pair: sort by pair, then weight, and take each pair's last
+            order = np.lexsort((weights, pairs))
+            pairs, weights = pairs[order], weights[order]
+            last = np.append(pairs[1:] != pairs[:-1], True)
+            pairs, weights = pairs[last], weights[last]
+        devices, items = pairs // n, pairs % n
+        keep = np.bincount(devices)[devices] >= self.min_basket
+        devices, items, weights = devices[keep], items[keep], weights[keep]
+        _, baskets = np.unique(devices, return_inverse=True)
+        used, items = np.unique(items, return_inverse=True)
+        itemobsv = coo_matrix((weights, (items, baskets)), shape=(len(used), baskets.max(initial=-1) + 1))
+        return [self.items[i] for i in used], itemobsv.tocsr()
+
+class ShardedObservationBuilder:
+    # Routes events to one ObservationBuilder per study program (the first element of an item), so
+    # baskets and the minimum basket size are counted per shard. study_programs limits the shards built.
+
+    def __init__(self, study_programs: Iterable[str] = None, min_basket: int = 5, decay: TimeDecay = None):
+        self.study_programs = set(study_programs) if study_programs is not None else None
+        self.min_basket = min_basket
+        self.decay = decay
+        self.shards: dict[str, ObservationBuilder] = dict()
+
+    def __len__(self):
+        return sum(len(b) for b in self.shards.values())
+
+    def _shard(self, study_program: str) -> Optional[ObservationBuilder]:
+        b = self.shards.get(study_program)
+        if b is None and (self.study_programs is None or study_program in self.study_programs):
+            b = self.shards[study_program] = ObservationBuilder(self.min_basket, self.decay)
+        return b
+
+    def add(self, device_id: Hashable, item: Hashable, timestamp: float = None):
+        b = self._shard(item[0])
+        if b is not None:
+            b.add(device_id, item, timestamp)
+
+    def add_encoded(self, device_ids: list[Hashable], items: list[Hashable], devices: np.ndarray, item_codes: np.ndarray, timestamps: np.ndarray = None):
+        programs, item_program = np.unique(np.array([p for (p, _) in items], dtype=str), return_inverse=True)
+        event_program = item_program[item_codes]
+        for (j, program) in enumerate(programs.tolist()):
+            b = self._shard(program)
+            if b is None:
+                continue
+            # Pass the shard its own slice of the item dictionary, with the codes renumbered to match
+            sel = np.flatnonzero(item_program == j)
+            local = np.full(len(items), -1, dtype=np.int32)
+            local[sel] = np.arange(len(sel), dtype=np.int32)
+            mask = event_program == j
+            b.add_encoded(device_ids, [items[i] for i in sel], devices[mask], local[item_codes[mask]],
+                timestamps[mask] if timestamps is not None else None)
+
+class CooccurrenceState:
+    # Incremental trainer state: device baskets, the item x item co-occurrence counts of qualified
+    # baskets (the diagonal is each item's basket count, i.e. its squared norm) and the current top-k
+    # neighbours. New events only touch the baskets they belong to, and cosine neighbours are only
+    # recomputed for rows whose counts or neighbour norms changed.
+
+    def __init__(self, min_basket: int = 5, k: int = 100):
+        self.min_basket = min_basket
+        self.k = k
+        self.items = []
+        self.itemidx = dict()
+        self.devices = dict()
+        self.baskets = []
+        self.cooc = csr_matrix((0, 0), dtype=np.int32)
+        self.changed = np.zeros(0, dtype=np.int64)
+        self.neighbours = csr_matrix((0, 0), dtype=np.float32)
+        self.watermark = None
+        self.event_count = 0
+        self.observation_count = 0
+
+    def _basket_matrix(self, baskets: list[set[int]]) -> csr_matrix:
+        indices = np.fromiter((c for b in baskets for c in b), dtype=np.int32)
+        indptr = np.zeros(len(baskets) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in baskets], out=indptr[1:])
+        return csr_matrix((np.ones(len(indices), dtype=np.int32), indices, indptr), shape=(len(baskets), len(self.items)))
+
+    @staticmethod
+    def _grow(m: csr_matrix, n: int) -> csr_matrix:
+        indptr = np.concatenate([m.indptr, np.full(n - m.shape[0], m.indptr[-1])])
+        return csr_matrix((m.data, m.indices, indptr), shape=(n, n))
+
+    def add_event(self, e: dict, before: dict[int, set[int]]):
+        # before collects the previous basket of every device touched until apply() is called
+        key = (e['study_program'], e['course_id'])
+        try:
+            item = self.itemidx[key]
+        except KeyError:
+            item = self.itemidx[key] = len(self.items)
+            self.items.append(key)
+        try:
+            device = self.devices[e['device_id']]
+        except KeyError:
+            device = self.devices[e['device_id']] = len(self.baskets)
+            self.baskets.append(set())
+        basket = self.baskets[device]
+        if item not in basket:
+            if device not in before:
+                before[device] = set(basket)
+            basket.add(item)
+        ts = parse_timestamp(e.get('timestamp'))
+        if ts is not None and (self.watermark is None or ts > self.watermark):
+            self.watermark = ts
+
+    def apply(self, before: dict[int, set[int]], cnt: int):
+        self.observation_count += sum(1 for (d, b) in before.items() if len(b) < self.min_basket <= len(self.baskets[d]))
+        old = self._basket_matrix([b for b in before.values() if len(b) >= self.min_basket])
+        new = self._basket_matrix([self.baskets[d] for d in before if len(self.baskets[d]) >= self.min_basket])
+        delta = (new.T @ new - old.T @ old).tocsr()
+        self.cooc = self._grow(self.cooc, len(self.items)) + delta
+        self.cooc.eliminate_zeros()
+        self.changed = np.union1d(self.changed, np.union1d(old.indices, new.indices))
+        self.event_count += cnt
+
+    def add_events(self, events, limit: int = None) -> int:
+        before = dict()
+        cnt = 0
+        for e in events:
+            self.add_event(e, before)
+            cnt += 1
+            if limit and cnt >= limit:
+                break
+        self.apply(before, cnt)
+        return cnt
+
+    def model(self) -> CosineSimRecommendationModel:
+        n = len(self.items)
+        counts = self.cooc.diagonal().astype(np.float64)
+        # sim(i, j) = cooc(i, j) / sqrt(n_i n_j) changes for every row that co-occurs with a changed item
+        dirty = np.union1d(self.changed, self.cooc[self.changed].indices)
+        rows = self.cooc[dirty]
+        norm = np.sqrt(np.repeat(counts[dirty], np.diff(rows.indptr)) * counts[rows.indices])
+        sim = topk_rows(csr_matrix((rows.data / norm, rows.indices, rows.indptr), shape=rows.shape), self.k)
+        prev = self._grow(self.neighbours, n)
+        lengths = np.diff(prev.indptr)
+        lengths[dirty] = np.diff(sim.indptr)
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        indices = np.empty(indptr[-1], dtype=np.int32)
+        data = np.empty(indptr[-1], dtype=np.float32)
+        clean = np.setdiff1d(np.arange(n), dirty)
+        dst, src = row_positions(indptr, clean), row_positions(prev.indptr, clean)
+        indices[dst], data[dst] = prev.indices[src], prev.data[src]
+        dst = row_positions(indptr, dirty)
+        indices[dst], data[dst] = sim.indices, sim.data
+        self.neighbours = csr_matrix((data, indices, indptr), shape=(n, n))
+        self.changed = np.zeros(0, dtype=np.int64)
+        return CosineSimRecommendationModel(list(self.items), indptr, indices, data, counts.astype(np.float32))
+
+class ShardedCooccurrenceState:
+    # One CooccurrenceState per study program, all fed from a single pass over the events. Shards
+    # that received no new baskets keep their published model and are not retrained.
+
+    def __init__(self, min_basket: int = 5, k: int = 100):
+        self.min_basket = min_basket
+        self.k = k
+        self.shards: dict[str, CooccurrenceState] = dict()
+        self.watermark = None
+
+    def add_events(self, events, limit: int = None) -> int:
+        before = dict()
+        counts = dict()
+        cnt = 0
+        for e in events:
+            program = e['study_program']
+            shard = self.shards.get(program)
+            if shard is None:
+                shard = self.shards[program] = CooccurrenceState(self.min_basket, self.k)
+            shard.add_event(e, before.setdefault(program, dict()))
+            counts[program] = counts.get(program, 0) + 1
+            cnt += 1
+            if limit and cnt >= limit:
+                break
+        for (program, b) in before.items():
+            self.shards[program].apply(b, counts[program])
+        self.watermark = max((s.watermark for s in self.shards.values() if s.watermark is not None), default=None)
+        return cnt
+
+    def changed(self) -> list[str]:
+        return [p for (p, s) in self.shards.items() if len(s.changed)]
+
+# Offered-course masks a model keeps, one per preloaded semester
+OFFERED_MASKS = 64
 
 class CourseRecommendationModel:
     
     def __init__(self):
         self.model = None
+        self.trained_at = None
+        self.observation_count = 0
+        # (study_program, semester, academic_year) -> (offered course numbers by popularity, their names)
+        self.popular_courses = dict()
         self.logger = getLogger('CourseRecommendationModel')
 
-    def populate(self):
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_course_nos', None)
+        state.pop('_offered_masks', None)
+        state.pop('_popular', None)
+        return state
+
+    def populate(self, limit: int = 900000, neighbours: Neighbours = None, decay: TimeDecay = None):
         self.logger.info("Started download {}".format(time.time()))
-        obsv = self.downloadobsvdata(ElasticService())
+        items, itemobsv = self.downloadobsvdata(ElasticService(), limit, decay)
         self.logger.info("Download completed {}. Start training".format(time.time()))
-        self.model = CosineSimRecommendationModel.train(obsv)
-        self.logger.info("Training completed {}".format(time.time()))
+        self.train_observations(items, itemobsv, neighbours)
+
+    def populate_eventlog(self, log: EventLog, limit: int = 900000, neighbours: Neighbours = None, decay: TimeDecay = None):
+        self.logger.info("Started reading event log {}".format(time.time()))
+        builder = ObservationBuilder(decay=decay)
+        read_event_log(log, builder, limit)
+        self.logger.info("Read {} events. Start training".format(len(builder)))
+        self.train_observations(*builder.build(), neighbours)
+
+    def populate_incremental(self, state: CooccurrenceState, limit: int = 900000, log: EventLog = None):
+        fetch_new_events(state, limit, log, self.logger)
+        self.train_state(state)
+
+    def train_observations(self, items: list[Hashable], itemobsv: csr_matrix, neighbours: Neighbours = None):
+        start = time.time()
+        self.model = CosineSimRecommendationModel.train_matrix(items, itemobsv, neighbours=neighbours)
+        self.trained_at = time.time()
+        self.observation_count = itemobsv.shape[1]
+        self.trained(start)
+
+    def train_state(self, state: CooccurrenceState):
+        start = time.time()
+        self.model = state.model()
+        self.trained_at = time.time()
+        self.observation_count = state.observation_count
+        self.trained(start)
+
+    def trained(self, start: float):
+        TRAINING_DURATION.set(self.trained_at - start)
+        TRAINING_OBSERVATIONS.set(self.observation_count)
+        MODEL_SIZE.set(self.model.indptr.nbytes + self.model.indices.nbytes + self.model.data.nbytes)
+        self.logger.info("Training completed {}".format(self.trained_at))
+
+    def offered_mask(self, offered: Optional[Collection[str]]) -> Optional[np.ndarray]:
+        # Boolean mask over the model's items whose course number is in `offered`. Preloaded semesters
+        # hand out the same dict until it expires, so masks are kept per dict; the entry holds on to
+        # the dict itself, so its id cannot be reused by another one while the mask is cached.
+        if offered is None:
+            return None
+        try:
+            masks = self._offered_masks
+        except AttributeError:
+            masks = self._offered_masks = LRUCache(maxsize=OFFERED_MASKS)
+        entry = masks.get(id(offered))
+        if entry is not MISSING and entry[0] is offered:
+            return entry[1]
+        try:
+            course_nos = self._course_nos
+        except AttributeError:
+            course_nos = self._course_nos = np.array([c for (_, c) in self.model.items], dtype=str)
+        mask = np.isin(course_nos, list(offered))
+        masks.put(id(offered), (offered, mask))
+        return mask
 
-    def infer(self, selected_courses):
-        res = self.model.infer(selected_courses)
-        res = sorted(res.items(), key=lambda x:-x[1])
-        return [course for course, score in res][:100]
+    def infer(self, selected_courses, offered: Collection[str] = None):
+        if offered is None:
+            ranked = self.model.rank(selected_courses)
+        else:
+            ranked = self.model.rank(selected_courses, allowed=self.offered_mask(offered))
+        return [course for course, score in ranked]
+
+    def infer_batch(self, selected_courses, offered: list[Optional[Collection[str]]] = None):
+        if offered is None:
+            ranked = self.model.rank_batch(selected_courses)
+        else:
+            # Requests for the same semester share one mask
+            ranked = self.model.rank_batch(selected_courses, allowed=[self.offered_mask(o) for o in offered])
+        return [[course for course, score in res] for res in ranked]
     
-    def downloadobsvdata(self, es: ElasticService):
-        self.logger.info('Download observation')
-        cnt = 0
-        obsv = dict()
-        for e in es.find_all_user_add_course():
-            course_key = (e['study_program'], e['course_id'])
-            grouping = e['device_id']
-            try:
-                obsv[grouping].add(course_key)
-            except KeyError:
-                obsv[grouping] = set([course_key])
+    def downloadobsvdata(self, es: ElasticService, limit: int = 900000, decay: TimeDecay = None) -> tuple[list[Hashable], csr_matrix]:
+        builder = ObservationBuilder(decay=decay)
+        download_observations(es, builder, limit, self.logger)
+        items, itemobsv = builder.build()
+        self.logger.info('Retrieved {} qualified observation'.format(itemobsv.shape[1]))
+        return items, itemobsv
 
-            cnt += 1
-            if cnt % 10000 == 0:
-                self.logger.info("Downloaded {} observations".format(cnt))
-            if cnt >= 900000:
-                 break
-        self.logger.info('Received {} observations'.format(cnt))
-        obsv = [l for _, l in obsv.items() if len(l) > 4]
-        self.logger.info('Retrieved {} qualified observation'.format(len(obsv)))
-        return obsv
-
-    def random_infer(self):
-        return random.sample(list(self.model.ccmtx.keys()), min(len(self.model.ccmtx), 300))
-
-def get_course_recommendation_model():
+    def popular(self, offered: Collection[str] = None, n: Optional[int] = 100) -> list[tuple[str, str]]:
+        # The n items in the most baskets, among the offered courses if given. n=None: all of them
+        try:
+            order = self._popular
+        except AttributeError:
+            order = self._popular = np.argsort(-self.model.popularity(), kind='stable')
+        if offered is not None:
+            order = order[self.offered_mask(offered)[order]]
+        return [self.model.items[i] for i in order[:n].tolist()]
+
+    def knows(self, keys: list[Hashable]) -> bool:
+        return any(k in self.model.itemidx for k in keys)
+
+    def precomputed(self, key: tuple[str, str, str]) -> Optional[tuple[list[str], dict[str, str]]]:
+        # Models from before the table was added have no popular_courses
+        return getattr(self, 'popular_courses', dict()).get(key)
+
+    def precompute_popular(self, mongo, semesters: list[tuple[str, str]]):
+        # Ranks the courses of every study program in the model that are offered in each of the
+        # semesters, together with their names, so that RANDOM and cold-start requests of those
+        # semesters need neither inference nor Mongo
+        table = dict()
+        for program in sorted(set(p for (p, _) in self.model.items)):
+            for (academic_year, semester) in semesters:
+                names = mongo.get_semester_courses(semester=semester, study_program=program, academic_year=academic_year)
+                ranked = list(dict.fromkeys(c for (p, c) in self.popular(names, n=None) if p == program and names.get(c)))
+                table[(program, semester, academic_year)] = (ranked, dict((c, names[c]) for c in ranked))
+        self.popular_courses = table
+        self.logger.info('Precomputed popular courses of {} semesters'.format(len(table)))
+
+    def random_infer(self, offered: Collection[str] = None):
+        items = self.model.items
+        if offered is not None:
+            items = [items[i] for i in np.flatnonzero(self.offered_mask(offered))]
+        return random.sample(items, min(len(items), 300))
+
+def download_observations(es: ElasticService, builder, limit: int = 900000, logger=None) -> int:
+    # With a decaying builder, only events within its horizon are downloaded
+    logger = logger or getLogger('download_observations')
+    logger.info('Download observation')
+    start = time.time()
+    cnt = 0
+    decay = builder.decay
+    for e in es.find_all_user_add_course(since=decay.since(start) if decay is not None else None):
+        builder.add(e['device_id'], (e['study_program'], e['course_id']), parse_timestamp(e.get('timestamp')) if decay is not None else None)
+        cnt += 1
+        if cnt % 10000 == 0:
+            logger.info("Downloaded {} observations".format(cnt))
+        if cnt >= limit:
+            break
+    logger.info('Received {} observations'.format(cnt))
+    TRAINING_DOWNLOAD_RATE.set(cnt / max(time.time() - start, 1e-9))
+    return cnt
+
+def read_event_log(log: EventLog, builder, limit: int = 900000) -> int:
+    # Newest partitions first, like a download. With a decaying builder, partitions past its horizon are not read
+    cnt = 0
+    since = builder.decay.since(time.time()) if builder.decay is not None else None
+    for p in log.partitions():
+        if cnt >= limit or (since is not None and p < EventLog._day(since)):
+            break
+        cols = log.read(p)
+        n = limit - cnt
+        items = list(zip(cols['study_programs'].tolist(), cols['course_ids'].tolist()))
+        builder.add_encoded(cols['devices'].tolist(), items, cols['device'][:n], cols['item'][:n], cols['timestamp'][:n])
+        cnt += min(n, len(cols['device']))
+    return cnt
+
+def fetch_new_events(state, limit: int = 900000, log: EventLog = None, logger=None) -> int:
+    logger = logger or getLogger('fetch_new_events')
+    since = state.watermark
+    start = time.time()
+    logger.info("Started incremental download since {} at {}".format(since, start))
+    events = log.events(since=since) if log is not None else ElasticService().find_all_user_add_course(since=since)
+    # The first run is capped like a full download; later runs take everything newer than the watermark.
+    # An event log was already capped when it was first synced.
+    cnt = state.add_events(events, limit=limit if since is None and log is None else None)
+    logger.info("Received {} new observations. Start training".format(cnt))
+    TRAINING_DOWNLOAD_RATE.set(cnt / max(time.time() - start, 1e-9))
+    return cnt
+
+def get_course_recommendation_model(limit: int = 900000, log: EventLog = None, neighbours: Neighbours = None, decay: TimeDecay = None):
+    model = CourseRecommendationModel()
+    if log is not None:
+        model.populate_eventlog(log, limit, neighbours, decay)
+    else:
+        model.populate(limit, neighbours, decay)
+    return model
+
+def get_course_recommendation_shards(limit: int = 900000, log: EventLog = None, study_programs: Iterable[str] = None, neighbours: Neighbours = None, decay: TimeDecay = None) -> dict[str, CourseRecommendationModel]:
+    # One model per study program from a single read of the events. With study_programs, only
+    # those shards are trained; the events of other programs are skipped.
+    logger = getLogger('get_course_recommendation_shards')
+    builder = ShardedObservationBuilder(study_programs, decay=decay)
+    if log is not None:
+        read_event_log(log, builder, limit)
+    else:
+        download_observations(ElasticService(), builder, limit, logger)
+    shards = dict()
+    for (program, b) in builder.shards.items():
+        model = CourseRecommendationModel()
+        model.train_observations(*b.build(), neighbours)
+        shards[program] = model
+    logger.info('Trained {} shards'.format(len(shards)))
+    return shards
+
+def sync_event_log(directory: str, limit: int = 900000) -> EventLog:
+    log = EventLog(directory)
+    try:
+        log.sync(ElasticService(), limit)
+    except Exception:
+        # Keep training on what is stored locally
+        getLogger('sync_event_log').exception('Event log sync failed, training from {} cached events'.format(len(log)))
+    return log
+
+def load_state(state_path: Optional[str], factory):
+    if state_path and os.path.exists(state_path):
+        try:
+            return load_mapped(state_path)
+        except Exception:
+            # E.g. pickled by an older version of the state classes: start over with a full download
+            getLogger('load_state').exception('Ignoring invalid state {}'.format(state_path))
+    return factory()
+
+incremental_state: Optional[CooccurrenceState] = None
+
+def get_incremental_course_recommendation_model(state_directory: str = None, limit: int = 900000, log: EventLog = None):
+    # The training process is long-lived, so the state normally stays in memory between refreshes.
+    # It is also written next to the snapshots so a restarted server can continue from the watermark.
+    global incremental_state
+    state_path = os.path.join(state_directory, STATE_FILE) if state_directory else None
+    state, incremental_state = incremental_state, None
+    if state is None:
+        state = load_state(state_path, CooccurrenceState)
     model = CourseRecommendationModel()
-    model.populate()
+    # If this fails halfway the state is inconsistent and is dropped; the next run starts from the saved copy
+    model.populate_incremental(state, limit, log)
+    incremental_state = state
+    if state_path:
+        dump_mapped(state, state_path)
     return model
 
-def recommend_course(req: grpcmsg.CourseRecommendationRequest, cache: SharableCache) -> grpcmsg.CourseRecommendationResponse:
-    logger = getLogger('recommend_course')
-    model: CourseRecommendationModel = cache.get_or_create('recommend_course_model', get_course_recommendation_model)
-    res = []
+incremental_shard_state: Optional[ShardedCooccurrenceState] = None
+
+def get_incremental_course_recommendation_shards(state_directory: str = None, limit: int = 900000, log: EventLog = None) -> dict[str, CourseRecommendationModel]:
+    # Like get_incremental_course_recommendation_model, but only shards with new baskets are returned
+    global incremental_shard_state
+    state_path = os.path.join(state_directory, SHARD_STATE_FILE) if state_directory else None
+    state, incremental_shard_state = incremental_shard_state, None
+    if state is None:
+        state = load_state(state_path, ShardedCooccurrenceState)
+    fetch_new_events(state, limit, log)
+    shards = dict()
+    for program in state.changed():
+        model = CourseRecommendationModel()
+        model.train_state(state.shards[program])
+        shards[program] = model
+    incremental_shard_state = state
+    if state_path:
+        dump_mapped(state, state_path)
+    return shards
+
+def shard_key(study_program: str) -> str:
+    return '{}/{}'.format(MODEL_KEY, study_program)
+
+def shard_models(cache: SharableCache) -> dict[str, CourseRecommendationModel]:
+    # Every published shard by study program
+    prefix = MODEL_KEY + '/'
+    return dict((k[len(prefix):], cache.get(k)) for k in published_model_keys(cache) if k.startswith(prefix))
+
+def fallback_model(shards: list[CourseRecommendationModel]) -> CourseRecommendationModel:
+    # The union of the shards, published as the global model in shard mode. It serves requests
+    # without a study program and of programs that have no shard, as the global model did before.
+    # Programs share no items or baskets, so it ranks like the shards themselves.
+    model = CourseRecommendationModel()
+    model.model = CosineSimRecommendationModel.concatenate([s.model for s in shards])
+    model.trained_at = min(s.trained_at for s in shards)
+    model.observation_count = sum(s.observation_count for s in shards)
+    for s in shards:
+        model.popular_courses.update(getattr(s, 'popular_courses', dict()))
+    return model
+
+def publish_fallback_model(cache: SharableCache, shards: list[CourseRecommendationModel]):
+    if shards:
+        cache.update(MODEL_KEY, fallback_model(shards))
+
+def shard_snapshot_directory(snapshot_directory: str, study_program: str) -> str:
+    return os.path.join(snapshot_directory, SHARD_DIRECTORY, quote(study_program, safe=''))
+
+def snapshot_header(model: CourseRecommendationModel) -> dict:
+    return {
+        'trained_at': model.trained_at,
+        'observation_count': model.observation_count,
+        'item_count': len(model.model),
+    }
+
+def precompute_popular_courses(models: Iterable[CourseRecommendationModel], semesters: int):
+    # Tables for the `semesters` latest semesters. Never fails the training run: without a table,
+    # cold-start requests are simply answered the regular way.
+    if not semesters:
+        return
+    try:
+        mongo = get_mongo_service()
+        recent = mongo.get_recent_semesters(semesters)
+        for model in models:
+            model.precompute_popular(mongo, recent)
+    except Exception:
+        getLogger('precompute_popular_courses').exception('Cannot precompute popular courses')
+
+def refresh_course_recommendation_model(cache: SharableCache, snapshot_directory: str = None, snapshot_keep: int = 3, incremental: bool = False, limit: int = 900000, event_log_directory: str = None, shard_by_program: bool = False, study_programs: Iterable[str] = None, neighbours: Neighbours = None, popular_semesters: int = 0, decay: TimeDecay = None) -> int:
+    # neighbours and decay only apply to full runs; incremental runs count every event fully and
+    # recompute the changed rows exactly
+    with PROFILING.training():
+        log = sync_event_log(event_log_directory, limit) if event_log_directory else None
+        if shard_by_program:
+            return refresh_course_recommendation_shards(cache, snapshot_directory, snapshot_keep, incremental, limit, log, study_programs, neighbours, popular_semesters, decay)
+        if incremental:
+            model = get_incremental_course_recommendation_model(snapshot_directory, limit, log)
+        else:
+            model = get_course_recommendation_model(limit, log, neighbours, decay)
+        precompute_popular_courses([model], popular_semesters)
+        cache.update(MODEL_KEY, model)
+        if snapshot_directory:
+            save_snapshot(snapshot_directory, model, snapshot_header(model), keep=snapshot_keep)
+        return len(model.model)
+
+def refresh_course_recommendation_shards(cache: SharableCache, snapshot_directory: str = None, snapshot_keep: int = 3, incremental: bool = False, limit: int = 900000, log: EventLog = None, study_programs: Iterable[str] = None, neighbours: Neighbours = None, popular_semesters: int = 0, decay: TimeDecay = None) -> int:
+    # Every shard is published under its own key, so a worker only maps the shards it is asked for.
+    # Incremental runs update every program that has new baskets; study_programs applies to full runs.
+    # The union of all current shards is published as the global fallback model.
+    if incremental:
+        shards = get_incremental_course_recommendation_shards(snapshot_directory, limit, log)
+        current = shard_models(cache)
+    else:
+        shards = get_course_recommendation_shards(limit, log, study_programs, neighbours, decay)
+        current = dict()
+    precompute_popular_courses(shards.values(), popular_semesters)
+    for (program, model) in shards.items():
+        cache.update(shard_key(program), model)
+        if snapshot_directory:
+            save_snapshot(shard_snapshot_directory(snapshot_directory, program), model, snapshot_header(model), keep=snapshot_keep)
+    current.update(shards)
+    publish_fallback_model(cache, [current[p] for p in sorted(current)])
+    return sum(len(model.model) for model in shards.values())
+
+def load_course_recommendation_snapshot(cache: SharableCache, snapshot_directory: str, shard_by_program: bool = False) -> Optional[dict]:
+    # Publish the newest valid snapshot, if any. Returns its header.
+    if shard_by_program:
+        return load_course_recommendation_shard_snapshots(cache, snapshot_directory)
+    snap = load_latest_snapshot(snapshot_directory)
+    if snap is None:
+        return None
+    header, model = snap
+    cache.update(MODEL_KEY, model)
+    return header
+
+def load_course_recommendation_shard_snapshots(cache: SharableCache, snapshot_directory: str) -> Optional[dict]:
+    # Publish the newest snapshot of every shard. The returned header carries the oldest training time.
+    try:
+        names = os.listdir(os.path.join(snapshot_directory, SHARD_DIRECTORY))
+    except FileNotFoundError:
+        return None
+    headers = []
+    models = []
+    for name in sorted(names):
+        snap = load_latest_snapshot(os.path.join(snapshot_directory, SHARD_DIRECTORY, name))
+        if snap is not None:
+            header, model = snap
+            cache.update(shard_key(unquote(name)), model)
+            headers.append(header)
+            models.append(model)
+    if not headers:
+        return None
+    publish_fallback_model(cache, models)
+    return {
+        'trained_at': min(h['trained_at'] for h in headers),
+        'observation_count': sum(h['observation_count'] for h in headers),
+        'item_count': sum(h['item_count'] for h in headers),
+        'shards': len(headers),
+    }
+
+def get_model(cache: SharableCache, study_program: str = None) -> CourseRecommendationModel:
+    # The shard of the study program if models are sharded, the global model otherwise
+    if study_program is not None:
+        try:
+            return cache.get(shard_key(study_program))
+        except KeyError:
+            pass
+    try:
+        return cache.get(MODEL_KEY)
+    except KeyError:
+        if study_program is not None:
+            raise ModelNotReadyError('course recommendation model for {} is not trained yet'.format(study_program))
+        raise ModelNotReadyError('course recommendation model is not trained yet')
+
+def published_model_keys(cache: SharableCache) -> list[str]:
+    return [k for k in list(cache.shared_cache.keys()) if k == MODEL_KEY or k.startswith(MODEL_KEY + '/')]
+
+def warm_up_worker(cache: SharableCache):
+    # Initializer of new worker processes: maps every published model and reads its arrays once, so
+    # the first requests of a fresh worker do not pay for loading it. Never fails the worker.
+    logger = getLogger('warm_up_worker')
+    try:
+        keys = published_model_keys(cache)
+        for key in keys:
+            model = cache.get(key)
+            if model.model is not None:
+                for arr in (model.model.indptr, model.model.indices, model.model.data):
+                    arr.sum()
+        logger.info('Worker {} mapped {} models'.format(os.getpid(), len(keys)))
+    except Exception:
+        logger.exception('Cannot warm up worker {}'.format(os.getpid()))
+
+def offered_courses(mongo, key: grpcmsg.SemesterKey) -> Optional[dict[str, str]]:
+    # Only known when whole semesters are preloaded; otherwise courses that are not offered are
+    # dropped after ranking, by the name lookup
+    if not mongo.preload:
+        return None
+    return mongo.get_semester_courses(semester=key.semester, study_program=key.studyProgram, academic_year=key.academicYear)
+
+def infer_course(model: CourseRecommendationModel, req: grpcmsg.CourseRecommendationRequest, offered: Collection[str] = None) -> list[tuple[str, str]]:
     if req.variant == 'RANDOM':
-        res = model.random_infer()
+        return model.random_infer(offered)
     elif req.variant == 'COSINE':
-        res = model.infer([(e.semesterKey.studyProgram, e.courseNo) for e in req.selectedCourses])
+        keys = selected_course_keys(req)
+        if not model.knows(keys):
+            # Cold start: nothing to score against, so the most popular courses of the program
+            program = req.semesterKey.studyProgram
+            return [k for k in model.popular(offered, n=None) if not program or k[0] == program][:100]
+        return model.infer(keys, offered)
     else:
         raise Exception('{} variant is invalid'.format(req.variant))
+
+# Courses in a response
+RESPONSE_COURSES = 11
+
+def semester_key(req: grpcmsg.CourseRecommendationRequest) -> tuple[str, str, str]:
+    return (req.semesterKey.studyProgram, req.semesterKey.semester, req.semesterKey.academicYear)
+
+def selected_course_keys(req: grpcmsg.CourseRecommendationRequest) -> list[tuple[str, str]]:
+    return [(e.semesterKey.studyProgram, e.courseNo) for e in req.selectedCourses]
+
+def candidate_courses(req: grpcmsg.CourseRecommendationRequest, res: list[tuple[str, str]]) -> list[str]:
+    selected = set(e.courseNo for e in req.selectedCourses)
+    return [course_no for (study_program, course_no) in res if course_no not in selected]
+
+def enrich_courses(req: grpcmsg.CourseRecommendationRequest, candidates: list[str], abbrs: dict[str, Optional[str]]) -> grpcmsg.CourseRecommendationResponse:
     enriched_res = []
-    mongo = get_mongo_service()
-    for study_program, course_no in res:
-        if len(enriched_res) > 10:
+    for course_no in candidates:
+        if len(enriched_res) >= RESPONSE_COURSES:
             break
-        if course_no in [e.courseNo for e in req.selectedCourses]:
-            continue
-
-        abbr = mongo.get_course_abbr(course_no=course_no, study_program=req.semesterKey.studyProgram, semester=req.semesterKey.semester, academic_year=req.semesterKey.academicYear)
+        abbr = abbrs[course_no]
         if abbr:
             d = grpcmsg.CourseRecommendationResponse.CourseDetail()
             d.key.courseNo = course_no
@@ -121,8 +905,202 @@ def recommend_course(req: grpcmsg.CourseRecommendationRequest, cache: SharableCa
     resp.courses.extend(enriched_res)
     return resp
 
-def recommend_course_serialized(req: bytes, cache: SharableCache) -> bytes:
-    r = grpcmsg.CourseRecommendationRequest()
-    r.ParseFromString(req)
-    res = recommend_course(r, cache)
-    return res.SerializeToString()
+# Time a name query to Mongo takes in this worker
+enrichment_seconds = Ewma(0.05)
+
+def fetch_course_abbrs(mongo, key: tuple[str, str, str], course_nos: list[str], deadline: Optional[float] = None) -> Optional[dict[str, Optional[str]]]:
+    # Names of course_nos, or None when some are not cached and a Mongo query would likely end after the deadline
+    (study_program, semester, academic_year) = key
+    abbrs = mongo.cached_course_abbrs(course_nos, semester=semester, study_program=study_program, academic_year=academic_year)
+    missing = [c for c in course_nos if c not in abbrs]
+    if not missing:
+        return abbrs
+    if deadline is not None and deadline - time.time() < enrichment_seconds.value:
+        return None
+    start = time.perf_counter()
+    found = mongo.get_course_abbrs(missing, semester=semester, study_program=study_program, academic_year=academic_year)
+    enrichment_seconds.update(time.perf_counter() - start)
+    return dict(abbrs, **found)
+
+def degraded_response(req: grpcmsg.CourseRecommendationRequest, model: CourseRecommendationModel, candidates: list[str], mongo, offered: Collection[str] = None) -> grpcmsg.CourseRecommendationResponse:
+    # Answer without querying Mongo: the ranked candidates, then the most popular courses, whose names
+    # this worker already has cached. Marked degraded so the front process does not cache it.
+    REQUESTS_SHED.inc(reason='degraded')
+    selected = set(e.courseNo for e in req.selectedCourses)
+    course_nos = list(dict.fromkeys(candidates + [c for (_, c) in model.popular(offered) if c not in selected]))
+    abbrs = mongo.cached_course_abbrs(course_nos, semester=req.semesterKey.semester, study_program=req.semesterKey.studyProgram, academic_year=req.semesterKey.academicYear)
+    res = enrich_courses(req, course_nos, dict((c, abbrs.get(c)) for c in course_nos))
+    res.degraded = True
+    return res
+
+def check_deadline(deadline: Optional[float]):
+    if deadline is not None and time.time() > deadline:
+        REQUESTS_SHED.inc(reason='expired')
+        raise DeadlineExceededError('the deadline passed before a worker picked the request up')
+
+def precomputed_response(model: CourseRecommendationModel, req: grpcmsg.CourseRecommendationRequest) -> Optional[grpcmsg.CourseRecommendationResponse]:
+    # RANDOM requests and COSINE requests without a course known to the model, answered from the
+    # trainer's table of popular courses. None if the request needs inference or the table does not
+    # cover its semester.
+    if req.variant == 'COSINE':
+        if model.knows(selected_course_keys(req)):
+            return None
+    elif req.variant != 'RANDOM':
+        return None
+    entry = model.precomputed(semester_key(req))
+    if entry is None:
+        return None
+    (ranked, names) = entry
+    selected = set(e.courseNo for e in req.selectedCourses)
+    n = min(len(ranked), RESPONSE_COURSES + len(selected))
+    picked = random.sample(ranked, n) if req.variant == 'RANDOM' else ranked[:n]
+    return enrich_courses(req, [c for c in picked if c not in selected], names)
+
+def recommend_course(req: grpcmsg.CourseRecommendationRequest, cache: SharableCache, deadline: float = None) -> grpcmsg.CourseRecommendationResponse:
+    # deadline: time.time() after which the caller no longer waits for the response
+    with REQUEST_STAGE_SECONDS.time(stage='model'):
+        model = get_model(cache, req.semesterKey.studyProgram or None)
+    res = precomputed_response(model, req)
+    if res is not None:
+        return res
+    mongo = get_mongo_service()
+    with REQUEST_STAGE_SECONDS.time(stage='mongo'):
+        offered = offered_courses(mongo, req.semesterKey)
+    with REQUEST_STAGE_SECONDS.time(stage='inference'):
+        candidates = candidate_courses(req, infer_course(model, req, offered))
+    with REQUEST_STAGE_SECONDS.time(stage='mongo'):
+        abbrs = fetch_course_abbrs(mongo, semester_key(req), candidates, deadline)
+    if abbrs is None:
+        return degraded_response(req, model, candidates, mongo, offered)
+    return enrich_courses(req, candidates, abbrs)
+
+def recommend_course_batch(reqs: list[grpcmsg.CourseRecommendationRequest], cache: SharableCache, deadlines: list[Optional[float]] = None) -> list:
+    # Requests are grouped by study program so each group is scored against its own shard. COSINE
+    # requests of a group are scored together with one sparse product, and names are fetched with one
+    # query per distinct semester. A request that fails gets its exception in place of a response,
+    # so one bad request does not fail the others batched with it.
+    mongo = get_mongo_service()
+    results = [None] * len(reqs)
+    deadlines = deadlines or [None] * len(reqs)
+    for (i, deadline) in enumerate(deadlines):
+        try:
+            check_deadline(deadline)
+        except DeadlineExceededError as e:
+            results[i] = e
+    offered = dict()
+    groups = dict()
+    models = dict()
+    for (i, r) in enumerate(reqs):
+        if results[i] is None:
+            groups.setdefault(r.semesterKey.studyProgram, []).append(i)
+    for (study_program, group) in groups.items():
+        try:
+            with REQUEST_STAGE_SECONDS.time(stage='model'):
+                model = get_model(cache, study_program or None)
+        except ModelNotReadyError as e:
+            for i in group:
+                results[i] = e
+            continue
+        rest = []
+        for i in group:
+            models[i] = model
+            try:
+                results[i] = precomputed_response(model, reqs[i])
+            except Exception as e:
+                results[i] = e
+            if results[i] is None:
+                rest.append(i)
+        with REQUEST_STAGE_SECONDS.time(stage='mongo'):
+            for i in rest:
+                key = semester_key(reqs[i])
+                if key not in offered:
+                    try:
+                        offered[key] = offered_courses(mongo, reqs[i].semesterKey)
+                    except Exception as e:
+                        offered[key] = e
+                if isinstance(offered[key], Exception):
+                    results[i] = offered[key]
+        rest = [i for i in rest if results[i] is None]
+        with REQUEST_STAGE_SECONDS.time(stage='inference'):
+            cosine = [i for i in rest if reqs[i].variant == 'COSINE' and model.knows(selected_course_keys(reqs[i]))]
+            selected = [selected_course_keys(reqs[i]) for i in cosine]
+            cosine_offered = [offered[semester_key(reqs[i])] for i in cosine]
+            try:
+                if all(o is None for o in cosine_offered):
+                    ranked = model.infer_batch(selected)
+                else:
+                    ranked = model.infer_batch(selected, cosine_offered)
+                for (i, res) in zip(cosine, ranked):
+                    results[i] = res
+            except Exception:
+                # Score them one by one, so only the requests that cause the error fail
+                getLogger('recommend_course_batch').exception('Batched inference failed, inferring {} requests one by one'.format(len(cosine)))
+            for i in rest:
+                if results[i] is None:
+                    try:
+                        results[i] = infer_course(model, reqs[i], offered[semester_key(reqs[i])])
+                    except Exception as e:
+                        results[i] = e
+    candidates = dict()
+    semesters = dict()
+    for (i, r) in enumerate(reqs):
+        # Ranked courses still to be named; the rest are errors or precomputed responses
+        if isinstance(results[i], list):
+            candidates[i] = candidate_courses(r, results[i])
+            semesters.setdefault(semester_key(r), dict()).update(dict.fromkeys(candidates[i]))
+    abbrs = dict()
+    with REQUEST_STAGE_SECONDS.time(stage='mongo'):
+        for (key, course_nos) in semesters.items():
+            # The semester's query has to finish before the earliest deadline of its requests
+            deadline = min((deadlines[i] for i in candidates if semester_key(reqs[i]) == key and deadlines[i] is not None), default=None)
+            try:
+                abbrs[key] = fetch_course_abbrs(mongo, key, list(course_nos), deadline)
+            except Exception as e:
+                abbrs[key] = e
+    for (i, r) in enumerate(reqs):
+        if i in candidates:
+            key = semester_key(r)
+            if isinstance(abbrs[key], Exception):
+                results[i] = abbrs[key]
+                continue
+            try:
+                if abbrs[key] is None:
+                    results[i] = degraded_response(r, models[i], candidates[i], mongo, offered[key])
+                else:
+                    results[i] = enrich_courses(r, candidates[i], abbrs[key])
+            except Exception as e:
+                results[i] = e
+    return results
+
+def observe_queue_wait(submitted_at: Optional[float]):
+    # submitted_at: time.time() in the server process when the task was handed to the pool
+    if submitted_at is not None:
+        REQUEST_STAGE_SECONDS.observe(max(time.time() - submitted_at, 0), stage='queue')
+
+def recommend_course_serialized(req: bytes, cache: SharableCache, submitted_at: float = None, deadline: float = None) -> bytes:
+    observe_queue_wait(submitted_at)
+    check_deadline(deadline)
+    with PROFILING.request('Recommend', lambda: req):
+        with REQUEST_STAGE_SECONDS.time(stage='deserialize'):
+            r = grpcmsg.CourseRecommendationRequest()
+            r.ParseFromString(req)
+        res = recommend_course(r, cache, deadline)
+        with REQUEST_STAGE_SECONDS.time(stage='serialize'):
+            return res.SerializeToString()
+
+def batch_request(reqs: list[bytes]) -> bytes:
+    # Serialized CourseRecommendationBatchRequest of serialized requests
+    return grpcmsg.CourseRecommendationBatchRequest(requests=[grpcmsg.CourseRecommendationRequest.FromString(r) for r in reqs]).SerializeToString()
+
+def recommend_course_batch_serialized(reqs: list[bytes], cache: SharableCache, submitted_at: float = None, deadlines: list[Optional[float]] = None) -> list:
+    observe_queue_wait(submitted_at)
+    with PROFILING.request('RecommendBatch', lambda: batch_request(reqs)):
+        parsed = []
+        with REQUEST_STAGE_SECONDS.time(stage='deserialize'):
+            for req in reqs:
+                r = grpcmsg.CourseRecommendationRequest()
+                r.ParseFromString(req)
+                parsed.append(r)
+        results = recommend_course_batch(parsed, cache, deadlines)
+        with REQUEST_STAGE_SECONDS.time(stage='serialize'):
+            return [res if isinstance(res, Exception) else res.SerializeToString() for res in results]
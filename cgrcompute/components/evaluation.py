@@ -0,0 +1,88 @@
+from typing import Hashable
+import time
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from cgrcompute.components.courserecommendation import CosineSimRecommendationModel
+
+
+def split_baskets(itemobsv: csr_matrix, test_fraction: float = 0.1, seed: int = 0) -> tuple[csr_matrix, csr_matrix]:
+    # Splits the baskets (columns) of an item x basket matrix at random. Returns the train matrix,
+    # still item x basket, and the test baskets as rows of a basket x item matrix.
+    rng = np.random.default_rng(seed)
+    test = rng.random(itemobsv.shape[1]) < test_fraction
+    return itemobsv[:, ~test].tocsr(), itemobsv[:, test].T.tocsr()
+
+
+def hide_items(baskets: csr_matrix, known: np.ndarray, n_hidden: int = 1, seed: int = 0) -> tuple[csr_matrix, csr_matrix, np.ndarray]:
+    # Hides up to n_hidden random items the model knows of every basket, always leaving one selected.
+    # Returns the selected and hidden items as basket x item matrices over the baskets where
+    # something could be hidden, and the indices of those baskets.
+    rng = np.random.default_rng(seed)
+    rows = np.repeat(np.arange(baskets.shape[0]), np.diff(baskets.indptr))
+    items = baskets.indices
+    # Unknown items sort last, so they are never hidden
+    keys = np.where(known[items], rng.random(len(items)), np.inf)
+    order = np.lexsort((keys, rows))
+    rows, items, keys = rows[order], items[order], keys[order]
+    position = np.arange(len(rows)) - baskets.indptr[rows]
+    hideable = np.minimum(np.bincount(rows[np.isfinite(keys)], minlength=baskets.shape[0]), np.diff(baskets.indptr) - 1)
+    hidden = position < np.minimum(hideable, n_hidden)[rows]
+    used = np.flatnonzero(hideable > 0)
+    renumber = np.full(baskets.shape[0], -1)
+    renumber[used] = np.arange(len(used))
+    keep = renumber[rows] >= 0
+    rows, items, hidden = renumber[rows[keep]], items[keep], hidden[keep]
+    shape = (len(used), known.shape[0])
+    def matrix(mask):
+        return csr_matrix((np.ones(mask.sum(), dtype=np.float32), (rows[mask], items[mask])), shape=shape)
+    return matrix(~hidden), matrix(hidden), used
+
+
+def recommended_indices(model: CosineSimRecommendationModel, selections: list[list[Hashable]], k: int) -> np.ndarray:
+    # rank_batch results as an item index matrix, padded with -1 where fewer than k came back
+    res = np.full((len(selections), k), -1, dtype=np.int64)
+    for (i, ranked) in enumerate(model.rank_batch(selections, k)):
+        res[i, :len(ranked)] = [model.itemidx[item] for (item, _) in ranked]
+    return res
+
+
+def ranking_metrics(recommended: np.ndarray, hidden: csr_matrix, k: int, n_items: int) -> dict:
+    # Hit rate, recall@k and NDCG@k of the first k columns of `recommended` against the hidden items,
+    # averaged over baskets, and the fraction of the n_items catalogue that was recommended at all
+    recommended = recommended[:, :k]
+    n_hidden = np.diff(hidden.indptr)
+    width = max(hidden.shape[1], 1)
+    hidden_keys = np.repeat(np.arange(hidden.shape[0]), n_hidden) * width + hidden.indices
+    keys = np.arange(len(recommended))[:, None] * width + recommended
+    hits = np.isin(keys, hidden_keys) & (recommended >= 0)
+    discount = 1 / np.log2(np.arange(2, k + 2))
+    ideal = np.cumsum(discount)[np.minimum(n_hidden, k) - 1]
+    return {
+        'k': k,
+        'baskets': len(recommended),
+        'hit_rate': float(hits.any(axis=1).mean()) if len(hits) else 0.0,
+        'recall': float((hits.sum(axis=1) / n_hidden).mean()) if len(hits) else 0.0,
+        'ndcg': float(((hits * discount).sum(axis=1) / ideal).mean()) if len(hits) else 0.0,
+        'coverage': len(np.unique(recommended[recommended >= 0])) / max(n_items, 1),
+    }
+
+
+def evaluate(model: CosineSimRecommendationModel, selected: csr_matrix, hidden: csr_matrix, ks: list[int], batch_size: int = 32) -> dict:
+    # Ranks every basket's selected items in batches like the server does and scores the results at each k
+    selections = [[model.items[i] for i in selected.indices[selected.indptr[b]:selected.indptr[b + 1]]] for b in range(selected.shape[0])]
+    k = max(ks)
+    chunks, latencies = [], []
+    for i in range(0, len(selections), batch_size):
+        start = time.perf_counter()
+        chunks.append(recommended_indices(model, selections[i:i + batch_size], k))
+        latencies.append(time.perf_counter() - start)
+    recommended = np.concatenate(chunks) if chunks else np.zeros((0, k), dtype=np.int64)
+    elapsed = sum(latencies)
+    n_items = int(np.count_nonzero(model.popularity()))
+    return {
+        'metrics': [ranking_metrics(recommended, hidden, k, n_items) for k in ks],
+        'rank_s': elapsed,
+        'baskets_per_s': len(selections) / elapsed if elapsed > 0 else 0.0,
+        'batch_latencies': latencies,
+    }
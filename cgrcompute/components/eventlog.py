@@ -0,0 +1,200 @@
+from cgrcompute.components.external import parse_timestamp
+from array import array
+from datetime import datetime, timezone
+from logging import getLogger
+from typing import Iterable, Iterator, Optional
+import numpy as np
+import json
+import os
+import re
+import shutil
+
+PARTITION_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+CODE_COLUMNS = ('device', 'item', 'timestamp')
+DICTIONARY_COLUMNS = ('devices', 'study_programs', 'course_ids')
+DAY_SECONDS = 86400
+SYNC_MARKER = 'sync.json'
+
+
+class PendingDay:
+    # Events of one day collected during an append, dictionary-encoded as they arrive so a large
+    # sync is held as compact int arrays rather than dicts
+
+    def __init__(self):
+        self.devices, self.items = [], []
+        self._deviceidx, self._itemidx = dict(), dict()
+        self.device, self.item, self.timestamp = array('i'), array('i'), array('d')
+
+    @staticmethod
+    def _code(value, dictionary: list, index: dict) -> int:
+        i = index.get(value)
+        if i is None:
+            i = index[value] = len(dictionary)
+            dictionary.append(value)
+        return i
+
+    def add(self, device_id: str, item: tuple[str, str], timestamp: float):
+        self.device.append(self._code(device_id, self.devices, self._deviceidx))
+        self.item.append(self._code(item, self.items, self._itemidx))
+        self.timestamp.append(timestamp)
+
+
+class EventLog:
+    # "user add course" events stored locally so training does not depend on a live OpenSearch.
+    # Each UTC day is a directory of .npy columns: device and item are int32 codes into the
+    # partition's devices and (study_programs, course_ids) dictionaries, timestamp is epoch seconds
+    # sorted newest first. Columns are memory-mapped on read, so only the ones used are paged in.
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.logger = getLogger('EventLog')
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+
+    def _recover(self):
+        # A crash while swapping a partition leaves it as .old and the complete new one as .tmp
+        names = os.listdir(self.directory)
+        for name in names:
+            if not name.endswith('.old'):
+                continue
+            path = os.path.join(self.directory, name[:-len('.old')])
+            if not os.path.exists(path):
+                if os.path.exists(path + '.tmp'):
+                    os.rename(path + '.tmp', path)
+                else:
+                    os.rename(path + '.old', path)
+                self.logger.warning('Recovered partition {} after an interrupted merge'.format(os.path.basename(path)))
+            shutil.rmtree(path + '.old', ignore_errors=True)
+        for name in names:
+            if name.endswith('.tmp'):
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    def partitions(self) -> list[str]:
+        # Newest first
+        return sorted((p for p in os.listdir(self.directory) if PARTITION_PATTERN.match(p)), reverse=True)
+
+    def read(self, partition: str, columns: Iterable[str] = CODE_COLUMNS + DICTIONARY_COLUMNS) -> dict[str, np.ndarray]:
+        path = os.path.join(self.directory, partition)
+        return {c: np.load(os.path.join(path, c + '.npy'), mmap_mode='r') for c in columns}
+
+    def __len__(self):
+        return sum(len(self.read(p, ('timestamp', ))['timestamp']) for p in self.partitions())
+
+    def watermark(self) -> Optional[float]:
+        # While a sync has not completed, events older than the newest stored one may be missing,
+        # so the watermark stays where that sync started
+        marker = os.path.join(self.directory, SYNC_MARKER)
+        if os.path.exists(marker):
+            with open(marker) as f:
+                return json.load(f)['since']
+        for p in self.partitions():
+            ts = self.read(p, ('timestamp', ))['timestamp']
+            if len(ts):
+                return float(ts[0])
+        return None
+
+    def events(self, since: float = None) -> Iterator[dict]:
+        # Oldest first, in the shape returned by ElasticService.find_all_user_add_course
+        for p in reversed(self.partitions()):
+            if since is not None and p < self._day(since):
+                continue
+            cols = self.read(p)
+            devices, programs, courses = (cols[c].tolist() for c in DICTIONARY_COLUMNS)
+            rows = zip(cols['device'].tolist(), cols['item'].tolist(), cols['timestamp'].tolist())
+            for (device, item, ts) in reversed(list(rows)):
+                if since is not None and ts < since:
+                    continue
+                yield {
+                    'study_program': programs[item],
+                    'course_id': courses[item],
+                    'device_id': devices[device],
+                    'timestamp': ts,
+                }
+
+    def append(self, events: Iterable[dict]) -> int:
+        # Every day touched is merged once, after all events were read
+        cnt = 0
+        pending = dict()
+        for e in events:
+            ts = parse_timestamp(e.get('timestamp')) or 0.0
+            day = pending.get(self._day(ts))
+            if day is None:
+                day = pending[self._day(ts)] = PendingDay()
+            day.add(str(e['device_id']), (str(e['study_program']), str(e['course_id'])), ts)
+            cnt += 1
+        for (partition, day) in pending.items():
+            self._merge(partition, day)
+        return cnt
+
+    def sync(self, es, limit: int = None) -> int:
+        # Fetch events from the newest stored one on (inclusive; duplicates are dropped on merge).
+        # The first sync of an empty log takes at most `limit` events, newest first.
+        since = self.watermark()
+        marker = os.path.join(self.directory, SYNC_MARKER)
+        if not os.path.exists(marker):
+            with open(marker + '.part', 'w') as f:
+                json.dump({'since': since}, f)
+            os.replace(marker + '.part', marker)
+        events = es.find_all_user_add_course(since=since)
+        if since is None and limit is not None:
+            events = (e for (_, e) in zip(range(limit), events))
+        cnt = self.append(events)
+        os.remove(marker)
+        self.logger.info('Synced {} events since {}'.format(cnt, since))
+        return cnt
+
+    @staticmethod
+    def _day(ts: float) -> str:
+        return datetime.fromtimestamp(ts, tz=timezone.utc).strftime('%Y-%m-%d')
+
+    @staticmethod
+    def _encode(values: list, dictionary: list) -> np.ndarray:
+        # Codes of entries already in the dictionary stay the same, new entries are appended
+        index = {v: i for (i, v) in enumerate(dictionary)}
+        codes = np.empty(len(values), dtype=np.int32)
+        for (n, v) in enumerate(values):
+            codes[n] = PendingDay._code(v, dictionary, index)
+        return codes
+
+    def _merge(self, partition: str, day: PendingDay):
+        path = os.path.join(self.directory, partition)
+        if os.path.exists(path):
+            old = self.read(partition)
+            devices = old['devices'].tolist()
+            items = list(zip(old['study_programs'].tolist(), old['course_ids'].tolist()))
+            device, item, timestamp = old['device'], old['item'], old['timestamp']
+        else:
+            devices, items = [], []
+            device, item, timestamp = np.empty(0, np.int32), np.empty(0, np.int32), np.empty(0)
+        new_device = self._encode(day.devices, devices)[np.frombuffer(day.device, dtype=np.int32)]
+        new_item = self._encode(day.items, items)[np.frombuffer(day.item, dtype=np.int32)]
+        device = np.concatenate([device, new_device])
+        item = np.concatenate([item, new_item])
+        timestamp = np.concatenate([timestamp, np.frombuffer(day.timestamp, dtype=np.float64)])
+        order = np.lexsort((item, device, -timestamp))
+        device, item, timestamp = device[order], item[order], timestamp[order]
+        keep = np.ones(len(order), dtype=bool)
+        keep[1:] = (device[1:] != device[:-1]) | (item[1:] != item[:-1]) | (timestamp[1:] != timestamp[:-1])
+        columns = {
+            'device': device[keep],
+            'item': item[keep],
+            'timestamp': timestamp[keep],
+            'devices': np.array(devices, dtype=str),
+            'study_programs': np.array([p for (p, _) in items], dtype=str),
+            'course_ids': np.array([c for (_, c) in items], dtype=str),
+        }
+        # Write a complete partition next to the old one and swap, so readers never see half of it.
+        # A crash between the renames is recovered when the log is opened again.
+        tmp = path + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for (c, arr) in columns.items():
+            np.save(os.path.join(tmp, c + '.npy'), arr)
+        if os.path.exists(path):
+            old_path = path + '.old'
+            shutil.rmtree(old_path, ignore_errors=True)
+            os.rename(path, old_path)
+            os.rename(tmp, path)
+            shutil.rmtree(old_path)
+        else:
+            os.rename(tmp, path)
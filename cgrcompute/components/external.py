@@ -4,10 +4,32 @@ from logging import getLogger
 import json
 from cgrcompute.components.config import get_config
 import typing
+from datetime import datetime, timezone
+from queue import Queue, Full
+import threading
+import pymongo
 from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+from cgrcompute.components.lrucache import LRUCache, MISSING
 from opensearchpy import OpenSearch
 
 
+def parse_timestamp(value) -> typing.Optional[float]:
+    # Event timestamps are epoch numbers or ISO-like strings (e.g. "2022-11-05 10:12:13.456"), UTC if no zone.
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return value / 1000 if value > 1e11 else float(value)
+    d = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if d.tzinfo is None:
+        d = d.replace(tzinfo=timezone.utc)
+    return d.timestamp()
+
+
+USER_ADD_COURSE_SOURCES = [('short_message', 'cgr-clientlogging'), ('message', 'cgr-legacy')]
+USER_ADD_COURSE_FIELDS = ['a_studyProgram', 'a_courseNo', 'device_id', 'timestamp']
+
+
 class ElasticService:
 
     def __init__(self):
@@ -20,10 +42,14 @@ class ElasticService:
             verify_certs=False,
             ssl_show_warn=False,
         )
+        self.page_size = int(cfg.get('page_size', 1000))
+        self.parallel = int(cfg.get('parallel', 1))
 
-    def find_all_user_add_course(self):
-        query1 = {
-            'size': 1000,
+    @staticmethod
+    def user_add_course_query(field, since=None, size=1000):
+        query = {
+            'size': size,
+            '_source': USER_ADD_COURSE_FIELDS,
             'sort': {
                 'timestamp': {
                     "order": "desc"
@@ -31,38 +57,92 @@ class ElasticService:
             },
             "query": {
                 "match_phrase": {
-                    "short_message": "user add course"
+                    field: "user add course"
                 }
             }
         }
-        query2 = {
-            'size': 1000,
-            'sort': {
-                'timestamp': {
-                    "order": "desc"
-                }
-            },
-            "query": {
-                "match_phrase": {
-                    "message": "user add course"
+        if since is not None:
+            query['query'] = {
+                'bool': {
+                    'must': [query['query']],
+                    'filter': [{'range': {'timestamp': {'gte': int(since * 1000), 'format': 'epoch_millis'}}}]
                 }
             }
-        }
-        for e in self.find_scrolling(query1, "cgr-clientlogging"):
-            s = e['_source']
-            yield {'study_program': s['a_studyProgram'], 'course_id': s['a_courseNo'], 'device_id': s['device_id'], 'raw': e}
-        for e in self.find_scrolling(query2, "cgr-legacy"):
-            s = e['_source']
-            yield {'study_program': s['a_studyProgram'], 'course_id': s['a_courseNo'], 'device_id': s['device_id'], 'raw': e}
+        return query
+
+    def find_all_user_add_course(self, since=None):
+        # since: only events at or after this unix time (seconds)
+        # Every index is read with `parallel` sliced scrolls at once, so events arrive roughly but not
+        # strictly newest first.
+        jobs = []
+        for (field, index) in USER_ADD_COURSE_SOURCES:
+            for i in range(self.parallel):
+                query = self.user_add_course_query(field, since, self.page_size)
+                if self.parallel > 1:
+                    query['slice'] = {'id': i, 'max': self.parallel}
+                jobs.append((query, index))
+        for page in self.find_scrolling_parallel(jobs):
+            for e in page:
+                s = e['_source']
+                yield {'study_program': s['a_studyProgram'], 'course_id': s['a_courseNo'], 'device_id': s['device_id'], 'timestamp': s.get('timestamp')}
 
     def find_scrolling(self, query, index):
+        for page in self.find_scrolling_pages(query, index):
+            for hit in page:
+                yield hit
+
+    def find_scrolling_pages(self, query, index):
         res = self.client.search(index=index, body=query, params={'scroll': '10m'})
         scroll_id = res['_scroll_id']
-        while len(res['hits']['hits']) > 0:
-            for hit in res['hits']['hits']:
-                yield hit
-            res = self.client.scroll(scroll_id=scroll_id, scroll='10m')
-        self.client.clear_scroll(scroll_id=scroll_id)
+        try:
+            while len(res['hits']['hits']) > 0:
+                yield res['hits']['hits']
+                res = self.client.scroll(scroll_id=scroll_id, scroll='10m')
+        finally:
+            self.client.clear_scroll(scroll_id=scroll_id)
+
+    def find_scrolling_parallel(self, jobs):
+        # Runs each (query, index) scroll in its own thread and yields their pages as they arrive.
+        # Closing the generator early stops the threads and clears their scrolls.
+        pages = Queue(maxsize=2 * len(jobs))
+        stop = threading.Event()
+
+        def put(e):
+            while not stop.is_set():
+                try:
+                    pages.put(e, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def run(query, index):
+            scroll = self.find_scrolling_pages(query, index)
+            try:
+                for page in scroll:
+                    if not put(page):
+                        return
+            except Exception as e:
+                put(e)
+            finally:
+                # Clears the scroll now rather than whenever the generator is collected
+                scroll.close()
+                put(None)
+
+        for (query, index) in jobs:
+            threading.Thread(target=run, args=(query, index), daemon=True).start()
+        running = len(jobs)
+        try:
+            while running > 0:
+                page = pages.get()
+                if page is None:
+                    running -= 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    yield page
+        finally:
+            stop.set()
 
 
 class MongoService:
@@ -72,6 +152,20 @@ class MongoService:
         url = cfg['url']
         dbname = cfg['database']
         self.db = MongoClient(url)[dbname]
+        ttl = float(cfg.get('abbr_cache_ttl', 3600))
+        # (course_no, study_program, semester, academic_year) -> abbrName, or None if the course is not offered
+        self.abbr_cache = LRUCache(maxsize=int(cfg.get('abbr_cache_size', 65536)), ttl=ttl)
+        # Semesters whose whole course table is in abbr_cache, so a cache miss means "not offered"
+        self.preload = str(cfg.get('abbr_preload', 'false')).lower() in ('1', 'true', 'yes', 'on')
+        self.preloaded = LRUCache(maxsize=256, ttl=ttl)
+
+    def ping(self, timeout: float = 2) -> bool:
+        try:
+            with pymongo.timeout(timeout):
+                self.db.command('ping')
+        except PyMongoError:
+            return False
+        return True
 
     def get_course_abbr(self, course_no, semester, study_program, academic_year):
         c = self.db['courses'].find_one({
@@ -85,6 +179,68 @@ class MongoService:
         else:
             return None
 
+    def preload_course_abbrs(self, semester, study_program, academic_year):
+        found = dict()
+        for c in self.db['courses'].find({
+                'semester': semester,
+                'studyProgram': study_program,
+                'academicYear': academic_year
+            }, {'courseNo': 1, 'abbrName': 1}):
+            found[c['courseNo']] = c['abbrName']
+            self.abbr_cache.put((c['courseNo'], study_program, semester, academic_year), c['abbrName'])
+        self.preloaded.put((study_program, semester, academic_year), found)
+        return found
+
+    def get_semester_courses(self, semester, study_program, academic_year) -> dict[str, str]:
+        # courseNo -> abbrName of every course offered in the semester, loaded once per abbr_cache_ttl
+        found = self.preloaded.get((study_program, semester, academic_year))
+        if found is MISSING:
+            found = self.preload_course_abbrs(semester, study_program, academic_year)
+        return found
+
+    def get_recent_semesters(self, n: int) -> list[tuple[str, str]]:
+        # (academic_year, semester) of the n latest semesters that have courses, newest first
+        return [(d['_id']['academicYear'], d['_id']['semester']) for d in self.db['courses'].aggregate([
+                {'$group': {'_id': {'academicYear': '$academicYear', 'semester': '$semester'}}},
+                {'$sort': {'_id.academicYear': -1, '_id.semester': -1}},
+                {'$limit': n},
+            ])]
+
+    def cached_course_abbrs(self, course_nos, semester, study_program, academic_year) -> dict[str, typing.Optional[str]]:
+        # The names of course_nos this process already knows, without a query
+        res = dict()
+        for course_no in course_nos:
+            abbr = self.abbr_cache.get((course_no, study_program, semester, academic_year))
+            if abbr is not MISSING:
+                res[course_no] = abbr
+        return res
+
+    def get_course_abbrs(self, course_nos, semester, study_program, academic_year) -> dict[str, typing.Optional[str]]:
+        # One $in query for every course that is not cached yet. Courses that are not offered map to None.
+        res = dict()
+        missing = []
+        for course_no in course_nos:
+            abbr = self.abbr_cache.get((course_no, study_program, semester, academic_year))
+            if abbr is MISSING:
+                missing.append(course_no)
+            else:
+                res[course_no] = abbr
+        if not missing:
+            return res
+        if self.preload:
+            found = self.get_semester_courses(semester, study_program, academic_year)
+        else:
+            found = dict((c['courseNo'], c['abbrName']) for c in self.db['courses'].find({
+                    'courseNo': {'$in': missing},
+                    'semester': semester,
+                    'studyProgram': study_program,
+                    'academicYear': academic_year
+                }, {'courseNo': 1, 'abbrName': 1}))
+        for course_no in missing:
+            res[course_no] = found.get(course_no)
+            self.abbr_cache.put((course_no, study_program, semester, academic_year), res[course_no])
+        return res
+
 def get_mongo_service():
     global mongosrv
     try:
@@ -1,67 +1,132 @@
 import grpc
-from concurrent.futures import ProcessPoolExecutor, BrokenExecutor
 from logging import getLogger
+from typing import Callable, Optional
 import threading
+import time
 
 from cgrcompute.grpc import health_pb2_grpc, health_pb2
 
-class HealthServicer(health_pb2_grpc.HealthServicer):
+# A check returns whether its component is healthy and a short description for the log
+Check = Callable[[], tuple[bool, str]]
 
-    def __init__(self, pool: ProcessPoolExecutor):
-        self.pool = pool
-        self.logger = getLogger("HealthServicer")
 
-    @staticmethod
-    def ping() -> str:
-        return "pong"
+class HealthMonitor:
+    # Status of the server's components, kept up to date by a background thread that runs each check
+    # every `interval` seconds (its own interval if given). A service is SERVING while all of its
+    # components are healthy; components that were not checked yet count as unhealthy. Readers get
+    # the last status without probing anything, and wait() wakes them as soon as a status changes.
+
+    def __init__(self, interval: float = 1):
+        self.interval = interval
+        self.logger = getLogger('HealthMonitor')
+        self.checks = dict()
+        self.services = dict()
+        self.components = dict()
+        self.version = 0
+        self._due = dict()
+        self._changed = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_check(self, name: str, check: Check, interval: float = None):
+        self.checks[name] = (check, interval or self.interval)
+        self._due[name] = 0
+        # Every component can be watched on its own too
+        self.services.setdefault(name, [name])
+
+    def add_service(self, name: str, components: list[str]):
+        self.services[name] = components
+
+    def status(self, service: str) -> Optional[bool]:
+        # None if the service is unknown
+        components = self.services.get(service)
+        if components is None:
+            return None
+        return all(self.components.get(c, (False, ''))[0] for c in components)
+
+    def refresh(self):
+        # Runs the checks that are due
+        now = time.monotonic()
+        for (name, (check, interval)) in self.checks.items():
+            if self._due[name] > now:
+                continue
+            self._due[name] = now + interval
+            try:
+                res = check()
+            except Exception as e:
+                self.logger.exception('Health check {} failed'.format(name))
+                res = (False, 'check failed: {}'.format(e))
+            old = self.components.get(name)
+            if old is not None and old[0] == res[0]:
+                self.components[name] = res
+                continue
+            self.logger.info('{} is {}: {}'.format(name, 'healthy' if res[0] else 'unhealthy', res[1]))
+            with self._changed:
+                self.components[name] = res
+                self.version += 1
+                self._changed.notify_all()
+
+    def wait(self, version: int, stop: threading.Event) -> int:
+        # Blocks until the status changed after `version` or stop is set, and returns the new version
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version or stop.is_set())
+            return self.version
+
+    def wake(self):
+        with self._changed:
+            self._changed.notify_all()
+
+    def _run(self):
+        while True:
+            self.refresh()
+            if self._stop.wait(max(min(self._due.values(), default=0) - time.monotonic(), 0.01)):
+                return
 
-    def _check_pool(self) -> bool:
-        # Pool can sometimes crash. probably due to OOM killing. So we must check that.
-        try:
-            task = self.pool.submit(HealthServicer.ping)
-            assert task.result() == "pong"
-            return True
-        except BrokenExecutor:
-            return False
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='HealthMonitor', daemon=True)
+        self._thread.start()
 
-    def _check_all(self) -> bool:
-        return self._check_pool()
+    def stop(self):
+        self._stop.set()
+
+
+def serving_status(ok: bool) -> int:
+    return health_pb2.HealthCheckResponse.ServingStatus.SERVING if ok else health_pb2.HealthCheckResponse.ServingStatus.NOT_SERVING
+
+
+class HealthServicer(health_pb2_grpc.HealthServicer):
+    # Answers from the status HealthMonitor keeps, so probes never wait behind requests
+
+    def __init__(self, monitor: HealthMonitor):
+        self.monitor = monitor
+        self.logger = getLogger("HealthServicer")
 
     def Check(self, request, context: grpc.ServicerContext):
-        if request.service == "":
-            ok = self._check_all()
-            self.logger.info(f"check with status: {ok}")
-            return health_pb2.HealthCheckResponse(
-                status=health_pb2.HealthCheckResponse.ServingStatus.SERVING if ok else health_pb2.HealthCheckResponse.ServingStatus.NOT_SERVING
-            )
-        else:
+        ok = self.monitor.status(request.service)
+        if ok is None:
             context.set_code(grpc.StatusCode.NOT_FOUND)
             return health_pb2.HealthCheckResponse()
+        return health_pb2.HealthCheckResponse(status=serving_status(ok))
 
     def Watch(self, request, context: grpc.ServicerContext):
-        if request.service != "":
+        if self.monitor.status(request.service) is None:
             yield health_pb2.HealthCheckResponse(
                 status=health_pb2.HealthCheckResponse.ServingStatus.SERVICE_UNKNOWN,
             )
             return
         self.logger.info("starting watch")
-        closed_condition = threading.Condition()
+        closed = threading.Event()
         def on_close():
-            with closed_condition:
-                closed_condition.notify()
+            closed.set()
+            self.monitor.wake()
         context.add_callback(on_close)
 
         prv_status = None
-        with closed_condition:
-            while not closed_condition.wait(timeout=1):
-                status = self._check_all()
-                if status == prv_status:
-                    continue
-                self.logger.info(f"Service status changed {prv_status} -> {status}")
-                yield health_pb2.HealthCheckResponse(
-                    status=health_pb2.HealthCheckResponse.ServingStatus.SERVING if status else health_pb2.HealthCheckResponse.ServingStatus.NOT_SERVING
-                )
+        version = self.monitor.version
+        while not closed.is_set():
+            status = self.monitor.status(request.service)
+            if status != prv_status:
+                yield health_pb2.HealthCheckResponse(status=serving_status(status))
                 prv_status = status
+            version = self.monitor.wait(version, closed)
         self.logger.info("end watch")
-
-
@@ -0,0 +1,49 @@
+from multiprocessing import Lock
+from multiprocessing.sharedctypes import RawArray
+from logging import getLogger
+import os
+import threading
+import time
+
+
+class WorkerHeartbeats:
+    # Liveness of worker processes through shared memory, so nobody has to send them a task to find
+    # out. A worker claims a slot when it starts and a daemon thread writes the time into it every
+    # `interval` seconds; the thread keeps beating while the worker is busy with requests and stops
+    # with the process, e.g. when it is OOM killed. A slot that has not been written for `timeout`
+    # seconds is free again. Must be created before the workers are forked.
+
+    def __init__(self, slots: int, interval: float = 1, timeout: float = 10):
+        self.interval = interval
+        self.timeout = timeout
+        self._pids = RawArray('i', slots)
+        self._beats = RawArray('d', slots)
+        self._lock = Lock()
+
+    def start(self):
+        # Called in the worker process
+        now = time.time()
+        with self._lock:
+            for slot in range(len(self._pids)):
+                if now - self._beats[slot] > self.timeout:
+                    self._pids[slot] = os.getpid()
+                    self._beats[slot] = now
+                    break
+            else:
+                getLogger('WorkerHeartbeats').warning('No heartbeat slot left for worker {}'.format(os.getpid()))
+                return
+        threading.Thread(target=self._beat, args=(slot, ), name='WorkerHeartbeat', daemon=True).start()
+
+    def _beat(self, slot: int):
+        pid = os.getpid()
+        while True:
+            time.sleep(self.interval)
+            if self._pids[slot] != pid:
+                # Stalled for longer than the timeout and the slot went to a new worker
+                return
+            self._beats[slot] = time.time()
+
+    def alive(self) -> list[int]:
+        # pids of the workers that beat within the timeout
+        now = time.time()
+        return [self._pids[slot] for slot in range(len(self._pids)) if now - self._beats[slot] <= self.timeout]
@@ -0,0 +1,48 @@
+from collections import OrderedDict
+from typing import Any, Hashable
+import threading
+import time
+
+MISSING = object()
+
+
+class LRUCache:
+    # Thread-safe LRU cache whose entries also expire `ttl` seconds after they were written.
+
+    def __init__(self, maxsize: int = 4096, ttl: float = 3600, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = MISSING) -> Any:
+        with self._lock:
+            try:
+                expire, val = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expire < self.clock():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return val
+
+    def put(self, key: Hashable, val: Any):
+        with self._lock:
+            self._data[key] = (self.clock() + self.ttl, val)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,377 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import getLogger
+from typing import Callable, Collection, Iterator, Optional
+import mmap
+import os
+import struct
+import threading
+import time
+
+# Processes that see this variable write their metrics to <dir>/<pid>.metrics, and collect() sums the
+# files of every process. It is set before the worker pools start, so their processes inherit it.
+METRICS_DIR_ENV = 'CGRCOMPUTE_METRICS_DIR'
+# Values of processes that exited, folded together by the collecting process
+AGGREGATE_FILE = 'aggregate.metrics'
+
+MAPPED_USED = struct.Struct('<Q')
+MAPPED_KEY = struct.Struct('<I')
+MAPPED_VALUE = struct.Struct('<dd')  # value, time of the last write
+MAPPED_INITIAL_SIZE = 64 * 1024
+
+
+def _padded(n: int) -> int:
+    return (n + 7) // 8 * 8
+
+
+class MappedValues:
+    # Append-only key -> (value, timestamp) store in a memory-mapped file with a single writing
+    # process. A new entry is written completely before the used size in the header covers it,
+    # so readers in other processes never see half an entry.
+
+    def __init__(self, path: str):
+        self.path = path
+        self.positions = dict()
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(MAPPED_USED.pack(MAPPED_USED.size))
+                f.truncate(MAPPED_INITIAL_SIZE)
+        self._map()
+        for (key, pos, _, _) in self._entries(self.mm):
+            self.positions[key] = pos
+
+    def _map(self):
+        with open(self.path, 'r+b') as f:
+            self.mm = mmap.mmap(f.fileno(), 0)
+
+    @staticmethod
+    def _entries(mm) -> Iterator[tuple[str, int, float, float]]:
+        used = MAPPED_USED.unpack_from(mm, 0)[0]
+        pos = MAPPED_USED.size
+        while pos < used:
+            n = MAPPED_KEY.unpack_from(mm, pos)[0]
+            key = mm[pos + MAPPED_KEY.size:pos + MAPPED_KEY.size + n].decode()
+            pos = _padded(pos + MAPPED_KEY.size + n)
+            value, ts = MAPPED_VALUE.unpack_from(mm, pos)
+            yield key, pos, value, ts
+            pos += MAPPED_VALUE.size
+
+    def _position(self, key: str) -> int:
+        pos = self.positions.get(key)
+        if pos is not None:
+            return pos
+        encoded = key.encode()
+        used = MAPPED_USED.unpack_from(self.mm, 0)[0]
+        pos = _padded(used + MAPPED_KEY.size + len(encoded))
+        end = pos + MAPPED_VALUE.size
+        if end > len(self.mm):
+            self.mm.close()
+            with open(self.path, 'r+b') as f:
+                f.truncate(max(2 * os.path.getsize(self.path), end))
+            self._map()
+        MAPPED_KEY.pack_into(self.mm, used, len(encoded))
+        self.mm[used + MAPPED_KEY.size:used + MAPPED_KEY.size + len(encoded)] = encoded
+        MAPPED_VALUE.pack_into(self.mm, pos, 0.0, 0.0)
+        MAPPED_USED.pack_into(self.mm, 0, end)
+        self.positions[key] = pos
+        return pos
+
+    def get(self, key: str) -> tuple[float, float]:
+        pos = self.positions.get(key)
+        return MAPPED_VALUE.unpack_from(self.mm, pos) if pos is not None else (0.0, 0.0)
+
+    def set(self, key: str, value: float):
+        MAPPED_VALUE.pack_into(self.mm, self._position(key), value, time.time())
+
+    def add(self, key: str, amount: float):
+        pos = self._position(key)
+        MAPPED_VALUE.pack_into(self.mm, pos, MAPPED_VALUE.unpack_from(self.mm, pos)[0] + amount, time.time())
+
+    def put(self, key: str, value: float, ts: float):
+        MAPPED_VALUE.pack_into(self.mm, self._position(key), value, ts)
+
+    @staticmethod
+    def read(path: str) -> dict[str, tuple[float, float]]:
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return dict((key, (value, ts)) for (key, _, value, ts) in MappedValues._entries(mm))
+        finally:
+            mm.close()
+
+
+class LocalValues:
+    # Process-local stand-in for MappedValues when no metrics directory is configured
+
+    def __init__(self):
+        self.values = dict()
+
+    def get(self, key: str) -> tuple[float, float]:
+        return self.values.get(key, (0.0, 0.0))
+
+    def set(self, key: str, value: float):
+        self.values[key] = (value, time.time())
+
+    def add(self, key: str, amount: float):
+        self.values[key] = (self.values.get(key, (0.0, 0.0))[0] + amount, time.time())
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _merge(prev: Optional[tuple[float, float]], value: float, ts: float, gauge: bool) -> tuple[float, float]:
+    # Sums, except gauges, which take the most recently written value
+    if prev is None:
+        return (value, ts)
+    if gauge:
+        return (value, ts) if ts >= prev[1] else prev
+    return (prev[0] + value, max(ts, prev[1]))
+
+
+def _labels(pairs) -> str:
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for (k, v) in pairs) + '}'
+
+
+def _format(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+        self._lock = threading.Lock()
+        self._values = None
+        self._aggregate = None
+        self._pid = None
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def values(self):
+        # Reopened after a fork, so a child never writes into its parent's file
+        if self._pid != os.getpid():
+            directory = os.environ.get(METRICS_DIR_ENV)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+                self._values = MappedValues(os.path.join(directory, '{}.metrics'.format(os.getpid())))
+            else:
+                self._values = LocalValues()
+            self._aggregate = None
+            self._pid = os.getpid()
+        return self._values
+
+    def set(self, key: str, value: float):
+        with self._lock:
+            self.values().set(key, value)
+
+    def add(self, key: str, amount: float):
+        with self._lock:
+            self.values().add(key, amount)
+
+    def add_many(self, items: list[tuple[str, float]]):
+        with self._lock:
+            values = self.values()
+            for (key, amount) in items:
+                values.add(key, amount)
+
+    def _fold_exited(self, directory: str, gauges: Collection[str]):
+        # The files of processes that exited, e.g. recycled workers, are added into the aggregate file
+        # and removed, so the directory does not grow with every worker the server ever started
+        for name in os.listdir(directory):
+            pid = name[:-len('.metrics')]
+            if not name.endswith('.metrics') or not pid.isdigit() or _alive(int(pid)):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                values = MappedValues.read(path)
+            except (OSError, ValueError, struct.error):
+                values = dict()
+            if self._aggregate is None:
+                self._aggregate = MappedValues(os.path.join(directory, AGGREGATE_FILE))
+            for (key, (value, ts)) in values.items():
+                prev = self._aggregate.get(key) if key in self._aggregate.positions else None
+                self._aggregate.put(key, *_merge(prev, value, ts, key.split('{')[0] in gauges))
+            os.unlink(path)
+
+    def collect(self) -> dict[str, tuple[float, float]]:
+        # Sums of every process, except gauges, which take the most recently written value
+        directory = os.environ.get(METRICS_DIR_ENV)
+        with self._lock:
+            local = self.values()
+            if not directory:
+                return dict(local.values)
+            gauges = set(m.name for m in self.metrics if m.kind == 'gauge')
+            self._fold_exited(directory, gauges)
+        res = dict()
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.metrics'):
+                continue
+            try:
+                values = MappedValues.read(os.path.join(directory, name))
+            except (OSError, ValueError, struct.error):
+                continue
+            for (key, (value, ts)) in values.items():
+                res[key] = _merge(res.get(key), value, ts, key.split('{')[0] in gauges)
+        return res
+
+    def render(self) -> str:
+        for m in self.metrics:
+            m.update()
+        values = self.collect()
+        lines = []
+        for m in self.metrics:
+            lines.append('# HELP {} {}'.format(m.name, m.help))
+            lines.append('# TYPE {} {}'.format(m.name, m.kind))
+            for (key, value) in m.samples(values):
+                lines.append('{} {}'.format(key, _format(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    kind = ''
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (), registry: Registry = REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.registry = registry
+        registry.register(self)
+
+    def _pairs(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError('{} takes labels {}'.format(self.name, self.labelnames))
+        return tuple((n, labels[n]) for n in self.labelnames)
+
+    def update(self):
+        pass
+
+    def samples(self, values: dict) -> list[tuple[str, float]]:
+        prefix = self.name + '{'
+        return sorted((k, v) for (k, (v, _)) in values.items() if k == self.name or k.startswith(prefix))
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        self.registry.add(self.name + _labels(self._pairs(labels)), amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._function = None
+
+    def set(self, value: float, **labels):
+        self.registry.set(self.name + _labels(self._pairs(labels)), value)
+
+    def set_function(self, fn: Callable[[], float]):
+        # Evaluated by the process that renders the metrics
+        self._function = fn
+
+    def update(self):
+        if self._function is not None:
+            self.set(self._function())
+
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, *args, buckets: tuple[float, ...] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'), )
+        self._keys = dict()
+
+    def observe(self, value: float, **labels):
+        pairs = self._pairs(labels)
+        keys = self._keys.get(pairs)
+        if keys is None:
+            keys = self._keys[pairs] = (
+                [self.name + '_bucket' + _labels(pairs + (('le', _format(le)), )) for le in self.buckets],
+                self.name + '_sum' + _labels(pairs),
+                self.name + '_count' + _labels(pairs))
+        buckets, sum_key, count_key = keys
+        # Only the bucket the value falls in is counted here; samples() makes them cumulative
+        self.registry.add_many([(buckets[bisect_left(self.buckets, value)], 1), (sum_key, value), (count_key, 1)])
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self, values: dict) -> list[tuple[str, float]]:
+        res = []
+        count = self.name + '_count'
+        label_sets = sorted(k[len(count):] for k in values if k.split('{')[0] == count)
+        for labelstr in label_sets:
+            pairs = labelstr[1:-1].split(',') if labelstr else []
+            total = 0
+            for le in self.buckets:
+                key = self.name + '_bucket{' + ','.join(pairs + ['le="{}"'.format(_format(le))]) + '}'
+                total += values.get(key, (0.0, 0.0))[0]
+                res.append((key, total))
+            res.append((self.name + '_sum' + labelstr, values[self.name + '_sum' + labelstr][0]))
+            res.append((count + labelstr, values[count + labelstr][0]))
+        return res
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int, host: str = '') -> ThreadingHTTPServer:
+    httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=httpd.serve_forever, name='MetricsServer', daemon=True).start()
+    getLogger('start_metrics_server').info('Serving metrics at :{}/metrics'.format(httpd.server_address[1]))
+    return httpd
+
+
+REQUEST_STAGE_SECONDS = Histogram('cgrcompute_request_stage_seconds',
+    'Time spent in each stage of a recommendation request', ('stage', ))
+RPC_SECONDS = Histogram('cgrcompute_rpc_seconds', 'Time to handle a gRPC call', ('method', ))
+TRAINING_DOWNLOAD_RATE = Gauge('cgrcompute_training_download_events_per_second', 'Events read per second by the last training run')
+TRAINING_OBSERVATIONS = Gauge('cgrcompute_training_observations', 'Qualified baskets behind the last trained model')
+TRAINING_DURATION = Gauge('cgrcompute_training_duration_seconds', 'Duration of the last model training, excluding the download')
+MODEL_SIZE = Gauge('cgrcompute_model_size_bytes', 'Array size of the last trained model')
+MODEL_VERSION = Gauge('cgrcompute_model_version', 'Generation of the published models; changes on every publish')
+POOL_RESTARTS = Counter('cgrcompute_pool_restarts_total', 'Process pools restarted after a worker died', ('pool', ))
+REQUESTS_SHED = Counter('cgrcompute_requests_shed_total', 'Requests rejected, dropped or answered without names from Mongo under load', ('reason', ))
+POOL_RECYCLES = Counter('cgrcompute_pool_recycles_total', 'Process pools replaced before their workers grew too large', ('pool', 'reason'))
@@ -1,7 +1,72 @@
 from multiprocessing import Manager
 from threading import Semaphore
 from typing import Any, Callable
+from urllib.parse import quote
+import mmap
+import os
 import pickle
+import shutil
+import struct
+import tempfile
+import uuid
+
+# Worker processes receive a fresh unpickled cache object with every task, so the
+# local copies are kept per process here instead of on the instance.
+_local_caches: dict[str, dict] = dict()
+_generation_maps: dict[str, mmap.mmap] = dict()
+
+MAPPED_MAGIC = b'CGRMAP01'
+MAPPED_HEADER = struct.Struct('<8sQQ')  # magic, payload length, buffer count
+MAPPED_BUFFER = struct.Struct('<QQ')    # offset, length
+MAPPED_ALIGN = 64
+GENERATION = struct.Struct('<Q')
+_MISSING = object()
+
+
+def _align(n: int) -> int:
+    return (n + MAPPED_ALIGN - 1) // MAPPED_ALIGN * MAPPED_ALIGN
+
+
+def dump_mapped(val: Any, path: str):
+    # Pickle protocol 5 hands contiguous numpy arrays to buffer_callback instead of copying them
+    # into the payload. They are written 64-byte aligned after it so load_mapped can map them back.
+    buffers = []
+    payload = pickle.dumps(val, protocol=5, buffer_callback=buffers.append)
+    raws = [b.raw() for b in buffers]
+    offset = _align(MAPPED_HEADER.size + MAPPED_BUFFER.size * len(raws) + len(payload))
+    table = []
+    for r in raws:
+        table.append((offset, r.nbytes))
+        offset = _align(offset + r.nbytes)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(MAPPED_HEADER.pack(MAPPED_MAGIC, len(payload), len(raws)))
+        for e in table:
+            f.write(MAPPED_BUFFER.pack(*e))
+        f.write(payload)
+        for ((o, _), r) in zip(table, raws):
+            f.seek(o)
+            f.write(r)
+        f.truncate(offset)
+    os.replace(tmp, path)
+
+
+def load_mapped(path: str) -> Any:
+    # Arrays in the result are read-only views over the mapping; nothing is copied.
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(mm) < MAPPED_HEADER.size:
+        raise ValueError('{} is truncated'.format(path))
+    magic, payload_len, nbuf = MAPPED_HEADER.unpack_from(mm, 0)
+    if magic != MAPPED_MAGIC:
+        raise ValueError('{} is not a mapped cache file'.format(path))
+    table = [MAPPED_BUFFER.unpack_from(mm, MAPPED_HEADER.size + MAPPED_BUFFER.size * i) for i in range(nbuf)]
+    start = MAPPED_HEADER.size + MAPPED_BUFFER.size * nbuf
+    if any(o + l > len(mm) for (o, l) in table) or start + payload_len > len(mm):
+        raise ValueError('{} is truncated'.format(path))
+    view = memoryview(mm)
+    return pickle.loads(view[start:start + payload_len], buffers=[view[o:o + l] for (o, l) in table])
+
 
 class SharableCache:
     cache_miss_lock : Semaphore
@@ -10,16 +75,32 @@ class SharableCache:
     local_cache : dict[str, tuple[int, Any]]
 
     def __init__(self, manager: Manager):
+        self.cache_id = uuid.uuid4().hex
         self.cache_miss_lock = manager.Semaphore()
         self.shared_cache = manager.dict()
         self.shared_cache_version = manager.dict()
-        self.local_cache = dict()
+        self.local_cache = _local_caches.setdefault(self.cache_id, dict())
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['local_cache']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local_cache = _local_caches.setdefault(self.cache_id, dict())
 
     def get(self, key: str):
-        if key in self.local_cache and self.local_cache[key][0] == self.shared_cache_version[key]:
+        # A KeyError raised through a manager proxy keeps the proxy alive in a reference cycle. When it
+        # is collected later its finalizer can close the connection another call is using, so missing
+        # keys are looked up with .get() and the KeyError is raised locally.
+        version = self.shared_cache_version.get(key)
+        if version is None:
+            raise KeyError(key)
+        if key in self.local_cache and self.local_cache[key][0] == version:
             return self.local_cache[key][1]
         else:
-            self.local_cache[key] = (self.shared_cache_version[key], pickle.loads(self.shared_cache[key]))
+            self.local_cache[key] = (version, pickle.loads(self.shared_cache[key]))
             return self.local_cache[key][1]
 
     def get_or_create(self, key: str, initfn: Callable[[], Any]):
@@ -32,12 +113,85 @@ class SharableCache:
                     self.update(key, initfn())
                 return self.get(key)
             finally:
-                self.cache_miss_lock.release() 
+                self.cache_miss_lock.release()
 
     def update(self, key: str, val: Any):
-        try:
-            v = self.shared_cache_version[key]
-        except KeyError:
-            v = 0
+        v = self.shared_cache_version.get(key, 0)
         self.shared_cache_version[key] = v+1
         self.shared_cache[key] = pickle.dumps(val)
+
+
+class MappedSharableCache(SharableCache):
+    # Values are written once to memory-mapped files (on tmpfs by default) and every process maps
+    # them read-only, so numpy arrays inside a value are shared instead of copied per worker.
+    # A generation counter in a mapped control file is bumped on every update; while it is
+    # unchanged, get() is served from the local cache without touching the manager.
+    shared_cache : dict[str, tuple[int, str]]
+    local_cache : dict[str, tuple[int, int, Any]]
+
+    def __init__(self, manager: Manager, directory: str = None):
+        super().__init__(manager)
+        self.update_lock = manager.Lock()
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix='cgrcompute-', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        else:
+            os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        with open(os.path.join(directory, 'generation'), 'wb') as f:
+            f.write(GENERATION.pack(0))
+
+    def _generation_map(self) -> mmap.mmap:
+        try:
+            return _generation_maps[self.directory]
+        except KeyError:
+            with open(os.path.join(self.directory, 'generation'), 'r+b') as f:
+                _generation_maps[self.directory] = mmap.mmap(f.fileno(), GENERATION.size)
+            return _generation_maps[self.directory]
+
+    def generation(self) -> int:
+        return GENERATION.unpack_from(self._generation_map(), 0)[0]
+
+    def get(self, key: str):
+        generation = self.generation()
+        local = self.local_cache.get(key)
+        if local is not None and local[0] == generation:
+            if local[2] is _MISSING:
+                raise KeyError(key)
+            return local[2]
+        while True:
+            entry = self.shared_cache.get(key)
+            if entry is None:
+                # Misses are remembered until the next update too, so probing optional keys stays cheap
+                self.local_cache[key] = (generation, None, _MISSING)
+                raise KeyError(key)
+            version, path = entry
+            if local is not None and local[1] == version:
+                val = local[2]
+            else:
+                try:
+                    val = load_mapped(path)
+                except FileNotFoundError:
+                    # Replaced by a newer version while we were reading the index. If the index still
+                    # points at the missing file, it was removed from under us and retrying cannot help.
+                    current = self.shared_cache.get(key)
+                    if current is None or current[0] != version:
+                        continue
+                    raise
+            self.local_cache[key] = (generation, version, val)
+            return val
+
+    def update(self, key: str, val: Any):
+        with self.update_lock:
+            version, old = self.shared_cache.get(key, (0, None))
+            path = os.path.join(self.directory, '{}.{}'.format(quote(key, safe=''), version + 1))
+            dump_mapped(val, path)
+            self.shared_cache[key] = (version + 1, path)
+            self.shared_cache_version[key] = version + 1
+            mm = self._generation_map()
+            GENERATION.pack_into(mm, 0, GENERATION.unpack_from(mm, 0)[0] + 1)
+            if old is not None:
+                # Processes still holding the old mapping keep it valid until they drop it
+                os.unlink(old)
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,99 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import normalize
+
+
+def topk_rows(m: csr_matrix, k: int) -> csr_matrix:
+    # Keep the k largest entries of every row. Only rows longer than k need a partition.
+    m = m.tocsr()
+    lengths = np.diff(m.indptr)
+    keep = np.ones(m.nnz, dtype=bool)
+    long = np.flatnonzero(lengths > k)
+    # Rows at most twice k long, like two merged top k rows, are partitioned together in a padded array
+    short = long[lengths[long] <= 2 * k]
+    if len(short):
+        positions = m.indptr[short, None] + np.arange(2 * k)
+        valid = np.arange(2 * k) < lengths[short, None]
+        positions = np.where(valid, positions, 0)
+        values = np.where(valid, m.data[positions], -np.inf)
+        chosen = np.take_along_axis(positions, np.argpartition(values, -k, axis=1)[:, -k:], axis=1)
+        keep[positions[valid]] = False
+        keep[chosen] = True
+    for i in long[lengths[long] > 2 * k]:
+        start, end = m.indptr[i], m.indptr[i + 1]
+        rowkeep = np.zeros(end - start, dtype=bool)
+        rowkeep[np.argpartition(m.data[start:end], -k)[-k:]] = True
+        keep[start:end] = rowkeep
+    indptr = np.zeros(m.shape[0] + 1, dtype=m.indptr.dtype)
+    np.cumsum(np.minimum(lengths, k), out=indptr[1:])
+    return csr_matrix((m.data[keep], m.indices[keep], indptr), shape=m.shape)
+
+
+def exact_neighbours(itemobsv: csr_matrix, k: int) -> csr_matrix:
+    # Top-k cosine neighbours of every row from the full item x item similarity matrix
+    return topk_rows(cosine_similarity(itemobsv, dense_output=False), k)
+
+
+class LSHNeighbours:
+    # Approximate top-k cosine neighbours with random-projection LSH. Each of `tables` tables hashes
+    # an item to the signs of its projections on `bits` random hyperplanes; exact cosine is only
+    # computed between items sharing a bucket in some table, and only the running top k is kept, so
+    # the full similarity matrix is never built. More tables raise recall, more bits make buckets
+    # smaller. Every table also costs a pass over all observations, so it only pays with few tables.
+
+    def __init__(self, bits: int = 2, tables: int = 1, seed: int = 0):
+        self.bits = bits
+        self.tables = tables
+        self.seed = seed
+
+    def __call__(self, itemobsv: csr_matrix, k: int) -> csr_matrix:
+        x = normalize(csr_matrix(itemobsv, dtype=np.float64), norm='l2', axis=1)
+        n, m = x.shape
+        rng = np.random.default_rng(self.seed)
+        weights = np.left_shift(1, np.arange(self.bits, dtype=np.int64))
+        signs = np.asarray(x @ rng.standard_normal((m, self.bits * self.tables))) > 0
+        # Every item is its own nearest neighbour, whichever buckets it falls in
+        norms = np.asarray(x.multiply(x).sum(axis=1)).ravel()
+        found = np.flatnonzero(norms)
+        best = csr_matrix((norms[found], (found, found)), shape=(n, n))
+        for table in range(self.tables):
+            bucket = signs[:, table * self.bits:(table + 1) * self.bits] @ weights
+            # With the items sorted by bucket, every observation column lists the items of one bucket
+            # after the other. Split at bucket changes, the columns become the rows of a groups x items
+            # matrix whose product with itself holds exactly the same-bucket pairs, at O(nnz) whatever
+            # the number of buckets. An item alone in its group only adds to its own similarity.
+            order = np.argsort(bucket, kind='stable')
+            rank = np.empty(n, dtype=np.int64)
+            rank[order] = np.arange(n)
+            xs = x[order].tocsc()
+            rowbucket = bucket[order][xs.indices]
+            split = np.ones(xs.nnz, dtype=bool)
+            split[1:] = rowbucket[1:] != rowbucket[:-1]
+            split[xs.indptr[:-1][np.diff(xs.indptr) > 0]] = True
+            sizes = np.diff(np.append(np.flatnonzero(split), xs.nnz))
+            paired = np.repeat(sizes > 1, sizes)
+            indptr = np.zeros(np.count_nonzero(sizes > 1) + 1, dtype=np.int64)
+            np.cumsum(sizes[sizes > 1], out=indptr[1:])
+            groups = csr_matrix((xs.data[paired], xs.indices[paired], indptr), shape=(len(indptr) - 1, n))
+            sim = (groups.T @ groups).tocsr()[rank]
+            sim.indices = order[sim.indices].astype(sim.indices.dtype)
+            sim.has_sorted_indices = False
+            # A pair found by several tables has the same exact score. Only the running top k is kept,
+            # so the union over the tables never grows towards the full similarity matrix.
+            best = topk_rows(best.maximum(topk_rows(sim, k)), k)
+        return best
+
+
+def recall_at_k(exact: csr_matrix, approx: csr_matrix) -> float:
+    # Fraction of the exact neighbours that the approximate index also returns, averaged over rows
+    n = exact.shape[0]
+    exact, approx = exact.tocsr(), approx.tocsr()
+    lengths = np.diff(exact.indptr)
+    rows = np.repeat(np.arange(n, dtype=np.int64), lengths)
+    approx_keys = np.repeat(np.arange(n, dtype=np.int64), np.diff(approx.indptr)) * n + approx.indices
+    hits = np.bincount(rows, weights=np.isin(rows * n + exact.indices, approx_keys), minlength=n)
+    found = lengths > 0
+    if not found.any():
+        return 1.0
+    return float(np.mean(hits[found] / lengths[found]))
@@ -0,0 +1,218 @@
+from concurrent.futures import Future, ProcessPoolExecutor, BrokenExecutor, InvalidStateError
+from cgrcompute.components.metrics import POOL_RESTARTS, POOL_RECYCLES
+from cgrcompute.components.heartbeat import WorkerHeartbeats
+from logging import getLogger
+from typing import Any, Callable, Optional
+import os
+import threading
+
+
+def anonymous_memory(pid: int) -> Optional[int]:
+    # Private anonymous memory (RssAnon) of a process in bytes, None where /proc is not available.
+    # Pages of the mapped models are shared and file-backed, so they are not counted.
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('RssAnon:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _ready() -> bool:
+    return True
+
+
+def _initialize(heartbeats: WorkerHeartbeats, initializer: Optional[Callable[..., Any]], initargs: tuple):
+    heartbeats.start()
+    if initializer is not None:
+        initializer(*initargs)
+
+
+class SupervisedPool:
+    # A ProcessPoolExecutor that is replaced instead of staying broken. When a worker dies (usually
+    # OOM killed) every task of the pool fails with BrokenExecutor; the pool is then recreated in the
+    # background and those tasks are submitted again, up to `retries` times, so tasks must be
+    # idempotent. Tasks submitted meanwhile wait for the new pool.
+    #
+    # Workers are also recycled before the kernel has to kill them: after max_tasks_per_child tasks
+    # per worker on average, or once a worker holds more than memory_limit bytes of private memory.
+    # A recycled pool is replaced gracefully: the new one takes new tasks once it is started, and
+    # the old one finishes its queued tasks and exits.
+    #
+    # Workers of every new pool are started and run `initializer` (e.g. mapping the current model)
+    # before the pool takes any task. Every worker beats in `heartbeats`, so its liveness can be
+    # checked without submitting anything.
+
+    def __init__(self, max_workers: int = None, initializer: Callable[..., Any] = None, initargs: tuple = (),
+            retries: int = 1, max_tasks_per_child: int = None, memory_limit: int = None, check_interval: float = 10,
+            name: str = 'workers', heartbeat_timeout: float = 10):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.initializer = initializer
+        self.initargs = initargs
+        self.retries = retries
+        self.max_tasks_per_child = max_tasks_per_child
+        self.memory_limit = memory_limit
+        self.check_interval = check_interval
+        self.name = name
+        # The workers of a recycled pool overlap with the new ones for a while
+        self.heartbeats = WorkerHeartbeats(2 * self.max_workers, timeout=heartbeat_timeout)
+        self.logger = getLogger('SupervisedPool')
+        self._lock = threading.Lock()
+        self._parked = []
+        self._replacing = False
+        self._shutdown = False
+        self._tasks = 0
+        self._stop = threading.Event()
+        self._executor = self._start()
+        self._monitor = None
+        if memory_limit:
+            self._monitor = threading.Thread(target=self._check_memory, name='SupervisedPoolMonitor', daemon=True)
+            self._monitor.start()
+
+    def _start(self) -> ProcessPoolExecutor:
+        executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=_initialize,
+            initargs=(self.heartbeats, self.initializer, self.initargs))
+        try:
+            # Fork the workers and run the initializer now instead of on the first tasks
+            for f in [executor.submit(_ready) for _ in range(self.max_workers)]:
+                f.result()
+        except BaseException:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        return executor
+
+    def pids(self) -> list[int]:
+        executor = self._executor
+        # ProcessPoolExecutor has no public way to list its workers
+        processes = getattr(executor, '_processes', None) or dict()
+        return list(processes)
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        outer = Future()
+        self._submit(outer, fn, args, kwargs, self.retries)
+        return outer
+
+    def _submit(self, outer: Future, fn: Callable, args: tuple, kwargs: dict, retries: int):
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+            executor = self._executor
+            if executor is None:
+                self._parked.append((outer, fn, args, kwargs, retries))
+                if not self._replacing:
+                    # The last replacement failed; try again
+                    self._replace_locked(None, 'broken')
+                return
+            self._tasks += 1
+            if self.max_tasks_per_child and self._tasks == self.max_tasks_per_child * self.max_workers:
+                self._replace_locked(executor, 'max_tasks')
+        try:
+            inner = executor.submit(fn, *args, **kwargs)
+        except BrokenExecutor:
+            # Broken before the task was queued, so it does not count as a try
+            self._broken(executor)
+            self._submit(outer, fn, args, kwargs, retries)
+            return
+        except RuntimeError:
+            # Shut down by a graceful replacement in the meantime
+            self._submit(outer, fn, args, kwargs, retries)
+            return
+        # A caller that stops waiting cancels the task if no worker has picked it up yet
+        outer.add_done_callback(lambda f: inner.cancel() if f.cancelled() else None)
+        inner.add_done_callback(lambda f: self._done(outer, f, executor, fn, args, kwargs, retries))
+
+    def _done(self, outer: Future, inner: Future, executor: ProcessPoolExecutor, fn: Callable, args: tuple, kwargs: dict, retries: int):
+        if inner.cancelled():
+            outer.cancel()
+            return
+        if outer.cancelled():
+            return
+        e = inner.exception()
+        if isinstance(e, BrokenExecutor):
+            self._broken(executor)
+            if retries > 0 and not self._shutdown:
+                self.logger.info('Retrying {} on the new pool'.format(getattr(fn, '__name__', fn)))
+                self._submit(outer, fn, args, kwargs, retries - 1)
+                return
+        try:
+            if e is not None:
+                outer.set_exception(e)
+            else:
+                outer.set_result(inner.result())
+        except InvalidStateError:
+            # Cancelled just now
+            pass
+
+    def _broken(self, executor: ProcessPoolExecutor):
+        with self._lock:
+            if self._executor is not executor or self._shutdown:
+                return
+            self.logger.error('Worker pool {} is broken, probably a worker was OOM killed. Starting a new one'.format(self.name))
+            POOL_RESTARTS.inc(pool=self.name)
+            self._executor = None
+            self._replace_locked(executor, 'broken')
+
+    def _replace_locked(self, old: Optional[ProcessPoolExecutor], reason: str):
+        if self._replacing:
+            return
+        self._replacing = True
+        threading.Thread(target=self._replace, args=(old, reason), name='SupervisedPoolReplace', daemon=True).start()
+
+    def _replace(self, old: Optional[ProcessPoolExecutor], reason: str):
+        try:
+            new = self._start()
+        except Exception as e:
+            self.logger.exception('Cannot start a new worker pool {}'.format(self.name))
+            with self._lock:
+                self._replacing = False
+                if reason == 'broken':
+                    parked, self._parked = self._parked, []
+                else:
+                    parked = []
+            for (outer, _, _, _, _) in parked:
+                outer.set_exception(BrokenExecutor('cannot start a new worker pool: {}'.format(e)))
+            return
+        with self._lock:
+            self._replacing = False
+            if self._shutdown:
+                new.shutdown(wait=False)
+                return
+            self._executor = new
+            self._tasks = 0
+            parked, self._parked = self._parked, []
+        if reason != 'broken':
+            POOL_RECYCLES.inc(pool=self.name, reason=reason)
+        self.logger.info('Worker pool {} replaced ({}), resubmitting {} waiting tasks'.format(self.name, reason, len(parked)))
+        if old is not None:
+            # A recycled pool finishes the tasks it already has before its workers exit
+            old.shutdown(wait=False)
+        for task in parked:
+            self._submit(*task)
+
+    def recycle(self, reason: str = 'manual'):
+        with self._lock:
+            if self._executor is not None and not self._shutdown:
+                self._replace_locked(self._executor, reason)
+
+    def _check_memory(self):
+        while not self._stop.wait(self.check_interval):
+            for pid in self.pids():
+                size = anonymous_memory(pid)
+                if size is not None and size > self.memory_limit:
+                    self.logger.warning('Worker {} holds {} MiB, more than the limit of {} MiB. Recycling the pool'.format(
+                        pid, size >> 20, self.memory_limit >> 20))
+                    self.recycle('memory')
+                    break
+
+    def shutdown(self, wait: bool = True, cancel_futures: bool = False):
+        with self._lock:
+            self._shutdown = True
+            executor, self._executor = self._executor, None
+            parked, self._parked = self._parked, []
+        self._stop.set()
+        for (outer, _, _, _, _) in parked:
+            outer.cancel()
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=cancel_futures)
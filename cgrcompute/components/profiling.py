@@ -0,0 +1,193 @@
+from collections import Counter
+from contextlib import contextmanager
+from logging import getLogger
+from multiprocessing.sharedctypes import RawArray
+from typing import Callable, Optional
+import cProfile
+import itertools
+import os
+import random
+import signal
+import threading
+import time
+import tracemalloc
+
+# Processes that see this variable write profiles below it; profiling is off without it. Like the
+# metrics directory, it is set before the worker pools start so their processes inherit it.
+PROFILE_DIR_ENV = 'CGRCOMPUTE_PROFILE_DIR'
+
+PROFILERS = ('cprofile', 'sampling')
+PROFILE_SUFFIXES = {'cprofile': '.prof', 'sampling': '.folded'}
+TRACEMALLOC_FRAMES = 16
+
+# Positions in the shared settings array
+_REQUEST_RATE, _PROFILER, _SAMPLING_INTERVAL, _TRAINING, _TRACEMALLOC, _TRACEMALLOC_INTERVAL = range(6)
+
+
+class StackSampler:
+    # Low-overhead alternative to cProfile: on every SIGPROF (each `interval` seconds of CPU time of
+    # the process) the stack of the main thread is counted once. dump_stats() writes the counts in
+    # the folded format read by flamegraph.pl and speedscope. Only usable from the main thread,
+    # which is where ProcessPoolExecutor workers run their tasks.
+
+    def __init__(self, interval: float = 0.001):
+        self.interval = interval
+        self.stacks = Counter()
+        self._previous = None
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def enable(self):
+        self._previous = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def disable(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self._previous or signal.SIG_DFL)
+
+    def dump_stats(self, path: str):
+        with open(path, 'w') as f:
+            for (stack, n) in sorted(self.stacks.items()):
+                f.write('{} {}\n'.format(stack, n))
+
+
+class Profiling:
+    # Opt-in profiling of sampled Recommend calls and of training runs. The settings live in shared
+    # memory: processes forked after this object was created (the worker pool and the training
+    # process) see every later configure() of the server process, so profiling can be switched on
+    # without a restart. Request profiles are written to <dir>/requests/<id>.prof (or .folded) next to
+    # <id>.pb, the serialized request, so a slow request can be replayed; training runs write
+    # <dir>/training/<id>.*, and with tracemalloc a snapshot every tracemalloc_interval seconds, which
+    # survives an OOM kill, and one at the end.
+
+    def __init__(self):
+        self._values = RawArray('d', 6)
+        self._values[_SAMPLING_INTERVAL] = 0.001
+        self._values[_TRACEMALLOC_INTERVAL] = 60
+        self._count = itertools.count()
+        self.logger = getLogger('Profiling')
+
+    def configure(self, request_rate: float = None, profiler: str = None, sampling_interval: float = None,
+            training: bool = None, tracemalloc: bool = None, tracemalloc_interval: float = None):
+        # None leaves a setting unchanged
+        if request_rate is not None and not 0 <= request_rate <= 1:
+            raise ValueError('request_rate must be between 0 and 1, got {}'.format(request_rate))
+        if profiler is not None and profiler not in PROFILERS:
+            raise ValueError('profiler must be one of {}, got {}'.format(PROFILERS, profiler))
+        for (pos, value) in ((_REQUEST_RATE, request_rate), (_SAMPLING_INTERVAL, sampling_interval),
+                (_TRAINING, training), (_TRACEMALLOC, tracemalloc), (_TRACEMALLOC_INTERVAL, tracemalloc_interval)):
+            if value is not None:
+                self._values[pos] = float(value)
+        if profiler is not None:
+            self._values[_PROFILER] = PROFILERS.index(profiler)
+        self.logger.info('Profiling settings {}'.format(self.settings()))
+
+    def settings(self) -> dict:
+        return {
+            'request_rate': self._values[_REQUEST_RATE],
+            'profiler': PROFILERS[int(self._values[_PROFILER])],
+            'sampling_interval': self._values[_SAMPLING_INTERVAL],
+            'training': bool(self._values[_TRAINING]),
+            'tracemalloc': bool(self._values[_TRACEMALLOC]),
+            'tracemalloc_interval': self._values[_TRACEMALLOC_INTERVAL],
+        }
+
+    @staticmethod
+    def directory() -> Optional[str]:
+        return os.environ.get(PROFILE_DIR_ENV) or None
+
+    def _new_id(self, name: str) -> str:
+        return '{}-{}-{}-{}'.format(name, time.strftime('%Y%m%dT%H%M%S'), os.getpid(), next(self._count))
+
+    def _profiler(self):
+        name = PROFILERS[int(self._values[_PROFILER])]
+        if name == 'sampling' and threading.current_thread() is not threading.main_thread():
+            self.logger.warning('The sampling profiler only works on the main thread, using cProfile')
+            name = 'cprofile'
+        if name == 'sampling':
+            return StackSampler(self._values[_SAMPLING_INTERVAL]), PROFILE_SUFFIXES[name]
+        return cProfile.Profile(), PROFILE_SUFFIXES[name]
+
+    @contextmanager
+    def request(self, name: str, payload: Callable[[], bytes]):
+        # payload is only called for sampled requests
+        rate = self._values[_REQUEST_RATE]
+        directory = self.directory()
+        if rate <= 0 or directory is None or random.random() >= rate:
+            yield
+            return
+        request_id = self._new_id(name)
+        profiler, suffix = self._profiler()
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            elapsed = time.perf_counter() - start
+            try:
+                path = os.path.join(directory, 'requests', request_id)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                profiler.dump_stats(path + suffix)
+                with open(path + '.pb', 'wb') as f:
+                    f.write(payload())
+                self.logger.info('Profiled {} in {:.4f} s to {}'.format(name, elapsed, path + suffix))
+            except Exception:
+                # Never fail a request because of its profile
+                self.logger.exception('Cannot write the profile of {}'.format(request_id))
+
+    def _snapshot(self, path: str):
+        tmp = path + '.tmp'
+        tracemalloc.take_snapshot().dump(tmp)
+        os.replace(tmp, path)
+
+    def _snapshot_periodically(self, path: str, stop: threading.Event):
+        while not stop.wait(self._values[_TRACEMALLOC_INTERVAL]):
+            try:
+                self._snapshot(path)
+            except Exception:
+                self.logger.exception('Cannot write the tracemalloc snapshot {}'.format(path))
+
+    @contextmanager
+    def training(self):
+        directory = self.directory()
+        profile = directory is not None and bool(self._values[_TRAINING])
+        trace = directory is not None and bool(self._values[_TRACEMALLOC])
+        if not (profile or trace):
+            yield
+            return
+        path = os.path.join(directory, 'training', self._new_id('training'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        profiler, suffix = self._profiler() if profile else (None, None)
+        stop = threading.Event()
+        snapshots = None
+        if trace:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            snapshots = threading.Thread(target=self._snapshot_periodically, args=(path + '.latest.tracemalloc', stop),
+                name='TracemallocSnapshots', daemon=True)
+            snapshots.start()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(path + suffix)
+                self.logger.info('Profiled training to {}'.format(path + suffix))
+            if trace:
+                stop.set()
+                snapshots.join()
+                self._snapshot(path + '.tracemalloc')
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                self.logger.info('Training allocated at most {} MiB in Python, snapshot {}'.format(peak >> 20, path + '.tracemalloc'))
+
+
+PROFILING = Profiling()
@@ -0,0 +1,51 @@
+from cgrcompute.components.lrucache import LRUCache
+from cgrcompute.grpc import cgrcompute_pb2 as grpcmsg
+from logging import getLogger
+from typing import Any, Callable, Hashable, Optional
+import threading
+
+
+class ResultCache:
+    # Serialized Recommend responses kept in the gRPC front process, so a repeated request skips the
+    # process pool, inference and the name lookup. Entries are keyed on the normalized request and
+    # the model version; when `version()` changes (a new model was published) the cache is cleared.
+    # RANDOM requests are never cached.
+
+    def __init__(self, version: Callable[[], Hashable], maxsize: int = 4096, ttl: float = 300):
+        self.version = version
+        self.lru = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.logger = getLogger('ResultCache')
+        self._version = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def request_key(req: grpcmsg.CourseRecommendationRequest) -> Optional[tuple]:
+        if req.variant != 'COSINE':
+            return None
+        selected = tuple(sorted(set((e.semesterKey.studyProgram, e.courseNo) for e in req.selectedCourses)))
+        return (req.variant, req.semesterKey.studyProgram, req.semesterKey.semester, req.semesterKey.academicYear, selected)
+
+    def key(self, req: grpcmsg.CourseRecommendationRequest) -> Optional[tuple]:
+        # None if the request must not be cached
+        key = self.request_key(req)
+        if key is None:
+            return None
+        version = self.version()
+        with self._lock:
+            if version != self._version:
+                if self._version is not None:
+                    self.logger.info('Model version {} published, dropping {} results {}'.format(version, len(self.lru), self.stats()))
+                self.lru.clear()
+                self._version = version
+        return (version, ) + key
+
+    def get(self, key: tuple) -> Any:
+        return self.lru.get(key)
+
+    def put(self, key: tuple, res: bytes):
+        # Results computed against an older model are dropped
+        if key[0] == self._version:
+            self.lru.put(key, res)
+
+    def stats(self) -> dict[str, int]:
+        return {'hits': self.lru.hits, 'misses': self.lru.misses, 'size': len(self.lru)}
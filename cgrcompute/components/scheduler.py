@@ -0,0 +1,67 @@
+from concurrent.futures import ProcessPoolExecutor, BrokenExecutor
+from cgrcompute.components.metrics import POOL_RESTARTS
+from logging import getLogger
+from typing import Any, Callable
+import threading
+import time
+
+
+class ModelRefresher:
+    # Runs a training task at startup and then every `interval` seconds (or on trigger()) in a
+    # dedicated process, so training never blocks request workers. The task is expected to
+    # publish its result itself, e.g. through SharableCache.update, which swaps the model atomically;
+    # on failure the previously published model simply stays in place.
+
+    def __init__(self, task: Callable[..., Any], args: tuple = (), interval: float = 86400):
+        self.task = task
+        self.args = args
+        self.interval = interval
+        self.executor = None
+        self.last_result = None
+        self.last_success = None
+        self.logger = getLogger('ModelRefresher')
+        self._trigger = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self) -> bool:
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=1)
+        start = time.time()
+        self.logger.info("Refreshing model")
+        try:
+            self.last_result = self.executor.submit(self.task, *self.args).result()
+        except BrokenExecutor:
+            # Training process died, most likely OOM killed. Start a new one next time.
+            self.logger.exception("Training process crashed")
+            POOL_RESTARTS.inc(pool='training')
+            self.executor.shutdown(wait=False)
+            self.executor = None
+            return False
+        except Exception:
+            self.logger.exception("Refresh failed, keeping the previous model")
+            return False
+        self.last_success = time.time()
+        self.logger.info("Refreshed model in {} s".format(self.last_success - start))
+        return True
+
+    def trigger(self):
+        self._trigger.set()
+
+    def _run(self, delay: float):
+        if self._trigger.wait(timeout=delay):
+            self.logger.info("Refresh triggered before the scheduled start")
+        while not self._stop.is_set():
+            self._trigger.clear()
+            self.refresh()
+            self._trigger.wait(timeout=self.interval)
+
+    def start(self, delay: float = 0):
+        self._thread = threading.Thread(target=self._run, args=(delay, ), name='ModelRefresher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._trigger.set()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
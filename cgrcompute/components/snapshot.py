@@ -0,0 +1,50 @@
+from cgrcompute.components.multiprocess import dump_mapped, load_mapped
+from logging import getLogger
+from typing import Any, Optional
+import os
+import re
+import time
+
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_PATTERN = re.compile(r'^model-(\d+)\.snap$')
+
+
+def list_snapshots(directory: str) -> list[str]:
+    # Newest first. Snapshot names carry the training time in milliseconds.
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    snaps = [(int(m.group(1)), n) for (m, n) in ((SNAPSHOT_PATTERN.match(n), n) for n in names) if m]
+    return [os.path.join(directory, n) for (_, n) in sorted(snaps, reverse=True)]
+
+
+def save_snapshot(directory: str, model: Any, header: dict, keep: int = 3) -> str:
+    os.makedirs(directory, exist_ok=True)
+    header = dict(header, format=SNAPSHOT_FORMAT)
+    header.setdefault('trained_at', time.time())
+    path = os.path.join(directory, 'model-{}.snap'.format(int(header['trained_at'] * 1000)))
+    dump_mapped({'header': header, 'model': model}, path)
+    for old in list_snapshots(directory)[keep:]:
+        os.unlink(old)
+    return path
+
+
+def load_snapshot(path: str) -> tuple[dict, Any]:
+    snap = load_mapped(path)
+    if not isinstance(snap, dict) or snap.get('header', {}).get('format') != SNAPSHOT_FORMAT:
+        raise ValueError('{} has an unsupported snapshot format'.format(path))
+    return snap['header'], snap['model']
+
+
+def load_latest_snapshot(directory: str) -> Optional[tuple[dict, Any]]:
+    logger = getLogger('load_latest_snapshot')
+    for path in list_snapshots(directory):
+        try:
+            header, model = load_snapshot(path)
+        except Exception:
+            logger.exception('Skipping invalid snapshot {}'.format(path))
+            continue
+        logger.info('Loaded snapshot {} {}'.format(path, header))
+        return header, model
+    return None
@@ -2,4 +2,4 @@ import sys
 import os
 sys.path.append(os.path.dirname(__file__))
 
-from . import health_pb2_grpc, health_pb2, cgrcompute_pb2_grpc, cgrcompute_pb2
+from . import health_pb2_grpc, health_pb2, cgrcompute_pb2_grpc, cgrcompute_pb2, admin_pb2_grpc, admin_pb2
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by the protocol buffer compiler.  DO NOT EDIT!
+# source: admin.proto
+"""Generated protocol buffer code."""
+from google.protobuf.internal import builder as _builder
+from google.protobuf import descriptor as _descriptor
+from google.protobuf import descriptor_pool as _descriptor_pool
+from google.protobuf import symbol_database as _symbol_database
+# @@protoc_insertion_point(imports)
+
+_sym_db = _symbol_database.Default()
+
+
+
+
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0b\x61\x64min.proto\"\xaf\x01\n\x11ProfilingSettings\x12\x18\n\x0brequestRate\x18\x01 \x01(\x01H\x00\x88\x01\x01\x12\x15\n\x08profiler\x18\x02 \x01(\tH\x01\x88\x01\x01\x12\x15\n\x08training\x18\x03 \x01(\x08H\x02\x88\x01\x01\x12\x18\n\x0btracemalloc\x18\x04 \x01(\x08H\x03\x88\x01\x01\x42\x0e\n\x0c_requestRateB\x0b\n\t_profilerB\x0b\n\t_trainingB\x0e\n\x0c_tracemalloc2A\n\x05\x41\x64min\x12\x38\n\x0cSetProfiling\x12\x12.ProfilingSettings\x1a\x12.ProfilingSettings\"\x00\x62\x06proto3')
+
+_builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
+_builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'admin_pb2', globals())
+if _descriptor._USE_C_DESCRIPTORS == False:
+
+  DESCRIPTOR._options = None
+  _PROFILINGSETTINGS._serialized_start=16
+  _PROFILINGSETTINGS._serialized_end=191
+  _ADMIN._serialized_start=193
+  _ADMIN._serialized_end=258
+# @@protoc_insertion_point(module_scope)
@@ -0,0 +1,69 @@
+# Generated by the gRPC Python protocol compiler plugin. DO NOT EDIT!
+"""Client and server classes corresponding to protobuf-defined services."""
+import grpc
+
+import admin_pb2 as admin__pb2
+
+
+class AdminStub(object):
+    """Runtime controls for operators
+    """
+
+    def __init__(self, channel):
+        """Constructor.
+
+        Args:
+            channel: A grpc.Channel.
+        """
+        self.SetProfiling = channel.unary_unary(
+                '/Admin/SetProfiling',
+                request_serializer=admin__pb2.ProfilingSettings.SerializeToString,
+                response_deserializer=admin__pb2.ProfilingSettings.FromString,
+                )
+
+
+class AdminServicer(object):
+    """Runtime controls for operators
+    """
+
+    def SetProfiling(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+
+def add_AdminServicer_to_server(servicer, server):
+    rpc_method_handlers = {
+            'SetProfiling': grpc.unary_unary_rpc_method_handler(
+                    servicer.SetProfiling,
+                    request_deserializer=admin__pb2.ProfilingSettings.FromString,
+                    response_serializer=admin__pb2.ProfilingSettings.SerializeToString,
+            ),
+    }
+    generic_handler = grpc.method_handlers_generic_handler(
+            'Admin', rpc_method_handlers)
+    server.add_generic_rpc_handlers((generic_handler,))
+
+
+ # This class is part of an EXPERIMENTAL API.
+class Admin(object):
+    """Runtime controls for operators
+    """
+
+    @staticmethod
+    def SetProfiling(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/Admin/SetProfiling',
+            admin__pb2.ProfilingSettings.SerializeToString,
+            admin__pb2.ProfilingSettings.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
@@ -13,7 +13,7 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x10\x63grcompute.proto\"K\n\x0bSemesterKey\x12\x14\n\x0cstudyProgram\x18\x01 \x01(\t\x12\x10\n\x08semester\x18\x02 \x01(\t\x12\x14\n\x0c\x61\x63\x61\x64\x65micYear\x18\x03 \x01(\t\"@\n\tCourseKey\x12\x10\n\x08\x63ourseNo\x18\x01 \x01(\t\x12!\n\x0bsemesterKey\x18\x02 \x01(\x0b\x32\x0c.SemesterKey\"v\n\x1b\x43ourseRecommendationRequest\x12\x0f\n\x07variant\x18\x01 \x01(\t\x12!\n\x0bsemesterKey\x18\x02 \x01(\x0b\x32\x0c.SemesterKey\x12#\n\x0fselectedCourses\x18\x03 \x03(\x0b\x32\n.CourseKey\"\x9a\x01\n\x1c\x43ourseRecommendationResponse\x12;\n\x07\x63ourses\x18\x02 \x03(\x0b\x32*.CourseRecommendationResponse.CourseDetail\x1a=\n\x0c\x43ourseDetail\x12\x17\n\x03key\x18\x01 \x01(\x0b\x32\n.CourseKey\x12\x14\n\x0c\x63ourseNameEn\x18\x02 \x01(\t2b\n\x14\x43ourseRecommendation\x12J\n\tRecommend\x12\x1c.CourseRecommendationRequest\x1a\x1d.CourseRecommendationResponse\"\x00\x62\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x10\x63grcompute.proto\"K\n\x0bSemesterKey\x12\x14\n\x0cstudyProgram\x18\x01 \x01(\t\x12\x10\n\x08semester\x18\x02 \x01(\t\x12\x14\n\x0c\x61\x63\x61\x64\x65micYear\x18\x03 \x01(\t\"@\n\tCourseKey\x12\x10\n\x08\x63ourseNo\x18\x01 \x01(\t\x12!\n\x0bsemesterKey\x18\x02 \x01(\x0b\x32\x0c.SemesterKey\"v\n\x1b\x43ourseRecommendationRequest\x12\x0f\n\x07variant\x18\x01 \x01(\t\x12!\n\x0bsemesterKey\x18\x02 \x01(\x0b\x32\x0c.SemesterKey\x12#\n\x0fselectedCourses\x18\x03 \x03(\x0b\x32\n.CourseKey\"\xac\x01\n\x1c\x43ourseRecommendationResponse\x12;\n\x07\x63ourses\x18\x02 \x03(\x0b\x32*.CourseRecommendationResponse.CourseDetail\x12\x10\n\x08\x64\x65graded\x18\x03 \x01(\x08\x1a=\n\x0c\x43ourseDetail\x12\x17\n\x03key\x18\x01 \x01(\x0b\x32\n.CourseKey\x12\x14\n\x0c\x63ourseNameEn\x18\x02 \x01(\t\"R\n CourseRecommendationBatchRequest\x12.\n\x08requests\x18\x01 \x03(\x0b\x32\x1c.CourseRecommendationRequest\"\xc6\x01\n!CourseRecommendationBatchResponse\x12\x30\n\tresponses\x18\x01 \x03(\x0b\x32\x1d.CourseRecommendationResponse\x12\x38\n\x06\x65rrors\x18\x02 \x03(\x0b\x32(.CourseRecommendationBatchResponse.Error\x1a\x35\n\x05\x45rror\x12\r\n\x05index\x18\x01 \x01(\x05\x12\x0c\n\x04\x63ode\x18\x02 \x01(\x05\x12\x0f\n\x07message\x18\x03 \x01(\t2\x93\x02\n\x14\x43ourseRecommendation\x12J\n\tRecommend\x12\x1c.CourseRecommendationRequest\x1a\x1d.CourseRecommendationResponse\"\x00\x12Y\n\x0eRecommendBatch\x12!.CourseRecommendationBatchRequest\x1a\".CourseRecommendationBatchResponse\"\x00\x12T\n\x0fRecommendStream\x12\x1c.CourseRecommendationRequest\x1a\x1d.CourseRecommendationResponse\"\x00(\x01\x30\x01\x62\x06proto3')
 
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'cgrcompute_pb2', globals())
@@ -27,9 +27,15 @@ if _descriptor._USE_C_DESCRIPTORS == False:
   _COURSERECOMMENDATIONREQUEST._serialized_start=163
   _COURSERECOMMENDATIONREQUEST._serialized_end=281
   _COURSERECOMMENDATIONRESPONSE._serialized_start=284
-  _COURSERECOMMENDATIONRESPONSE._serialized_end=438
-  _COURSERECOMMENDATIONRESPONSE_COURSEDETAIL._serialized_start=377
-  _COURSERECOMMENDATIONRESPONSE_COURSEDETAIL._serialized_end=438
-  _COURSERECOMMENDATION._serialized_start=440
-  _COURSERECOMMENDATION._serialized_end=538
+  _COURSERECOMMENDATIONRESPONSE._serialized_end=456
+  _COURSERECOMMENDATIONRESPONSE_COURSEDETAIL._serialized_start=395
+  _COURSERECOMMENDATIONRESPONSE_COURSEDETAIL._serialized_end=456
+  _COURSERECOMMENDATIONBATCHREQUEST._serialized_start=458
+  _COURSERECOMMENDATIONBATCHREQUEST._serialized_end=540
+  _COURSERECOMMENDATIONBATCHRESPONSE._serialized_start=543
+  _COURSERECOMMENDATIONBATCHRESPONSE._serialized_end=741
+  _COURSERECOMMENDATIONBATCHRESPONSE_ERROR._serialized_start=688
+  _COURSERECOMMENDATIONBATCHRESPONSE_ERROR._serialized_end=741
+  _COURSERECOMMENDATION._serialized_start=744
+  _COURSERECOMMENDATION._serialized_end=1019
 # @@protoc_insertion_point(module_scope)
@@ -19,6 +19,16 @@ class CourseRecommendationStub(object):
                 request_serializer=cgrcompute__pb2.CourseRecommendationRequest.SerializeToString,
                 response_deserializer=cgrcompute__pb2.CourseRecommendationResponse.FromString,
                 )
+        self.RecommendBatch = channel.unary_unary(
+                '/CourseRecommendation/RecommendBatch',
+                request_serializer=cgrcompute__pb2.CourseRecommendationBatchRequest.SerializeToString,
+                response_deserializer=cgrcompute__pb2.CourseRecommendationBatchResponse.FromString,
+                )
+        self.RecommendStream = channel.stream_stream(
+                '/CourseRecommendation/RecommendStream',
+                request_serializer=cgrcompute__pb2.CourseRecommendationRequest.SerializeToString,
+                response_deserializer=cgrcompute__pb2.CourseRecommendationResponse.FromString,
+                )
 
 
 class CourseRecommendationServicer(object):
@@ -30,6 +40,18 @@ class CourseRecommendationServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def RecommendBatch(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def RecommendStream(self, request_iterator, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_CourseRecommendationServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -38,6 +60,16 @@ def add_CourseRecommendationServicer_to_server(servicer, server):
                     request_deserializer=cgrcompute__pb2.CourseRecommendationRequest.FromString,
                     response_serializer=cgrcompute__pb2.CourseRecommendationResponse.SerializeToString,
             ),
+            'RecommendBatch': grpc.unary_unary_rpc_method_handler(
+                    servicer.RecommendBatch,
+                    request_deserializer=cgrcompute__pb2.CourseRecommendationBatchRequest.FromString,
+                    response_serializer=cgrcompute__pb2.CourseRecommendationBatchResponse.SerializeToString,
+            ),
+            'RecommendStream': grpc.stream_stream_rpc_method_handler(
+                    servicer.RecommendStream,
+                    request_deserializer=cgrcompute__pb2.CourseRecommendationRequest.FromString,
+                    response_serializer=cgrcompute__pb2.CourseRecommendationResponse.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'CourseRecommendation', rpc_method_handlers)
@@ -64,3 +96,37 @@ class CourseRecommendation(object):
             cgrcompute__pb2.CourseRecommendationResponse.FromString,
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def RecommendBatch(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/CourseRecommendation/RecommendBatch',
+            cgrcompute__pb2.CourseRecommendationBatchRequest.SerializeToString,
+            cgrcompute__pb2.CourseRecommendationBatchResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def RecommendStream(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_stream(request_iterator, target, '/CourseRecommendation/RecommendStream',
+            cgrcompute__pb2.CourseRecommendationRequest.SerializeToString,
+            cgrcompute__pb2.CourseRecommendationResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
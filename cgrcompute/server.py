@@ -1,62 +1,456 @@
+import asyncio
 import grpc
-from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from multiprocessing import Manager
-from cgrcompute.components.multiprocess import SharableCache
-from cgrcompute.components.courserecommendation import recommend_course_serialized
-from cgrcompute.components.health import HealthServicer
+from cgrcompute.components.multiprocess import SharableCache, MappedSharableCache
+from cgrcompute.components.config import get_config
+from cgrcompute.components.courserecommendation import recommend_course_serialized, recommend_course_batch_serialized, refresh_course_recommendation_model, load_course_recommendation_snapshot, warm_up_worker, published_model_keys, TimeDecay, ModelNotReadyError, DeadlineExceededError
+from cgrcompute.components.scheduler import ModelRefresher
+from cgrcompute.components.batching import MicroBatcher
+from cgrcompute.components.pool import SupervisedPool
+from cgrcompute.components.admission import AdmissionController, RejectedError
+from cgrcompute.components.health import HealthMonitor, HealthServicer
+from cgrcompute.components.external import MongoService
+from cgrcompute.components.admin import AdminServicer
+from cgrcompute.components.neighbours import LSHNeighbours
+from cgrcompute.components.resultcache import ResultCache
+from cgrcompute.components.lrucache import MISSING
+from cgrcompute.components.metrics import METRICS_DIR_ENV, MODEL_VERSION, RPC_SECONDS, start_metrics_server
+from cgrcompute.components.profiling import PROFILE_DIR_ENV, PROFILING
 from logging import getLogger
+from typing import Optional
 import logging
+import os
+import shutil
+import signal
+import threading
 import time
+from queue import Queue
 
-from cgrcompute.grpc import cgrcompute_pb2_grpc, cgrcompute_pb2, health_pb2_grpc
+from cgrcompute.grpc import cgrcompute_pb2_grpc, cgrcompute_pb2, health_pb2_grpc, admin_pb2_grpc
 
 POOL_SIZE = 4
 
 logging.basicConfig(level=logging.INFO)
 
 manager: Manager = None
-pool: ProcessPoolExecutor = None
+pool: SupervisedPool = None
+cache: MappedSharableCache = None
+refresher: ModelRefresher = None
+batcher: MicroBatcher = None
+result_cache: ResultCache = None
+admission: AdmissionController = None
+health: HealthMonitor = None
+
+# Errors of a request that are answered with a status instead of failing the RPC
+REQUEST_ERRORS = (ModelNotReadyError, DeadlineExceededError, RejectedError)
+
+
+def status_code(e: Exception) -> grpc.StatusCode:
+    if isinstance(e, ModelNotReadyError):
+        return grpc.StatusCode.UNAVAILABLE
+    if isinstance(e, DeadlineExceededError) or (isinstance(e, RejectedError) and e.reason == 'deadline'):
+        return grpc.StatusCode.DEADLINE_EXCEEDED
+    if isinstance(e, RejectedError):
+        return grpc.StatusCode.RESOURCE_EXHAUSTED
+    return grpc.StatusCode.UNKNOWN
+
+
+def request_deadline(context) -> Optional[float]:
+    # The gRPC deadline of the call as a time.time(), None if the client set none
+    remaining = context.time_remaining()
+    return None if remaining is None else time.time() + remaining
+
+
+def wait(fut: Future, deadline: Optional[float]):
+    try:
+        return fut.result(timeout=None if deadline is None else max(deadline - time.time(), 0))
+    except FutureTimeoutError:
+        fut.cancel()
+        raise DeadlineExceededError('no response before the deadline')
+
+
+async def wait_async(fut: Future, deadline: Optional[float]):
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(fut), None if deadline is None else max(deadline - time.time(), 0))
+    except asyncio.TimeoutError:
+        raise DeadlineExceededError('no response before the deadline')
+
+
+def batch_dispatcher(cache):
+    # MicroBatcher items are (serialized request, deadline) pairs
+    def dispatch(items):
+        return pool.submit(recommend_course_batch_serialized, [r for (r, _) in items], cache, time.time(), [d for (_, d) in items])
+    return dispatch
 
 
 class CourseRecommendationServicer(cgrcompute_pb2_grpc.CourseRecommendationServicer):
     cache: SharableCache
 
-    def __init__(self, cache):
+    def __init__(self, cache, batcher: MicroBatcher = None, batch_size: int = 32, result_cache: ResultCache = None, admission: AdmissionController = None):
         self.cache = cache
+        self.batcher = batcher
+        self.batch_size = batch_size
+        self.result_cache = result_cache
+        self.admission = admission
         self.logger = getLogger('CourseRecommendationServicer')
 
+    def submit(self, request, deadline: float = None) -> Future:
+        # Raises RejectedError if admission control turns the request away
+        key = self.result_cache.key(request) if self.result_cache is not None else None
+        if key is not None:
+            res = self.result_cache.get(key)
+            if res is not MISSING:
+                fut = Future()
+                fut.set_result(res)
+                return fut
+        if self.admission is not None:
+            self.admission.admit(deadline=deadline)
+        if self.batcher is not None:
+            fut = self.batcher.submit((request.SerializeToString(), deadline))
+        else:
+            fut = pool.submit(recommend_course_serialized, request.SerializeToString(), self.cache, time.time(), deadline)
+        if self.admission is not None:
+            self.admission.track(fut)
+        if key is not None:
+            def store(f):
+                # Degraded answers are only good enough for the request that missed its deadline
+                if not f.cancelled() and f.exception() is None and not cgrcompute_pb2.CourseRecommendationResponse.FromString(f.result()).degraded:
+                    self.result_cache.put(key, f.result())
+            fut.add_done_callback(store)
+        return fut
+
+    def submit_batch(self, requests, deadline: float = None) -> list[Future]:
+        # Split large batches so they are still spread over all workers
+        if self.admission is not None:
+            self.admission.admit(len(requests), deadline)
+        reqs = [r.SerializeToString() for r in requests]
+        futures = []
+        for i in range(0, len(reqs), self.batch_size):
+            chunk = reqs[i:i + self.batch_size]
+            fut = pool.submit(recommend_course_batch_serialized, chunk, self.cache, time.time(), [deadline] * len(chunk))
+            if self.admission is not None:
+                self.admission.track(fut, len(chunk))
+            futures.append(fut)
+        return futures
+
+    @staticmethod
+    def batch_response(results: list[list]) -> cgrcompute_pb2.CourseRecommendationBatchResponse:
+        # A request that failed gets an empty response in its place and an entry in `errors`
+        res = cgrcompute_pb2.CourseRecommendationBatchResponse()
+        for r in (r for chunk in results for r in chunk):
+            if isinstance(r, Exception):
+                res.errors.add(index=len(res.responses), code=status_code(r).value[0], message=str(r))
+                res.responses.add()
+            else:
+                res.responses.add().ParseFromString(r)
+        return res
+
     def Recommend(self, request, context):
         start = time.time()
         self.logger.info("Processing Recommend")
         res =  cgrcompute_pb2.CourseRecommendationResponse()
-        res.ParseFromString(pool.submit(recommend_course_serialized, request.SerializeToString(), self.cache).result())
+        deadline = request_deadline(context)
+        try:
+            res.ParseFromString(wait(self.submit(request, deadline), deadline))
+        except REQUEST_ERRORS as e:
+            context.abort(status_code(e), str(e))
         self.logger.info("Processed Recommend took {} s".format(time.time() - start))
+        RPC_SECONDS.observe(time.time() - start, method='Recommend')
+        return res
+
+    def RecommendBatch(self, request, context):
+        start = time.time()
+        self.logger.info("Processing RecommendBatch of {}".format(len(request.requests)))
+        res = cgrcompute_pb2.CourseRecommendationBatchResponse()
+        deadline = request_deadline(context)
+        try:
+            res = self.batch_response([wait(f, deadline) for f in self.submit_batch(request.requests, deadline)])
+        except REQUEST_ERRORS as e:
+            context.abort(status_code(e), str(e))
+        self.logger.info("Processed RecommendBatch took {} s".format(time.time() - start))
+        RPC_SECONDS.observe(time.time() - start, method='RecommendBatch')
         return res
 
+    def RecommendStream(self, request_iterator, context):
+        # Requests are submitted as they arrive; responses are sent back in request order
+        pending = Queue()
+        deadline = request_deadline(context)
+        def consume():
+            try:
+                for r in request_iterator:
+                    try:
+                        pending.put(self.submit(r, deadline))
+                    except RejectedError as e:
+                        fut = Future()
+                        fut.set_exception(e)
+                        pending.put(fut)
+            finally:
+                pending.put(None)
+        threading.Thread(target=consume, daemon=True).start()
+        while True:
+            fut = pending.get()
+            if fut is None:
+                return
+            res = cgrcompute_pb2.CourseRecommendationResponse()
+            try:
+                res.ParseFromString(wait(fut, deadline))
+            except REQUEST_ERRORS as e:
+                context.abort(status_code(e), str(e))
+            yield res
 
-def create_server():
-    global manager, pool
+
+class AsyncCourseRecommendationServicer(CourseRecommendationServicer):
+    # grpc.aio variant: waiting on the pool does not hold a server thread, so the number of
+    # in-flight requests is bounded by the process pool and maximum_concurrent_rpcs only.
+
+    async def Recommend(self, request, context):
+        start = time.time()
+        self.logger.info("Processing Recommend")
+        res =  cgrcompute_pb2.CourseRecommendationResponse()
+        deadline = request_deadline(context)
+        try:
+            res.ParseFromString(await wait_async(self.submit(request, deadline), deadline))
+        except REQUEST_ERRORS as e:
+            await context.abort(status_code(e), str(e))
+        self.logger.info("Processed Recommend took {} s".format(time.time() - start))
+        RPC_SECONDS.observe(time.time() - start, method='Recommend')
+        return res
+
+    async def RecommendBatch(self, request, context):
+        start = time.time()
+        self.logger.info("Processing RecommendBatch of {}".format(len(request.requests)))
+        res = cgrcompute_pb2.CourseRecommendationBatchResponse()
+        deadline = request_deadline(context)
+        try:
+            res = self.batch_response(await asyncio.gather(*(wait_async(f, deadline) for f in self.submit_batch(request.requests, deadline))))
+        except REQUEST_ERRORS as e:
+            await context.abort(status_code(e), str(e))
+        self.logger.info("Processed RecommendBatch took {} s".format(time.time() - start))
+        RPC_SECONDS.observe(time.time() - start, method='RecommendBatch')
+        return res
+
+    async def RecommendStream(self, request_iterator, context):
+        pending = asyncio.Queue()
+        deadline = request_deadline(context)
+        async def consume():
+            try:
+                async for r in request_iterator:
+                    try:
+                        fut = self.submit(r, deadline)
+                    except RejectedError as e:
+                        fut = Future()
+                        fut.set_exception(e)
+                    await pending.put(asyncio.ensure_future(wait_async(fut, deadline)))
+            finally:
+                await pending.put(None)
+        consumer = asyncio.ensure_future(consume())
+        try:
+            while True:
+                fut = await pending.get()
+                if fut is None:
+                    return
+                res = cgrcompute_pb2.CourseRecommendationResponse()
+                try:
+                    res.ParseFromString(await fut)
+                except REQUEST_ERRORS as e:
+                    await context.abort(status_code(e), str(e))
+                yield res
+        finally:
+            consumer.cancel()
+
+
+def create_neighbours(cfg):
+    if cfg.get('recommendation', 'neighbours', fallback='exact') == 'lsh':
+        return LSHNeighbours(bits=cfg.getint('recommendation', 'lsh_bits', fallback=2),
+            tables=cfg.getint('recommendation', 'lsh_tables', fallback=1))
+    return None
+
+def create_study_programs(cfg) -> Optional[list[str]]:
+    programs = [p.strip() for p in cfg.get('recommendation', 'study_programs', fallback='').split(',')]
+    return [p for p in programs if p] or None
+
+def create_decay(cfg):
+    half_life = cfg.getfloat('recommendation', 'decay_half_life_days', fallback=0)
+    if half_life > 0:
+        return TimeDecay(half_life * 86400, min_weight=cfg.getfloat('recommendation', 'decay_min_weight', fallback=0.01))
+    return None
+
+def configure_profiling(cfg):
+    # Must run before the worker pools start, so their processes inherit the directory and settings
+    directory = cfg.get('profiling', 'directory', fallback=None)
+    if directory:
+        os.environ[PROFILE_DIR_ENV] = directory
+    PROFILING.configure(request_rate=cfg.getfloat('profiling', 'request_rate', fallback=0),
+        profiler=cfg.get('profiling', 'profiler', fallback='cprofile'),
+        sampling_interval=cfg.getfloat('profiling', 'sampling_interval_ms', fallback=1) / 1000,
+        training=cfg.getboolean('profiling', 'training', fallback=False),
+        tracemalloc=cfg.getboolean('profiling', 'tracemalloc', fallback=False),
+        tracemalloc_interval=cfg.getfloat('profiling', 'tracemalloc_interval', fallback=60))
+
+def check_workers() -> tuple[bool, str]:
+    alive = pool.heartbeats.alive()
+    return (len(alive) > 0, '{} of {} workers alive'.format(len(alive), pool.max_workers))
+
+def check_model() -> tuple[bool, str]:
+    keys = published_model_keys(cache)
+    if not keys:
+        return (False, 'no model published yet')
+    return (True, '{} models published, version {}'.format(len(keys), cache.generation()))
+
+def check_training(max_age: float) -> tuple[bool, str]:
+    if refresher.last_success is None:
+        return (False, 'not trained yet')
+    age = time.time() - refresher.last_success
+    return (age <= max_age, 'last trained {:.0f} s ago'.format(age))
+
+def check_mongo(mongo: MongoService, timeout: float) -> tuple[bool, str]:
+    ok = mongo.ping(timeout)
+    return (ok, 'reachable' if ok else 'unreachable')
+
+def create_health_monitor(cfg) -> HealthMonitor:
+    monitor = HealthMonitor(interval=cfg.getfloat('health', 'interval', fallback=1))
+    monitor.add_check('workers', check_workers)
+    monitor.add_check('model', check_model)
+    max_train_age = cfg.getfloat('health', 'max_train_age', fallback=0) or 2 * refresher.interval
+    monitor.add_check('training', partial(check_training, max_train_age))
+    # A client of its own: the one of get_mongo_service() would be inherited by workers forked later
+    monitor.add_check('mongo', partial(check_mongo, MongoService(), cfg.getfloat('health', 'mongo_timeout', fallback=2)),
+        interval=cfg.getfloat('health', 'mongo_interval', fallback=10))
+    # Restarting the server only helps when its workers are gone
+    monitor.add_service('', ['workers'])
+    # Ready to take Recommend calls
+    monitor.add_service('CourseRecommendation', ['workers', 'model'])
+    return monitor
+
+def create_components():
+    global manager, pool, cache, refresher, batcher, result_cache, admission, health
+    cfg = get_config()
     manager = Manager()
-    cache = SharableCache(manager)
-    pool = ProcessPoolExecutor()
-    server = grpc.server(ThreadPoolExecutor(max_workers=POOL_SIZE))
+    cache = MappedSharableCache(manager, directory=cfg.get('cache', 'directory', fallback=None))
+    # Worker and training processes inherit this and write their metrics next to the models. A
+    # configured cache directory outlives the server, so the files of its previous runs are removed
+    metrics_directory = os.path.join(cache.directory, 'metrics')
+    shutil.rmtree(metrics_directory, ignore_errors=True)
+    os.environ[METRICS_DIR_ENV] = metrics_directory
+    MODEL_VERSION.set_function(cache.generation)
+    configure_profiling(cfg)
+    metrics_port = cfg.getint('metrics', 'port', fallback=0)
+    if metrics_port:
+        start_metrics_server(metrics_port)
+    snapshot_directory = cfg.get('recommendation', 'snapshot_directory', fallback=None)
+    refresher = ModelRefresher(partial(refresh_course_recommendation_model, cache,
+            snapshot_directory=snapshot_directory,
+            snapshot_keep=cfg.getint('recommendation', 'snapshot_keep', fallback=3),
+            incremental=cfg.getboolean('recommendation', 'incremental', fallback=True),
+            limit=cfg.getint('recommendation', 'max_events', fallback=900000),
+            event_log_directory=cfg.get('recommendation', 'event_log_directory', fallback=None),
+            shard_by_program=cfg.getboolean('recommendation', 'shard_by_program', fallback=False),
+            study_programs=create_study_programs(cfg),
+            neighbours=create_neighbours(cfg),
+            popular_semesters=cfg.getint('recommendation', 'popular_semesters', fallback=2),
+            decay=create_decay(cfg)),
+        interval=cfg.getfloat('recommendation', 'refresh_interval', fallback=86400))
+    memory_limit = cfg.getint('server', 'worker_memory_limit_mb', fallback=0)
+    pool = SupervisedPool(max_workers=cfg.getint('server', 'workers', fallback=None),
+        initializer=warm_up_worker, initargs=(cache, ),
+        retries=cfg.getint('server', 'worker_retries', fallback=1),
+        max_tasks_per_child=cfg.getint('server', 'max_tasks_per_child', fallback=None),
+        memory_limit=memory_limit << 20 if memory_limit > 0 else None,
+        heartbeat_timeout=cfg.getfloat('health', 'worker_timeout', fallback=10))
+    batch_delay = cfg.getfloat('server', 'batch_delay_ms', fallback=0) / 1000
+    if batch_delay > 0:
+        batcher = MicroBatcher(batch_dispatcher(cache),
+            max_batch_size=cfg.getint('server', 'batch_size', fallback=32), max_delay=batch_delay)
+    result_cache_size = cfg.getint('server', 'result_cache_size', fallback=0)
+    if result_cache_size > 0:
+        result_cache = ResultCache(cache.generation, maxsize=result_cache_size,
+            ttl=cfg.getfloat('server', 'result_cache_ttl', fallback=300))
+    # Without limits, requests are still rejected when they would miss their own deadline
+    max_in_flight = cfg.getint('server', 'max_in_flight', fallback=0)
+    max_wait = cfg.getfloat('server', 'max_wait_ms', fallback=0) / 1000
+    admission = AdmissionController(max_in_flight=max_in_flight or None, max_wait=max_wait or None)
+    health = create_health_monitor(cfg)
+    health.start()
+
+def create_servicer(servicer_class):
+    return servicer_class(cache, batcher=batcher, batch_size=get_config().getint('server', 'batch_size', fallback=32), result_cache=result_cache, admission=admission)
+
+def add_admin_servicer(server):
+    if get_config().getboolean('server', 'admin', fallback=False):
+        admin_pb2_grpc.add_AdminServicer_to_server(AdminServicer(PROFILING), server)
+
+def create_server():
+    create_components()
+    cfg = get_config()
+    server = grpc.server(ThreadPoolExecutor(max_workers=cfg.getint('server', 'threads', fallback=POOL_SIZE)),
+        maximum_concurrent_rpcs=cfg.getint('server', 'max_concurrent_rpcs', fallback=None))
     server.add_insecure_port('[::]:50051')
-    cgrcompute_pb2_grpc.add_CourseRecommendationServicer_to_server(CourseRecommendationServicer(cache), server)
-    health_pb2_grpc.add_HealthServicer_to_server(HealthServicer(pool), server)
+    cgrcompute_pb2_grpc.add_CourseRecommendationServicer_to_server(create_servicer(CourseRecommendationServicer), server)
+    health_pb2_grpc.add_HealthServicer_to_server(HealthServicer(health), server)
+    add_admin_servicer(server)
     return server
 
+def create_aio_server():
+    # Must be called inside the event loop that runs the server.
+    create_components()
+    cfg = get_config()
+    # Only the synchronous health servicer runs on these threads
+    server = grpc.aio.server(migration_thread_pool=ThreadPoolExecutor(max_workers=cfg.getint('server', 'threads', fallback=POOL_SIZE)),
+        maximum_concurrent_rpcs=cfg.getint('server', 'max_concurrent_rpcs', fallback=None))
+    server.add_insecure_port('[::]:50051')
+    cgrcompute_pb2_grpc.add_CourseRecommendationServicer_to_server(create_servicer(AsyncCourseRecommendationServicer), server)
+    health_pb2_grpc.add_HealthServicer_to_server(HealthServicer(health), server)
+    add_admin_servicer(server)
+    return server
+
+def start_refresher():
+    # Serve the newest snapshot right away, then retrain in the background once it is due
+    delay = 0
+    cfg = get_config()
+    snapshot_directory = cfg.get('recommendation', 'snapshot_directory', fallback=None)
+    if snapshot_directory:
+        header = load_course_recommendation_snapshot(cache, snapshot_directory,
+            shard_by_program=cfg.getboolean('recommendation', 'shard_by_program', fallback=False))
+        if header:
+            delay = max(0, refresher.interval - (time.time() - header['trained_at']))
+            # The snapshot counts as the last training until the next one finishes
+            refresher.last_success = header['trained_at']
+    refresher.start(delay)
+
 def create_client():
     channel = grpc.insecure_channel('localhost:50051')
     return cgrcompute_pb2_grpc.CourseRecommendationStub(channel)
 
-if __name__ == '__main__':
-    logger = getLogger('main')
-    logger.info("Started CGR-Compute with gRPC at :50051")
+def serve():
     server = create_server()
+    start_refresher()
     server.start()
+    server.wait_for_termination()
+
+async def serve_aio():
+    server = create_aio_server()
+    start_refresher()
+    await server.start()
+    await server.wait_for_termination()
+
+if __name__ == '__main__':
+    logger = getLogger('main')
+    mode = get_config().get('server', 'mode', fallback='thread')
+    logger.info("Started CGR-Compute with gRPC ({}) at :50051".format(mode))
+    signal.signal(signal.SIGHUP, lambda signum, frame: refresher.trigger())
     try:
-        server.wait_for_termination()
+        if mode == 'aio':
+            asyncio.run(serve_aio())
+        else:
+            serve()
     finally:
         logger.info("Shutting down...")
-        manager.shutdown()
+        health.stop()
+        refresher.stop()
+        if batcher is not None:
+            batcher.close()
         pool.shutdown()
+        cache.close()
+        manager.shutdown()
@@ -0,0 +1,25 @@
+import numpy as np
+
+
+def generate_events(n_events: int, n_courses: int = 3000, programs=('S', 'T', 'I'), mean_basket: float = 8.0, zipf: float = 1.1, seed: int = 0):
+    # Synthetic "user add course" events with Zipfian course popularity, shaped like the events of
+    # ElasticService.find_all_user_add_course. Shared by the tests and the benchmarks.
+    rng = np.random.default_rng(seed)
+    popularity = 1.0 / np.arange(1, n_courses + 1) ** zipf
+    popularity /= popularity.sum()
+    course_program = rng.integers(0, len(programs), n_courses)
+    events = []
+    device = 0
+    while len(events) < n_events:
+        size = min(1 + rng.poisson(mean_basket - 1), n_courses)
+        for c in rng.choice(n_courses, size=size, replace=False, p=popularity):
+            events.append({'study_program': programs[course_program[c]], 'course_id': str(2100000 + c), 'device_id': str(device)})
+        device += 1
+    return events[:n_events]
+
+
+def generate_observations(n_events: int, **kwargs) -> list[set]:
+    baskets = dict()
+    for e in generate_events(n_events, **kwargs):
+        baskets.setdefault(e['device_id'], set()).add((e['study_program'], e['course_id']))
+    return [b for b in baskets.values() if len(b) > 4]
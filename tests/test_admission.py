@@ -0,0 +1,75 @@
+import unittest
+import time
+from concurrent.futures import Future
+from cgrcompute.components.admission import AdmissionController, Ewma, RejectedError
+
+
+def _completed(controller, n):
+    for _ in range(n):
+        fut = controller.track(Future())
+        fut.set_result(None)
+
+
+class AdmissionControllerTest(unittest.TestCase):
+
+    def test_unlimited(self):
+        controller = AdmissionController()
+        controller.admit(1000, deadline=time.time() + 1)
+        self.assertIsNone(controller.estimated_wait())
+
+    def test_max_in_flight(self):
+        controller = AdmissionController(max_in_flight=2)
+        futures = [controller.track(Future()) for _ in range(2)]
+        with self.assertRaises(RejectedError) as cm:
+            controller.admit()
+        self.assertEqual('queue', cm.exception.reason)
+        futures[0].set_result(None)
+        controller.admit()
+
+    def test_batch_counts_every_request(self):
+        controller = AdmissionController(max_in_flight=3)
+        controller.admit(3)
+        self.assertRaises(RejectedError, lambda: controller.admit(4))
+        fut = controller.track(Future(), 3)
+        self.assertEqual(3, controller.in_flight)
+        fut.set_result(None)
+        self.assertEqual(0, controller.in_flight)
+
+    def test_estimated_wait(self):
+        controller = AdmissionController(window=10)
+        controller._created_at -= 10
+        _completed(controller, 20)
+        # 2 completions per second, so the next request waits for about half a second
+        self.assertAlmostEqual(0.5, controller.estimated_wait(), places=2)
+        pending = [controller.track(Future()) for _ in range(3)]
+        self.assertAlmostEqual(2, controller.estimated_wait(), places=2)
+        for fut in pending:
+            fut.cancel()
+        self.assertEqual(0, controller.in_flight)
+        self.assertAlmostEqual(0.5, controller.estimated_wait(), places=2)
+
+    def test_max_wait(self):
+        controller = AdmissionController(max_wait=0.1, window=10)
+        controller._created_at -= 10
+        _completed(controller, 20)
+        with self.assertRaises(RejectedError) as cm:
+            controller.admit()
+        self.assertEqual('wait', cm.exception.reason)
+
+    def test_deadline(self):
+        controller = AdmissionController(window=10)
+        controller._created_at -= 10
+        _completed(controller, 20)
+        controller.admit(deadline=time.time() + 1)
+        with self.assertRaises(RejectedError) as cm:
+            controller.admit(deadline=time.time() + 0.2)
+        self.assertEqual('deadline', cm.exception.reason)
+
+    def test_ewma(self):
+        avg = Ewma(1, alpha=0.5)
+        self.assertEqual(2, avg.update(3))
+        self.assertEqual(1.5, avg.update(1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+from cgrcompute.components.batching import MicroBatcher
+
+
+class MicroBatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ThreadPoolExecutor(max_workers=2)
+        self.batches = []
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def dispatch(self, items):
+        self.batches.append(items)
+        return self.pool.submit(lambda: [ValueError(i) if i < 0 else i * 2 for i in items])
+
+    def test_batch_and_resolve(self):
+        b = MicroBatcher(self.dispatch, max_batch_size=4, max_delay=0.5)
+        futures = [b.submit(i) for i in range(6)]
+        self.assertEqual([0, 2, 4, 6, 8, 10], [f.result(timeout=5) for f in futures])
+        self.assertEqual([[0, 1, 2, 3], [4, 5]], self.batches)
+        b.close()
+
+    def test_error_only_fails_its_item(self):
+        b = MicroBatcher(self.dispatch, max_delay=0.05)
+        ok, bad = b.submit(1), b.submit(-1)
+        self.assertEqual(2, ok.result(timeout=5))
+        self.assertRaises(ValueError, lambda: bad.result(timeout=5))
+        b.close()
+
+    def test_dispatch_failure(self):
+        def broken(items):
+            f = Future()
+            f.set_exception(RuntimeError('pool broken'))
+            return f
+        b = MicroBatcher(broken, max_delay=0.01)
+        self.assertRaises(RuntimeError, lambda: b.submit(1).result(timeout=5))
+        b.close()
+
+    def test_cancelled_items_are_not_dispatched(self):
+        b = MicroBatcher(self.dispatch, max_delay=0.2)
+        cancelled, kept = b.submit(1), b.submit(2)
+        cancelled.cancel()
+        self.assertEqual(4, kept.result(timeout=5))
+        self.assertEqual([[2]], self.batches)
+        b.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,18 @@
 import unittest
 from cgrcompute.components.courserecommendation import *
+import cgrcompute.components.courserecommendation as courserecommendation
 from math import sqrt
+import pickle
+import random
+import time
+import tempfile
+import os
 from unittest.mock import MagicMock, patch
 import cgrcompute.grpc.cgrcompute_pb2 as grpcmsg
+import numpy as np
+from scipy.sparse import csr_matrix
+from cgrcompute.components.neighbours import LSHNeighbours
+from tests.synthetic import generate_observations
 
 class CosineSimRecommendationModelTest(unittest.TestCase):
 
@@ -11,7 +21,7 @@ class CosineSimRecommendationModelTest(unittest.TestCase):
             'courseA': {'courseP': 0.1,  'courseQ': 0.2, 'courseR': 0.3},
             'courseB': {'courseP': 0.7, 'courseQ': 0.1}
         }
-        model = CosineSimRecommendationModel(ccvec)
+        model = CosineSimRecommendationModel.from_ccmtx(ccvec)
 
         res = model.infer(['courseA'])
         self.assertAlmostEqual(res['courseP'], 0.1)
@@ -27,13 +37,13 @@ class CosineSimRecommendationModelTest(unittest.TestCase):
         ccvec = {
             'courseA': dict(('course' + str(i), i) for i in range(50))
         }
-        model = CosineSimRecommendationModel(ccvec)
+        model = CosineSimRecommendationModel.from_ccmtx(ccvec)
         res = model.infer(['courseA'])
         for i in range(40, 50):
             self.assertIn(('course' + str(i), i), res.items())
 
     def test_infer_shouldIgnoreUnk(self):
-        model = CosineSimRecommendationModel({})
+        model = CosineSimRecommendationModel.from_ccmtx({})
         res = model.infer(['something'])
         self.assertEqual(res, {})
 
@@ -47,13 +57,98 @@ class CosineSimRecommendationModelTest(unittest.TestCase):
         self.assertAlmostEqual(model.ccmtx['c']['a'], 1 / sqrt(3))
         self.assertAlmostEqual(model.ccmtx['c']['c'], 1)
 
-class CourseRecommendationModelTest(unittest.TestCase):
+    def test_train_shouldMatchDenseCosine(self):
+        rng = random.Random(7)
+        obsv = [set(rng.sample(range(30), rng.randint(1, 8))) for _ in range(200)]
+        model = CosineSimRecommendationModel.train(obsv, k=10)
+        items = sorted(set(c for o in obsv for c in o))
+        for a in items:
+            expected = []
+            for b in items:
+                both = sum(1 for o in obsv if a in o and b in o)
+                if both:
+                    na = sum(1 for o in obsv if a in o)
+                    nb = sum(1 for o in obsv if b in o)
+                    expected.append(both / sqrt(na * nb))
+            expected = sorted(expected)[-10:]
+            got = sorted(model.ccmtx[a].values())
+            self.assertEqual(len(expected), len(got))
+            for e, g in zip(expected, got):
+                self.assertAlmostEqual(e, g)
 
-    def with_mocked_internalmodel(self, infer_result):
-        model = CourseRecommendationModel()
-        model.model = CosineSimRecommendationModel({})
-        model.model.infer = MagicMock(return_value=infer_result)
-        return model
+    def test_train_with_lsh_neighbours(self):
+        items, itemobsv = ['a', 'b', 'c'], csr_matrix(np.array([[1, 1, 1], [1, 1, 0], [0, 0, 1]], dtype=np.float64))
+        exact = CosineSimRecommendationModel.train_matrix(items, itemobsv)
+        approx = CosineSimRecommendationModel.train_matrix(items, itemobsv, neighbours=LSHNeighbours(bits=0, tables=1))
+        self.assertEqual(exact.ccmtx.keys(), approx.ccmtx.keys())
+        for c in items:
+            for (n, score) in exact.ccmtx[c].items():
+                self.assertAlmostEqual(score, approx.ccmtx[c][n], places=5)
+
+    def test_rank_should_sort_desc(self):
+        ccvec = {
+            'courseA': {'courseP': 0.1,  'courseQ': 0.2, 'courseR': 0.3},
+            'courseB': {'courseP': 0.7, 'courseQ': 0.2}
+        }
+        model = CosineSimRecommendationModel.from_ccmtx(ccvec)
+        res = model.rank(['courseA', 'courseB', 'unknown'], k=2)
+        self.assertEqual(['courseP', 'courseQ'], [c for c, _ in res])
+        self.assertAlmostEqual(res[0][1], 0.8)
+
+    def test_rank_batch_should_match_rank(self):
+        rng = random.Random(3)
+        obsv = [set(rng.sample(range(40), rng.randint(1, 8))) for _ in range(300)]
+        model = CosineSimRecommendationModel.train(obsv, k=15)
+        reqs = [rng.sample(range(45), rng.randint(0, 6)) for _ in range(20)]
+        for req, res in zip(reqs, model.rank_batch(reqs, k=10)):
+            expected = model.rank(req, k=10)
+            self.assertEqual(len(expected), len(res))
+            for (ec, es), (c, scr) in zip(expected, res):
+                self.assertAlmostEqual(es, scr, places=5)
+
+    def test_rank_only_allowed(self):
+        model = CosineSimRecommendationModel.from_ccmtx({'a': {'p': 0.1, 'q': 0.3, 'r': 0.2}})
+        allowed = np.array([c in ('a', 'p', 'r') for c in model.items])
+        self.assertEqual(['r', 'p'], [c for (c, _) in model.rank(['a'], allowed=allowed)])
+        self.assertEqual([['r', 'p'], ['q', 'r', 'p']], [[c for (c, _) in res] for res in model.rank_batch([['a'], ['a']], allowed=[allowed, None])])
+
+    def test_pickle_roundtrip(self):
+        model = CosineSimRecommendationModel.train([{'a', 'b'},  {'a', 'b'}, {'a', 'c'}])
+        res = pickle.loads(pickle.dumps(model))
+        self.assertEqual(model.ccmtx, res.ccmtx)
+        self.assertEqual(res.data.dtype, np.float32)
+
+    def test_load_legacy_ccmtx_pickle(self):
+        model = CosineSimRecommendationModel.__new__(CosineSimRecommendationModel)
+        model.__setstate__({'ccmtx': {'a': {'a': 1.0, 'b': 0.5}, 'b': {'b': 1.0, 'a': 0.5}}})
+        self.assertEqual({'a': {'a': 1.0, 'b': 0.5}, 'b': {'b': 1.0, 'a': 0.5}}, model.ccmtx)
+        self.assertAlmostEqual(model.infer(['a'])['b'], 0.5)
+
+class TopkRowsTest(unittest.TestCase):
+
+    def test_keep_largest_per_row(self):
+        m = csr_matrix(np.array([
+            [0.1, 0.5, 0.0, 0.3],
+            [0.0, 0.2, 0.0, 0.0],
+            [0.4, 0.0, 0.9, 0.8],
+        ]))
+        res = topk_rows(m, 2).toarray()
+        np.testing.assert_array_equal(res, np.array([
+            [0.0, 0.5, 0.0, 0.3],
+            [0.0, 0.2, 0.0, 0.0],
+            [0.0, 0.0, 0.9, 0.8],
+        ]))
+
+    def test_short_and_long_rows(self):
+        # Rows up to twice k long are partitioned together, longer ones one by one
+        rng = np.random.default_rng(0)
+        m = csr_matrix(rng.random((30, 40)) * (rng.random((30, 40)) < np.linspace(0, 1, 30)[:, None]))
+        res = topk_rows(m, 8).toarray()
+        for (row, kept) in zip(m.toarray(), res):
+            top = np.sort(row[row > 0])[::-1][:8]
+            np.testing.assert_array_equal(top, np.sort(kept[kept > 0])[::-1])
+
+class CourseRecommendationModelTest(unittest.TestCase):
 
     def test_downloadobsvdata(self):
 
@@ -66,37 +161,418 @@ class CourseRecommendationModelTest(unittest.TestCase):
             ]
             return mock
         model = CourseRecommendationModel()
-        res = model.downloadobsvdata(mock_es())
-        self.assertEqual(3, len(res))
+        items, itemobsv = model.downloadobsvdata(mock_es())
+        self.assertEqual(3, itemobsv.shape[1])
         expectedSet = set(('S', course_no) for course_no in ['21101', '21102', '21103', '21104', '21105'])
-        for s in res:
-            self.assertSetEqual(expectedSet, s)
+        self.assertSetEqual(expectedSet, set(items))
+        self.assertTrue((itemobsv.toarray() == 1).all())
+
+    def test_downloadobsvdata_filter_small_baskets(self):
+        mock = MagicMock()
+        mock.find_all_user_add_course.return_value = [
+            {'study_program': 'S', 'course_id': course_no, 'device_id': '1'}
+            for course_no in ['21101', '21102', '21103', '21104', '21105', '21101']
+        ] + [{'study_program': 'S', 'course_id': '21106', 'device_id': '2'}]
+        items, itemobsv = CourseRecommendationModel().downloadobsvdata(mock)
+        self.assertEqual(1, itemobsv.shape[1])
+        self.assertNotIn(('S', '21106'), items)
+        self.assertEqual(len(items), itemobsv.shape[0])
+        self.assertEqual(5, itemobsv.nnz)
 
     def test_infer_sorted(self):
-        model = self.with_mocked_internalmodel({
-                    ('S', 'test'): 0.1,
-                    ('S', 'test2'): 0.2
-                })
+        model = CourseRecommendationModel()
+        model.model = CosineSimRecommendationModel.from_ccmtx({})
+        model.model.rank = MagicMock(return_value=[(('S', 'test2'), 0.2), (('S', 'test'), 0.1)])
         res = model.infer([('S', 'ok')])
-        model.model.infer.assert_called_with([('S', 'ok')])
+        model.model.rank.assert_called_with([('S', 'ok')])
         self.assertListEqual([('S', 'test2'), ('S', 'test')], res)
 
+    def test_offered_mask_per_semester(self):
+        model = CourseRecommendationModel()
+        model.model = CosineSimRecommendationModel.from_ccmtx({('S', 'a'): {('S', 'b'): 0.5}, ('T', 'b'): {}})
+        offered = {'b': 'B'}
+        mask = model.offered_mask(offered)
+        self.assertEqual([False, True, True], mask.tolist())
+        self.assertIs(mask, model.offered_mask(offered))
+        self.assertIsNot(mask, model.offered_mask({'b': 'B'}))
+        self.assertNotIn('_offered_masks', pickle.loads(pickle.dumps(model)).__dict__)
+
     def test_random(self):
         model = CourseRecommendationModel()
-        model.model = CosineSimRecommendationModel({ 'test': [] })
+        model.model = CosineSimRecommendationModel.from_ccmtx({ 'test': [] })
         self.assertListEqual(['test'], model.random_infer())
 
+class ObservationBuilderTest(unittest.TestCase):
+
+    def test_build_should_match_basket_sets(self):
+        obsv = generate_observations(3000, n_courses=200, seed=3)
+        builder = ObservationBuilder()
+        for (dev, basket) in enumerate(obsv):
+            for item in basket:
+                builder.add(dev, item)
+                builder.add(dev, item)
+        items, itemobsv = builder.build()
+        baskets = [set(items[i] for i in col.indices) for col in itemobsv.T.tocsr()]
+        self.assertCountEqual([frozenset(b) for b in obsv], [frozenset(b) for b in baskets])
+
+    def test_build_empty(self):
+        items, itemobsv = ObservationBuilder().build()
+        self.assertEqual([], items)
+        self.assertEqual((0, 0), itemobsv.shape)
+
+
+class TimeDecayTest(unittest.TestCase):
+
+    def test_weights(self):
+        decay = TimeDecay(10, min_weight=0.25)
+        np.testing.assert_allclose([1, 1, 0.5, 0.25, 1], decay.weights(np.array([100, 110, 90, 80, np.nan]), 100))
+        self.assertAlmostEqual(20, decay.horizon())
+        self.assertAlmostEqual(80, decay.since(100))
+        self.assertIsNone(TimeDecay(10, min_weight=0).since(100))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, lambda: TimeDecay(0))
+        self.assertRaises(ValueError, lambda: TimeDecay(10, min_weight=1))
+
+    def test_builder(self):
+        builder = ObservationBuilder(min_basket=2, decay=TimeDecay(10, min_weight=0.2))
+        for (device, course_no, ts) in [('1', 'a', 80), ('1', 'a', 100), ('1', 'b', 90), ('1', 'c', 50),
+                ('2', 'a', 90), ('2', 'c', 60), ('3', 'a', None), ('3', 'b', 100)]:
+            builder.add(device, ('S', course_no), ts)
+        items, itemobsv = builder.build(now=100)
+        # c is too old everywhere, so device 2 is left with a single course and is dropped
+        self.assertEqual([('S', 'a'), ('S', 'b')], items)
+        np.testing.assert_allclose([[1, 1], [0.5, 1]], itemobsv.toarray())
+
+    def test_encoded_timestamps(self):
+        events = [('1', ('S', 'a'), 100), ('1', ('S', 'b'), 90), ('2', ('S', 'a'), 80), ('2', ('T', 'b'), 100), ('2', ('S', 'b'), 100)]
+        devices = sorted(set(d for (d, _, _) in events))
+        items = sorted(set(i for (_, i, _) in events))
+        expected = ShardedObservationBuilder(min_basket=1, decay=TimeDecay(10))
+        encoded = ShardedObservationBuilder(min_basket=1, decay=TimeDecay(10))
+        for (d, item, ts) in events:
+            expected.add(d, item, ts)
+        encoded.add_encoded(devices, items,
+            np.array([devices.index(d) for (d, _, _) in events], dtype=np.int32),
+            np.array([items.index(i) for (_, i, _) in events], dtype=np.int32),
+            np.array([ts for (_, _, ts) in events], dtype=np.float64))
+        for program in 'ST':
+            np.testing.assert_allclose(expected.shards[program].build(now=100)[1].toarray(), encoded.shards[program].build(now=100)[1].toarray())
+        np.testing.assert_allclose([[1, 0.25], [0.5, 1]], encoded.shards['S'].build(now=100)[1].toarray())
+
+    def test_training_reads_only_the_horizon(self):
+        now = time.time()
+        es = MagicMock()
+        es.find_all_user_add_course.return_value = [{'study_program': 'S', 'course_id': c, 'device_id': '1', 'timestamp': now} for c in 'abcde']
+        model = CourseRecommendationModel()
+        items, itemobsv = model.downloadobsvdata(es, decay=TimeDecay(86400, min_weight=0.5))
+        self.assertAlmostEqual(now - 86400, es.find_all_user_add_course.call_args[1]['since'], delta=60)
+        self.assertEqual(5, itemobsv.nnz)
+        with tempfile.TemporaryDirectory() as d:
+            log = EventLog(d)
+            log.append([{'study_program': 'S', 'course_id': c, 'device_id': dev, 'timestamp': ts}
+                for (dev, ts) in [('new', now), ('old', now - 5 * 86400)] for c in 'abcde'])
+            builder = ObservationBuilder(decay=TimeDecay(86400, min_weight=0.25))
+            self.assertEqual(5, read_event_log(log, builder))
+            self.assertEqual(10, read_event_log(log, ObservationBuilder()))
+
+class ShardedObservationBuilderTest(unittest.TestCase):
+
+    def test_shards_match_per_program_builders(self):
+        rng = random.Random(3)
+        events = [(str(rng.randrange(30)), (rng.choice('ST'), str(rng.randrange(20)))) for _ in range(1500)]
+        sharded = ShardedObservationBuilder()
+        encoded = ShardedObservationBuilder(study_programs=['T'])
+        for (d, item) in events:
+            sharded.add(d, item)
+        devices = sorted(set(d for (d, _) in events))
+        items = sorted(set(i for (_, i) in events))
+        encoded.add_encoded(devices, items,
+            np.array([devices.index(d) for (d, _) in events], dtype=np.int32),
+            np.array([items.index(i) for (_, i) in events], dtype=np.int32))
+        self.assertEqual(['S', 'T'], sorted(sharded.shards))
+        self.assertEqual(['T'], list(encoded.shards))
+        for program in 'ST':
+            expected = ObservationBuilder()
+            for (d, item) in events:
+                if item[0] == program:
+                    expected.add(d, item)
+            for b in [sharded.shards[program]] + ([encoded.shards[program]] if program == 'T' else []):
+                items, itemobsv = b.build()
+                expected_items, expected_obsv = expected.build()
+                self.assertEqual(sorted(expected_items), sorted(items))
+                self.assertEqual(expected_obsv.shape, itemobsv.shape)
+                self.assertEqual(expected_obsv.nnz, itemobsv.nnz)
+
+class CooccurrenceStateTest(unittest.TestCase):
+
+    def events(self, n, seed=1):
+        rng = random.Random(seed)
+        return [{'study_program': 'S', 'course_id': str(rng.randint(0, 40)), 'device_id': str(rng.randint(0, 150)), 'timestamp': i} for i in range(n)]
+
+    def assertSameModel(self, expected, res):
+        expected, res = expected.ccmtx, res.ccmtx
+        self.assertEqual(set(expected), set(res))
+        for c in expected:
+            self.assertEqual(set(expected[c]), set(res[c]))
+            for n in expected[c]:
+                self.assertAlmostEqual(expected[c][n], res[c][n], places=6)
+
+    def test_incremental_matches_full_training(self):
+        events = self.events(3000)
+        state = CooccurrenceState()
+        for start in range(0, 3000, 700):
+            state.add_events(events[start:start + 700])
+            model = state.model()
+        baskets = dict()
+        for e in events:
+            baskets.setdefault(e['device_id'], set()).add((e['study_program'], e['course_id']))
+        baskets = [b for b in baskets.values() if len(b) > 4]
+        self.assertSameModel(CosineSimRecommendationModel.train(baskets), model)
+        self.assertEqual(len(baskets), state.observation_count)
+        self.assertEqual(2999, state.watermark)
+
+    def test_only_recompute_affected_rows(self):
+        base = [{'study_program': 'S', 'course_id': c, 'device_id': d} for d in '12' for c in 'abcde'] + \
+            [{'study_program': 'S', 'course_id': c, 'device_id': '3'} for c in 'vwxyz']
+        state = CooccurrenceState()
+        state.add_events(base)
+        state.model()
+        state.add_events([{'study_program': 'S', 'course_id': 'f', 'device_id': '1'}])
+        self.assertEqual(set(('S', c) for c in 'abcdef'), set(state.items[i] for i in state.changed))
+        model = state.model()
+        self.assertAlmostEqual(model.ccmtx[('S', 'a')][('S', 'f')], 1 / sqrt(2), places=6)
+        self.assertAlmostEqual(model.ccmtx[('S', 'v')][('S', 'z')], 1)
+
+    def test_state_survives_mapping(self):
+        events = self.events(2000, seed=5)
+        state = CooccurrenceState()
+        state.add_events(events[:1000])
+        state.model()
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'state')
+            dump_mapped(state, path)
+            restored = load_mapped(path)
+            restored.add_events(events[1000:])
+            state.add_events(events[1000:])
+            self.assertSameModel(state.model(), restored.model())
+
+    def test_unreadable_state_starts_over(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'state')
+            dump_mapped(CooccurrenceState(), path)
+            for error in (AttributeError('CooccurrenceState has no attribute'), pickle.UnpicklingError(), EOFError()):
+                with patch('cgrcompute.components.courserecommendation.load_mapped', side_effect=error):
+                    self.assertIsInstance(load_state(path, ShardedCooccurrenceState), ShardedCooccurrenceState)
+
+class ShardedCooccurrenceStateTest(unittest.TestCase):
+
+    def test_only_changed_shards(self):
+        state = ShardedCooccurrenceState()
+        state.add_events([{'study_program': p, 'course_id': c, 'device_id': p + d, 'timestamp': 10}
+            for p in 'ST' for d in '12' for c in 'abcde'])
+        self.assertEqual(['S', 'T'], sorted(state.changed()))
+        for program in 'ST':
+            state.shards[program].model()
+        self.assertEqual([], state.changed())
+        state.add_events([{'study_program': 'T', 'course_id': 'f', 'device_id': 'T1', 'timestamp': 20}])
+        self.assertEqual(['T'], state.changed())
+        self.assertEqual(20, state.watermark)
+        self.assertEqual([('T', c) for c in 'abcdef'], state.shards['T'].items)
+
+class IncrementalRefreshTest(unittest.TestCase):
+
+    def setUp(self):
+        self.patch_es = patch('cgrcompute.components.courserecommendation.ElasticService')
+        self.es = self.patch_es.start()
+        courserecommendation.incremental_state = None
+
+    def tearDown(self):
+        self.patch_es.stop()
+
+    def test_fetch_since_watermark(self):
+        first = [{'study_program': 'S', 'course_id': c, 'device_id': '1', 'timestamp': 10} for c in 'abcde']
+        self.es.return_value.find_all_user_add_course.return_value = first
+        with tempfile.TemporaryDirectory() as d:
+            model = get_incremental_course_recommendation_model(d)
+            self.es.return_value.find_all_user_add_course.assert_called_with(since=None)
+            self.assertEqual(1, model.observation_count)
+            self.es.return_value.find_all_user_add_course.return_value = [{'study_program': 'S', 'course_id': 'f', 'device_id': '1', 'timestamp': 20}]
+            model = get_incremental_course_recommendation_model(d)
+            self.es.return_value.find_all_user_add_course.assert_called_with(since=10)
+            self.assertIn(('S', 'f'), model.model.ccmtx[('S', 'a')])
+            # A restarted process continues from the saved state
+            courserecommendation.incremental_state = None
+            self.es.return_value.find_all_user_add_course.return_value = []
+            get_incremental_course_recommendation_model(d)
+            self.es.return_value.find_all_user_add_course.assert_called_with(since=20)
+
+    def test_failure_drops_state(self):
+        def broken(since):
+            yield {'study_program': 'S', 'course_id': 'a', 'device_id': '1', 'timestamp': 10}
+            raise ConnectionError()
+        self.es.return_value.find_all_user_add_course.side_effect = broken
+        self.assertRaises(ConnectionError, get_incremental_course_recommendation_model)
+        self.assertIsNone(courserecommendation.incremental_state)
+
+class EventLogTrainingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.patch_es = patch('cgrcompute.components.courserecommendation.ElasticService')
+        self.es = self.patch_es.start()
+        self.dir = tempfile.TemporaryDirectory()
+        courserecommendation.incremental_state = None
+
+    def tearDown(self):
+        self.patch_es.stop()
+        self.dir.cleanup()
+
+    def test_same_model_as_elastic(self):
+        events = [{'study_program': 'S', 'course_id': c, 'device_id': str(d), 'timestamp': 1000 - d}
+            for d in range(20) for c in random.Random(d).sample('abcdefghij', 6)]
+        self.es.return_value.find_all_user_add_course.return_value = events
+        expected = get_course_recommendation_model()
+        log = sync_event_log(self.dir.name)
+        model = get_course_recommendation_model(log=log)
+        self.assertEqual(expected.observation_count, model.observation_count)
+        self.assertEqual(expected.model.ccmtx, model.model.ccmtx)
+
+    def test_train_from_cache_when_elastic_is_down(self):
+        self.es.return_value.find_all_user_add_course.return_value = [
+            {'study_program': 'S', 'course_id': c, 'device_id': '1', 'timestamp': 10} for c in 'abcde']
+        sync_event_log(self.dir.name)
+        self.es.return_value.find_all_user_add_course.side_effect = ConnectionError()
+        for incremental in (False, True):
+            cache = MagicMock()
+            self.assertEqual(5, refresh_course_recommendation_model(cache, incremental=incremental, event_log_directory=self.dir.name))
+
+class CourseRecommendationSnapshotTest(unittest.TestCase):
+
+    def test_refresh_and_restore(self):
+        trained = CourseRecommendationModel()
+        trained.model = CosineSimRecommendationModel.train([{'a', 'b'},  {'a', 'b'}, {'a', 'c'}])
+        trained.trained_at = 1234.0
+        trained.observation_count = 3
+        cache = MagicMock()
+        with tempfile.TemporaryDirectory() as d, patch('cgrcompute.components.courserecommendation.get_course_recommendation_model') as p:
+            p.return_value = trained
+            refresh_course_recommendation_model(cache, d)
+            cache.update.assert_called_with(MODEL_KEY, trained)
+            restored = MagicMock()
+            header = load_course_recommendation_snapshot(restored, d)
+        self.assertEqual({'trained_at': 1234.0, 'observation_count': 3, 'item_count': 3, 'format': 1}, header)
+        key, model = restored.update.call_args[0]
+        self.assertEqual(MODEL_KEY, key)
+        self.assertEqual(trained.model.ccmtx, model.model.ccmtx)
+        self.assertEqual(['b', 'c'], sorted(model.infer(['a'])[1:]))
+
+class ShardedRefreshTest(unittest.TestCase):
+
+    def setUp(self):
+        self.patch_es = patch('cgrcompute.components.courserecommendation.ElasticService')
+        self.es = self.patch_es.start()
+        self.es.return_value.find_all_user_add_course.return_value = [
+            {'study_program': p, 'course_id': p + c, 'device_id': d, 'timestamp': 10}
+            for p in 'ST' for d in '12' for c in 'abcde']
+        courserecommendation.incremental_shard_state = None
+
+    def tearDown(self):
+        self.patch_es.stop()
+
+    def published(self, cache):
+        return dict((c[0][0], c[0][1]) for c in cache.update.call_args_list)
+
+    def test_full(self):
+        cache = MagicMock()
+        self.assertEqual(10, refresh_course_recommendation_model(cache, shard_by_program=True))
+        models = self.published(cache)
+        self.assertEqual([MODEL_KEY, shard_key('S'), shard_key('T')], sorted(models))
+        self.assertEqual([('S', c) for c in ['Sb', 'Sc', 'Sd', 'Se']], sorted(models[shard_key('S')].infer([('S', 'Sa')])[1:]))
+        # Requests without a study program are served by the union of the shards
+        fallback = models[MODEL_KEY]
+        self.assertEqual(10, len(fallback.model))
+        self.assertEqual(models[shard_key('S')].infer([('S', 'Sa')]), fallback.infer([('S', 'Sa')]))
+        self.assertEqual(models[shard_key('T')].infer([('T', 'Tb')]), fallback.infer([('T', 'Tb')]))
+        self.assertEqual(4, fallback.observation_count)
+        cache = MagicMock()
+        refresh_course_recommendation_model(cache, shard_by_program=True, study_programs=['T'])
+        self.assertEqual([MODEL_KEY, shard_key('T')], sorted(self.published(cache)))
+
+    def test_incremental_and_restore(self):
+        with tempfile.TemporaryDirectory() as d:
+            cache = MagicMock()
+            refresh_course_recommendation_model(cache, d, incremental=True, shard_by_program=True)
+            self.assertEqual([MODEL_KEY, shard_key('S'), shard_key('T')], sorted(self.published(cache)))
+            self.es.return_value.find_all_user_add_course.return_value = [{'study_program': 'T', 'course_id': 'Tf', 'device_id': '1', 'timestamp': 20}]
+            published = self.published(cache)
+            cache = MagicMock()
+            cache.shared_cache = published
+            cache.get.side_effect = published.__getitem__
+            self.assertEqual(6, refresh_course_recommendation_model(cache, d, incremental=True, shard_by_program=True))
+            # Only the changed shard, and the fallback over it and the unchanged one
+            self.assertEqual([MODEL_KEY, shard_key('T')], sorted(self.published(cache)))
+            self.assertEqual(11, len(self.published(cache)[MODEL_KEY].model))
+            restored = MagicMock()
+            header = load_course_recommendation_snapshot(restored, d, shard_by_program=True)
+        self.assertEqual(2, header['shards'])
+        self.assertEqual(11, header['item_count'])
+        models = self.published(restored)
+        self.assertEqual([MODEL_KEY, shard_key('S'), shard_key('T')], sorted(models))
+        self.assertEqual(6, len(models[shard_key('T')].model))
+        self.assertEqual(11, len(models[MODEL_KEY].model))
+
+    def test_popular_semesters(self):
+        with patch('cgrcompute.components.courserecommendation.get_mongo_service') as mongo:
+            mongo.return_value.get_recent_semesters.return_value = [('2565', '1')]
+            mongo.return_value.get_semester_courses.side_effect = lambda semester, study_program, academic_year: {'Sa': 'A', 'Sc': 'C', 'Sz': 'Z', 'Ta': None}
+            cache = MagicMock()
+            refresh_course_recommendation_model(cache, shard_by_program=True, popular_semesters=1)
+            models = self.published(cache)
+            mongo.return_value.get_recent_semesters.assert_called_once_with(1)
+            self.assertEqual((['Sa', 'Sc'], {'Sa': 'A', 'Sc': 'C'}), models[shard_key('S')].precomputed(('S', '1', '2565')))
+            self.assertEqual(([], {}), models[shard_key('T')].precomputed(('T', '1', '2565')))
+            self.assertIsNone(models[shard_key('S')].precomputed(('S', '2', '2565')))
+            self.assertEqual(models[shard_key('S')].precomputed(('S', '1', '2565')), models[MODEL_KEY].precomputed(('S', '1', '2565')))
+            # Training still publishes its models when Mongo is down
+            mongo.return_value.get_recent_semesters.side_effect = RuntimeError('unreachable')
+            cache = MagicMock()
+            refresh_course_recommendation_model(cache, shard_by_program=True, popular_semesters=1)
+            self.assertIsNone(self.published(cache)[shard_key('S')].precomputed(('S', '1', '2565')))
+
+    def test_get_model_prefers_shard(self):
+        cache = MagicMock()
+        cache.get.side_effect = lambda key: {shard_key('S'): 'S model', MODEL_KEY: 'global'}[key]
+        self.assertEqual('S model', get_model(cache, 'S'))
+        self.assertEqual('global', get_model(cache, 'T'))
+        cache.get.side_effect = lambda key: {shard_key('S'): 'S model'}[key]
+        self.assertRaises(ModelNotReadyError, lambda: get_model(cache, 'T'))
+
+    def test_warm_up_worker_maps_every_model(self):
+        cache = MagicMock()
+        refresh_course_recommendation_model(cache, shard_by_program=True)
+        models = self.published(cache)
+        models['other'] = None
+        cache.shared_cache = models
+        cache.get.side_effect = models.__getitem__
+        warm_up_worker(cache)
+        self.assertEqual([MODEL_KEY, shard_key('S'), shard_key('T')], sorted(c[0][0] for c in cache.get.call_args_list))
+        cache.get.side_effect = RuntimeError('manager is gone')
+        warm_up_worker(cache)
+
 class RecommendCourseTest(unittest.TestCase):
 
     def setUp(self):
         self.patch_mongo = patch('cgrcompute.components.courserecommendation.get_mongo_service')
         self.mongo = self.patch_mongo.start()
-        self.mongo.return_value.get_course_abbr.return_value = 'HELLO'
+        self.mongo.return_value.get_course_abbrs.side_effect = lambda course_nos, **kwargs: dict((c, 'HELLO') for c in course_nos)
+        self.mongo.return_value.cached_course_abbrs.return_value = {}
+        self.mongo.return_value.preload = False
         self.rec = MagicMock()
         self.rec.infer.return_value = [('S', '1g'), ('S', '2g')]
         self.rec.random_infer.return_value = [('A', '1k'), ('A', '2k')]
+        self.rec.precomputed.return_value = None
         self.cache = MagicMock()
-        self.cache.get_or_create.return_value = self.rec
+        self.cache.get.return_value = self.rec
 
     def tearDown(self):
         self.patch_mongo.stop()
@@ -129,18 +605,189 @@ class RecommendCourseTest(unittest.TestCase):
         c.semesterKey.CopyFrom(req.semesterKey)
         res = recommend_course(req, self.cache)
         self.assertEqual(res.courses[0].key.courseNo, '2g')
+        self.mongo.return_value.get_course_abbrs.assert_called_once_with(['2g'], semester='0', study_program='T', academic_year='Y')
 
     def test_infer_fitered(self):
         req = grpcmsg.CourseRecommendationRequest()
         req.variant = 'COSINE'
         req.semesterKey.studyProgram = 'T'
         req.semesterKey.semester = '0'
-        self.mongo.return_value.get_course_abbr.side_effect = [None, 'TEST']
+        self.mongo.return_value.get_course_abbrs.side_effect = lambda course_nos, **kwargs: {'1g': None, '2g': 'TEST'}
         res = recommend_course(req, self.cache)
         self.assertEqual(res.courses[0].courseNameEn, 'TEST')
         self.assertEqual(res.courses[0].key.courseNo, '2g')
         self.assertEqual(len(res.courses), 1)
 
+    def test_model_not_ready(self):
+        self.cache.get.side_effect = KeyError('recommend_course_model')
+        req = grpcmsg.CourseRecommendationRequest()
+        req.variant = 'COSINE'
+        self.assertRaises(ModelNotReadyError, lambda: recommend_course(req, self.cache))
+
+    def test_batch(self):
+        self.rec.infer_batch.return_value = [[('S', '1g'), ('S', '2g')], [('S', '2g')]]
+        reqs = []
+        for variant in ['COSINE', 'RANDOM', 'BAD', 'COSINE']:
+            req = grpcmsg.CourseRecommendationRequest()
+            req.variant = variant
+            req.semesterKey.studyProgram = 'T'
+            req.semesterKey.semester = '0'
+            reqs.append(req)
+        c = reqs[3].selectedCourses.add()
+        c.courseNo = '1g'
+        res = recommend_course_batch(reqs, self.cache)
+        self.assertEqual(['1g', '2g'], [c.key.courseNo for c in res[0].courses])
+        self.assertEqual(['1k', '2k'], [c.key.courseNo for c in res[1].courses])
+        self.assertIsInstance(res[2], Exception)
+        self.assertEqual(['2g'], [c.key.courseNo for c in res[3].courses])
+        self.rec.infer_batch.assert_called_once_with([[], [('', '1g')]])
+        # One name lookup for the whole batch
+        self.assertEqual(1, self.mongo.return_value.get_course_abbrs.call_count)
+
+    def test_batch_failures_stay_with_their_requests(self):
+        self.mongo.return_value.preload = True
+        def semester_courses(semester, **kwargs):
+            if semester == '2':
+                raise ConnectionError('offered courses')
+            return None
+        def abbrs(course_nos, semester, **kwargs):
+            if semester == '1':
+                raise ConnectionError('names')
+            return dict((c, 'HELLO') for c in course_nos)
+        def infer(keys, offered=None):
+            if keys:
+                raise ValueError('bad selection')
+            return [('S', '1g'), ('S', '2g')]
+        self.mongo.return_value.get_semester_courses.side_effect = semester_courses
+        self.mongo.return_value.get_course_abbrs.side_effect = abbrs
+        self.rec.infer_batch.side_effect = RuntimeError('batch')
+        self.rec.infer.side_effect = infer
+        reqs = [grpcmsg.CourseRecommendationRequest(variant='COSINE') for _ in range(4)]
+        for (r, semester) in zip(reqs, '0012'):
+            r.semesterKey.studyProgram = 'T'
+            r.semesterKey.semester = semester
+        reqs[1].selectedCourses.add().courseNo = '1g'
+        res = recommend_course_batch(reqs, self.cache)
+        self.assertEqual(['1g', '2g'], [c.key.courseNo for c in res[0].courses])
+        self.assertIsInstance(res[1], ValueError)
+        self.assertIsInstance(res[2], ConnectionError)
+        self.assertIsInstance(res[3], ConnectionError)
+
+    def test_offered_prefilter(self):
+        model = CourseRecommendationModel()
+        model.model = CosineSimRecommendationModel.from_ccmtx({('T', 'a'): {('T', 'x'): 0.9, ('T', 'y'): 0.5, ('T', 'z'): 0.1}})
+        self.cache.get.return_value = model
+        self.mongo.return_value.preload = True
+        self.mongo.return_value.get_semester_courses.return_value = {'a': 'A', 'y': 'Y', 'z': 'Z'}
+        req = grpcmsg.CourseRecommendationRequest()
+        req.variant = 'COSINE'
+        req.semesterKey.studyProgram = 'T'
+        req.semesterKey.semester = '1'
+        req.semesterKey.academicYear = '2565'
+        c = req.selectedCourses.add()
+        c.courseNo = 'a'
+        c.semesterKey.CopyFrom(req.semesterKey)
+        res = recommend_course(req, self.cache)
+        self.assertEqual(['y', 'z'], [c.key.courseNo for c in res.courses])
+        self.mongo.return_value.get_course_abbrs.assert_called_once_with(['y', 'z'], semester='1', study_program='T', academic_year='2565')
+        self.cache.get.assert_called_with(shard_key('T'))
+        res = recommend_course_batch([req, req], self.cache)
+        self.assertEqual([['y', 'z']] * 2, [[c.key.courseNo for c in r.courses] for r in res])
+        self.mongo.return_value.get_semester_courses.assert_called_with(semester='1', study_program='T', academic_year='2565')
+
+    def test_expired_deadline(self):
+        self.rec.infer_batch.return_value = [[('S', '1g')]]
+        req = grpcmsg.CourseRecommendationRequest(variant='COSINE')
+        self.assertRaises(DeadlineExceededError, lambda: recommend_course_serialized(req.SerializeToString(), self.cache, deadline=time.time() - 1))
+        self.cache.get.assert_not_called()
+        res = recommend_course_batch([req, req], self.cache, [time.time() - 1, time.time() + 60])
+        self.assertIsInstance(res[0], DeadlineExceededError)
+        self.assertEqual('1g', res[1].courses[0].key.courseNo)
+        self.rec.infer_batch.assert_called_once_with([[]])
+
+    def test_degraded_when_enrichment_misses_deadline(self):
+        model = CourseRecommendationModel()
+        model.model = CosineSimRecommendationModel.from_ccmtx({('T', 'a'): {('T', 'x'): 0.9, ('T', 'y'): 0.5}, ('T', 'b'): {('T', 'x'): 0.5}, ('T', 'x'): {}, ('T', 'y'): {}})
+        self.cache.get.return_value = model
+        self.mongo.return_value.cached_course_abbrs.side_effect = lambda course_nos, **kwargs: dict((c, 'CACHED') for c in course_nos if c in ('a', 'x'))
+        req = grpcmsg.CourseRecommendationRequest(variant='COSINE')
+        req.semesterKey.studyProgram = 'T'
+        c = req.selectedCourses.add()
+        c.courseNo = 'a'
+        c.semesterKey.CopyFrom(req.semesterKey)
+        with patch.object(courserecommendation.enrichment_seconds, 'value', 10):
+            res = recommend_course(req, self.cache, deadline=time.time() + 1)
+            # Only courses with a cached name, and never the selected one
+            self.assertEqual(['x'], [c.key.courseNo for c in res.courses])
+            self.assertTrue(res.degraded)
+            self.mongo.return_value.get_course_abbrs.assert_not_called()
+            res = recommend_course(req, self.cache, deadline=time.time() + 60)
+        self.assertFalse(res.degraded)
+        self.assertEqual([('x', 'CACHED'), ('y', 'HELLO')], [(c.key.courseNo, c.courseNameEn) for c in res.courses])
+        self.mongo.return_value.get_course_abbrs.assert_called_once_with(['y'], semester='', study_program='T', academic_year='')
+
+    def test_cached_names_skip_mongo(self):
+        self.mongo.return_value.cached_course_abbrs.side_effect = lambda course_nos, **kwargs: dict((c, 'CACHED') for c in course_nos)
+        req = grpcmsg.CourseRecommendationRequest(variant='COSINE')
+        res = recommend_course(req, self.cache, deadline=time.time() - 1)
+        self.assertEqual('CACHED', res.courses[0].courseNameEn)
+        self.mongo.return_value.get_course_abbrs.assert_not_called()
+
+    def precomputed_model(self):
+        model = CourseRecommendationModel()
+        model.model = CosineSimRecommendationModel.from_ccmtx({('T', 'a'): {('T', 'b'): 0.9}, ('T', 'b'): {('T', 'a'): 0.9}})
+        model.popular_courses = {('T', '1', '2565'): (['c', 'a', 'b'], {'a': 'A', 'b': 'B', 'c': 'C'})}
+        self.cache.get.return_value = model
+        return model
+
+    def cold_requests(self):
+        reqs = []
+        for (variant, course_nos) in [('RANDOM', []), ('COSINE', []), ('COSINE', ['c', 'x'])]:
+            req = grpcmsg.CourseRecommendationRequest(variant=variant)
+            req.semesterKey.studyProgram = 'T'
+            req.semesterKey.semester = '1'
+            req.semesterKey.academicYear = '2565'
+            for course_no in course_nos:
+                c = req.selectedCourses.add()
+                c.courseNo = course_no
+                c.semesterKey.CopyFrom(req.semesterKey)
+            reqs.append(req)
+        return reqs
+
+    def test_precomputed(self):
+        self.precomputed_model()
+        self.mongo.return_value.preload = True
+        (rand, empty, unknown) = self.cold_requests()
+        res = recommend_course(rand, self.cache)
+        self.assertEqual(['a', 'b', 'c'], sorted(c.key.courseNo for c in res.courses))
+        self.assertEqual(['C', 'A', 'B'], [c.courseNameEn for c in recommend_course(empty, self.cache).courses])
+        self.assertEqual(['a', 'b'], [c.key.courseNo for c in recommend_course(unknown, self.cache).courses])
+        res = recommend_course_batch([rand, empty, unknown], self.cache)
+        self.assertEqual([3, 3, 2], [len(r.courses) for r in res])
+        self.mongo.return_value.get_semester_courses.assert_not_called()
+        self.mongo.return_value.get_course_abbrs.assert_not_called()
+        self.mongo.return_value.cached_course_abbrs.assert_not_called()
+
+    def test_cold_start_without_table(self):
+        model = self.precomputed_model()
+        model.popular_courses = dict()
+        model.model.counts = np.array([1, 2], dtype=np.float32)
+        (rand, empty, unknown) = self.cold_requests()
+        self.assertEqual(['b', 'a'], [c.key.courseNo for c in recommend_course(empty, self.cache).courses])
+        self.assertEqual([['b', 'a']], [[c.key.courseNo for c in r.courses] for r in recommend_course_batch([empty], self.cache)])
+        # A known course is scored as usual
+        known = self.cold_requests()[2]
+        known.selectedCourses[0].courseNo = 'a'
+        self.assertEqual(['b'], [c.key.courseNo for c in recommend_course(known, self.cache).courses])
+
+    def test_batch_serialized(self):
+        req = grpcmsg.CourseRecommendationRequest()
+        req.variant = 'RANDOM'
+        res = recommend_course_batch_serialized([req.SerializeToString()], self.cache)
+        parsed = grpcmsg.CourseRecommendationResponse()
+        parsed.ParseFromString(res[0])
+        self.assertEqual('1k', parsed.courses[0].key.courseNo)
+
     def test_serialize(self):
         with patch('cgrcompute.components.courserecommendation.recommend_course') as p:
             p.return_value = grpcmsg.CourseRecommendationResponse()
@@ -0,0 +1,66 @@
+import unittest
+import numpy as np
+from scipy.sparse import csr_matrix
+from cgrcompute.components.courserecommendation import CosineSimRecommendationModel, ObservationBuilder
+from cgrcompute.components.evaluation import evaluate, hide_items, ranking_metrics, split_baskets
+from tests.synthetic import generate_observations
+
+
+class EvaluationTest(unittest.TestCase):
+
+    def test_split_baskets(self):
+        itemobsv = csr_matrix(np.random.default_rng(0).random((20, 100)) > 0.5)
+        train, test = split_baskets(itemobsv, 0.3)
+        self.assertEqual((20, 100), (train.shape[0], train.shape[1] + test.shape[0]))
+        self.assertEqual(20, test.shape[1])
+        self.assertEqual(itemobsv.nnz, train.nnz + test.nnz)
+
+    def test_hide_items(self):
+        baskets = csr_matrix(np.array([
+            [1, 1, 1, 0],
+            [1, 0, 0, 0],
+            [0, 0, 1, 1],
+            [1, 1, 0, 1],
+        ]))
+        known = np.array([True, True, False, False])
+        selected, hidden, used = hide_items(baskets, known, n_hidden=2)
+        # Nothing can be hidden from a single item basket or one without known items
+        self.assertEqual([0, 3], used.tolist())
+        self.assertEqual([2, 2], np.diff(hidden.indptr).tolist())
+        self.assertFalse(hidden[:, 2:].nnz)
+        np.testing.assert_array_equal(baskets[used].toarray(), (selected + hidden).toarray())
+
+    def test_ranking_metrics(self):
+        recommended = np.array([
+            [3, 1, 2],
+            [0, 2, -1],
+        ])
+        hidden = csr_matrix(np.array([
+            [0, 1, 0, 0],
+            [1, 0, 0, 1],
+        ]))
+        m = ranking_metrics(recommended, hidden, 2, 8)
+        self.assertEqual(1, m['hit_rate'])
+        self.assertAlmostEqual((1 + 0.5) / 2, m['recall'])
+        self.assertAlmostEqual((1 / np.log2(3) + 1 / (1 + 1 / np.log2(3))) / 2, m['ndcg'])
+        self.assertAlmostEqual(4 / 8, m['coverage'])
+
+    def test_evaluate_synthetic(self):
+        builder = ObservationBuilder()
+        for (dev, basket) in enumerate(generate_observations(20000, n_courses=300)):
+            for item in basket:
+                builder.add(dev, item)
+        items, itemobsv = builder.build()
+        train, test = split_baskets(itemobsv, 0.2)
+        model = CosineSimRecommendationModel.train_matrix(items, train)
+        selected, hidden, _ = hide_items(test, np.asarray(train.sum(axis=1)).ravel() > 0)
+        res = evaluate(model, selected, hidden, [1, 10], batch_size=16)
+        at1, at10 = res['metrics']
+        self.assertEqual(selected.shape[0], at10['baskets'])
+        self.assertLessEqual(at1['recall'], at10['recall'])
+        self.assertGreater(at10['hit_rate'], 0)
+        self.assertGreater(res['baskets_per_s'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
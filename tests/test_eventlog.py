@@ -0,0 +1,113 @@
+import unittest
+import os
+import shutil
+import tempfile
+from unittest.mock import MagicMock, patch
+from cgrcompute.components.eventlog import EventLog
+
+DAY = 86400
+
+
+def event(device, course, ts, program='S'):
+    return {'study_program': program, 'course_id': course, 'device_id': device, 'timestamp': ts}
+
+
+class EventLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.log = EventLog(self.dir.name)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_partition_by_day(self):
+        self.log.append([event('1', 'a', 10), event('2', 'b', DAY + 10), event('1', 'b', 20)])
+        self.assertEqual(['1970-01-02', '1970-01-01'], self.log.partitions())
+        cols = self.log.read('1970-01-01')
+        self.assertEqual([20.0, 10.0], cols['timestamp'].tolist())
+        self.assertEqual(['1', '1'], cols['devices'][cols['device']].tolist())
+        self.assertEqual(['b', 'a'], cols['course_ids'][cols['item']].tolist())
+        self.assertEqual(3, len(self.log))
+        self.assertEqual(DAY + 10, self.log.watermark())
+
+    def test_merge_drops_duplicates(self):
+        self.log.append([event('1', 'a', 10), event('2', 'b', 20)])
+        self.log.append([event('2', 'b', 20), event('3', 'c', 30, program='T')])
+        self.assertEqual(3, len(self.log))
+        self.assertEqual(['1970-01-01'], os.listdir(self.dir.name))
+        self.assertEqual([
+            event('1', 'a', 10.0),
+            event('2', 'b', 20.0),
+            event('3', 'c', 30.0, program='T'),
+        ], list(self.log.events()))
+        self.assertEqual([event('3', 'c', 30.0, program='T')], list(self.log.events(since=25)))
+
+    def test_merge_each_day_once(self):
+        events = [event(str(i), 'a', (i % 2) * DAY + i) for i in range(10)]
+        with patch.object(EventLog, '_merge', autospec=True, side_effect=EventLog._merge) as merge:
+            self.assertEqual(10, self.log.append(events))
+        self.assertEqual(2, merge.call_count)
+        self.assertEqual(10, len(self.log))
+
+    def test_iso_timestamps(self):
+        self.log.append([event('1', 'a', '2022-11-05 10:12:13.456')])
+        self.assertEqual(['2022-11-05'], self.log.partitions())
+
+    def test_sync_since_watermark(self):
+        es = MagicMock()
+        es.find_all_user_add_course.return_value = iter([event(str(i), 'a', 100 - i) for i in range(10)])
+        self.assertEqual(3, self.log.sync(es, limit=3))
+        es.find_all_user_add_course.assert_called_with(since=None)
+        es.find_all_user_add_course.return_value = iter([event('0', 'a', 100), event('9', 'b', 200)])
+        self.log.sync(es, limit=3)
+        es.find_all_user_add_course.assert_called_with(since=100.0)
+        self.assertEqual(4, len(self.log))
+
+    def test_failed_sync_keeps_watermark(self):
+        self.log.append([event('1', 'a', 10)])
+        def failing():
+            yield event('2', 'b', DAY + 30)
+            yield event('3', 'b', DAY + 20)
+            raise ConnectionError('scroll expired')
+        es = MagicMock()
+        es.find_all_user_add_course.return_value = failing()
+        self.assertRaises(ConnectionError, lambda: self.log.sync(es))
+        self.log.append([event('2', 'b', DAY + 30)])
+        # Events between 10 and DAY + 20 may be missing, so the next sync starts over from 10
+        self.assertEqual(10, self.log.watermark())
+        es.find_all_user_add_course.return_value = iter([event('2', 'b', DAY + 30), event('4', 'c', DAY + 5)])
+        self.log.sync(es)
+        es.find_all_user_add_course.assert_called_with(since=10.0)
+        self.assertEqual(DAY + 30, self.log.watermark())
+        self.assertEqual(3, len(self.log))
+
+    def test_recover_interrupted_merge(self):
+        self.log.append([event('1', 'a', 10)])
+        self.log.append([event('2', 'a', DAY + 10)])
+        path = os.path.join(self.dir.name, '1970-01-01')
+        # Crashed after moving the old partition away: the complete new one is still .tmp
+        shutil.copytree(path, path + '.tmp')
+        os.rename(path, path + '.old')
+        # Crashed before the swap: the new partition may be incomplete
+        path = os.path.join(self.dir.name, '1970-01-02')
+        os.makedirs(path + '.tmp')
+        log = EventLog(self.dir.name)
+        self.assertEqual(['1970-01-02', '1970-01-01'], log.partitions())
+        self.assertEqual(['1970-01-01', '1970-01-02'], sorted(os.listdir(self.dir.name)))
+        self.assertEqual(2, len(log))
+
+    def test_recover_old_partition(self):
+        self.log.append([event('1', 'a', 10)])
+        path = os.path.join(self.dir.name, '1970-01-01')
+        os.rename(path, path + '.old')
+        self.assertEqual(['1970-01-01'], EventLog(self.dir.name).partitions())
+
+    def test_empty(self):
+        self.assertEqual([], self.log.partitions())
+        self.assertIsNone(self.log.watermark())
+        self.assertEqual(0, len(self.log))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,8 @@
 import unittest
-from cgrcompute.components.external import MongoService
+import time
+from cgrcompute.components.external import MongoService, ElasticService, parse_timestamp
 from unittest.mock import patch, MagicMock
+from pymongo.errors import ServerSelectionTimeoutError
 
 
 class MongoServiceTest(unittest.TestCase):
@@ -36,5 +38,134 @@ class MongoServiceTest(unittest.TestCase):
                 'academicYear': '2564'
             })
 
+class MongoServiceAbbrsTest(unittest.TestCase):
+
+    def create(self, **cfg):
+        self.db = {'courses': MagicMock()}
+        with patch('cgrcompute.components.external.MongoClient') as mockc, patch('cgrcompute.components.external.get_config') as getcfg:
+            getcfg.return_value = {'mongo': dict({'url': 'mongo://a', 'database': 'db'}, **cfg)}
+            mockc.return_value = {'db': self.db}
+            return MongoService()
+
+    def test_batch_and_cache(self):
+        srv = self.create()
+        self.db['courses'].find.return_value = [{'courseNo': '1', 'abbrName': 'ONE'}]
+        self.assertEqual({'1': 'ONE', '2': None}, srv.get_course_abbrs(['1', '2'], semester='1', study_program='S', academic_year='2565'))
+        self.db['courses'].find.assert_called_once_with({
+                'courseNo': {'$in': ['1', '2']},
+                'semester': '1',
+                'studyProgram': 'S',
+                'academicYear': '2565'
+            }, {'courseNo': 1, 'abbrName': 1})
+        self.db['courses'].find.return_value = [{'courseNo': '3', 'abbrName': 'THREE'}]
+        self.assertEqual({'1': 'ONE', '2': None, '3': 'THREE'}, srv.get_course_abbrs(['1', '2', '3'], semester='1', study_program='S', academic_year='2565'))
+        self.assertEqual(['3'], self.db['courses'].find.call_args[0][0]['courseNo']['$in'])
+        # Fully cached requests do not touch mongo
+        srv.get_course_abbrs(['3', '1'], semester='1', study_program='S', academic_year='2565')
+        self.assertEqual(2, self.db['courses'].find.call_count)
+
+    def test_preload(self):
+        srv = self.create(abbr_preload='true')
+        self.db['courses'].find.return_value = [{'courseNo': '1', 'abbrName': 'ONE'}, {'courseNo': '3', 'abbrName': 'THREE'}]
+        self.assertEqual({'1': 'ONE', '2': None}, srv.get_course_abbrs(['1', '2'], semester='1', study_program='S', academic_year='2565'))
+        self.db['courses'].find.assert_called_once_with({
+                'semester': '1',
+                'studyProgram': 'S',
+                'academicYear': '2565'
+            }, {'courseNo': 1, 'abbrName': 1})
+        self.assertEqual({'3': 'THREE', '4': None}, srv.get_course_abbrs(['3', '4'], semester='1', study_program='S', academic_year='2565'))
+        self.assertEqual({'1': 'ONE', '3': 'THREE'}, srv.get_semester_courses(semester='1', study_program='S', academic_year='2565'))
+        self.assertEqual(1, self.db['courses'].find.call_count)
+
+    def test_recent_semesters(self):
+        srv = self.create()
+        self.db['courses'].aggregate.return_value = [{'_id': {'academicYear': '2565', 'semester': '2'}}, {'_id': {'academicYear': '2565', 'semester': '1'}}]
+        self.assertEqual([('2565', '2'), ('2565', '1')], srv.get_recent_semesters(2))
+        self.assertEqual({'$limit': 2}, self.db['courses'].aggregate.call_args[0][0][-1])
+
+    def test_ping(self):
+        srv = self.create()
+        srv.db = MagicMock()
+        self.assertTrue(srv.ping())
+        srv.db.command.assert_called_with('ping')
+        srv.db.command.side_effect = ServerSelectionTimeoutError('no servers')
+        self.assertFalse(srv.ping())
+
+class ElasticServiceTest(unittest.TestCase):
+
+    def create(self, **cfg):
+        with patch('cgrcompute.components.external.OpenSearch') as client, patch('cgrcompute.components.external.get_config') as getcfg:
+            getcfg.return_value = {'elastic': dict({'host': 'h', 'port': 1, 'username': 'u', 'password': 'p'}, **cfg)}
+            srv = ElasticService()
+        self.pages = dict()
+        self.cleared = []
+
+        def search(index, body, params):
+            key = (index, body.get('slice', {}).get('id'))
+            hits = [{'_source': {'a_studyProgram': 'S', 'a_courseNo': '{}-{}-{}'.format(index, key[1], i), 'device_id': 'd', 'timestamp': i}} for i in range(5)]
+            self.pages[key] = [hits[i:i + body['size']] for i in range(0, len(hits), body['size'])] + [[]]
+            return {'_scroll_id': key, 'hits': {'hits': self.pages[key].pop(0)}}
+
+        srv.client.search.side_effect = search
+        srv.client.scroll.side_effect = lambda scroll_id, scroll: {'hits': {'hits': self.pages[scroll_id].pop(0)}}
+        srv.client.clear_scroll.side_effect = lambda scroll_id: self.cleared.append(scroll_id)
+        return srv
+
+    def test_find_all_sequential(self):
+        srv = self.create(page_size='2')
+        res = list(srv.find_all_user_add_course())
+        self.assertEqual(10, len(res))
+        self.assertEqual({'study_program': 'S', 'course_id': 'cgr-legacy-None-0', 'device_id': 'd', 'timestamp': 0}, [e for e in res if e['course_id'] == 'cgr-legacy-None-0'][0])
+        body = srv.client.search.call_args_list[0][1]['body']
+        self.assertEqual(2, body['size'])
+        self.assertEqual(['a_studyProgram', 'a_courseNo', 'device_id', 'timestamp'], body['_source'])
+        self.assertNotIn('slice', body)
+        self.assertEqual(2, len(self.cleared))
+
+    def test_find_all_sliced(self):
+        srv = self.create(page_size='3', parallel='3')
+        res = list(srv.find_all_user_add_course())
+        self.assertEqual(30, len(res))
+        self.assertEqual(30, len(set(e['course_id'] for e in res)))
+        slices = sorted((c[1]['index'], c[1]['body']['slice']['id'], c[1]['body']['slice']['max']) for c in srv.client.search.call_args_list)
+        self.assertEqual([('cgr-clientlogging', i, 3) for i in range(3)] + [('cgr-legacy', i, 3) for i in range(3)], slices)
+        self.assertEqual(6, len(self.cleared))
+
+    def test_find_all_error(self):
+        srv = self.create(parallel='2')
+        srv.client.scroll.side_effect = ConnectionError()
+        self.assertRaises(ConnectionError, lambda: list(srv.find_all_user_add_course()))
+
+    def test_find_all_stop_early(self):
+        srv = self.create(page_size='1', parallel='2')
+        events = srv.find_all_user_add_course()
+        next(events)
+        events.close()
+        # Every scroll still open is cleared by its thread shortly after
+        expected = [(index, i) for index in ('cgr-clientlogging', 'cgr-legacy') for i in range(2)]
+        deadline = time.time() + 5
+        while len(self.cleared) < len(expected) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertCountEqual(expected, self.cleared)
+        # Reading everything takes 5 scroll calls per slice
+        self.assertLess(srv.client.scroll.call_count, 20)
+
+    def test_query_all(self):
+        q = ElasticService.user_add_course_query('message')
+        self.assertEqual({'match_phrase': {'message': 'user add course'}}, q['query'])
+
+    def test_query_since(self):
+        q = ElasticService.user_add_course_query('short_message', since=1667643133.5)
+        self.assertEqual([{'match_phrase': {'short_message': 'user add course'}}], q['query']['bool']['must'])
+        self.assertEqual({'gte': 1667643133500, 'format': 'epoch_millis'}, q['query']['bool']['filter'][0]['range']['timestamp'])
+
+    def test_parse_timestamp(self):
+        self.assertEqual(1667643133.456, parse_timestamp('2022-11-05 10:12:13.456'))
+        self.assertEqual(1667643133.0, parse_timestamp('2022-11-05T10:12:13Z'))
+        self.assertEqual(1667643133.0, parse_timestamp('2022-11-05T17:12:13+07:00'))
+        self.assertEqual(1667643133.456, parse_timestamp(1667643133456))
+        self.assertEqual(1667643133, parse_timestamp(1667643133))
+        self.assertIsNone(parse_timestamp(None))
+
 if __name__ == '__main__':
     unittest.main()
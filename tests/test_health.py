@@ -1,28 +1,112 @@
 import unittest
-from cgrcompute.components.health import HealthServicer
-from concurrent.futures import ProcessPoolExecutor, BrokenExecutor
-import os
-import signal
+import threading
+import grpc
+from queue import Queue
+from unittest.mock import MagicMock
+from cgrcompute.components.health import HealthMonitor, HealthServicer
+from cgrcompute.grpc import health_pb2
 
-class HealthServicerTestCase(unittest.TestCase):
-    
-    def test_ping(self):
-        self.assertEqual(HealthServicer.ping(), "pong")
+SERVING = health_pb2.HealthCheckResponse.ServingStatus.SERVING
+NOT_SERVING = health_pb2.HealthCheckResponse.ServingStatus.NOT_SERVING
+
+
+class HealthMonitorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.workers = (True, '2 of 2 workers alive')
+        self.model = (False, 'no model published yet')
+        self.monitor = HealthMonitor()
+        self.monitor.add_check('workers', lambda: self.workers)
+        self.monitor.add_check('model', lambda: self.model)
+        self.monitor.add_service('', ['workers'])
+        self.monitor.add_service('ready', ['workers', 'model'])
+
+    def test_not_checked_yet(self):
+        self.assertFalse(self.monitor.status(''))
+        self.assertIsNone(self.monitor.status('unknown'))
+
+    def test_services(self):
+        self.monitor.refresh()
+        self.assertTrue(self.monitor.status(''))
+        self.assertTrue(self.monitor.status('workers'))
+        self.assertFalse(self.monitor.status('model'))
+        self.assertFalse(self.monitor.status('ready'))
 
+    def test_interval(self):
+        calls = []
+        self.monitor.add_check('slow', lambda: calls.append(1) or (True, ''), interval=3600)
+        self.monitor.refresh()
+        self.monitor.refresh()
+        self.assertEqual(1, len(calls))
 
-    @staticmethod
-    def _poison():
-        # Simulate OOM
-        os.kill(os.getpid(), signal.SIGKILL)
+    def test_failing_check(self):
+        def broken():
+            raise RuntimeError('boom')
+        self.monitor.add_check('broken', broken)
+        self.monitor.refresh()
+        self.assertFalse(self.monitor.status('broken'))
+        self.assertTrue(self.monitor.status(''))
+
+    def test_version_changes_with_status_only(self):
+        self.monitor.refresh()
+        version = self.monitor.version
+        self.workers = (True, '1 of 2 workers alive')
+        self.monitor._due['workers'] = 0
+        self.monitor.refresh()
+        self.assertEqual(version, self.monitor.version)
+        self.workers = (False, '0 of 2 workers alive')
+        self.monitor._due['workers'] = 0
+        self.monitor.refresh()
+        self.assertGreater(self.monitor.version, version)
+
+    def test_background_thread(self):
+        self.monitor.interval = 0.01
+        self.monitor.start()
+        try:
+            version = self.monitor.wait(0, threading.Event())
+            self.assertEqual(self.monitor.version, version)
+            self.assertTrue(self.monitor.status(''))
+        finally:
+            self.monitor.stop()
+
+
+class HealthServicerTestCase(unittest.TestCase):
 
-    def test_check_pool(self):
-        pool = ProcessPoolExecutor(max_workers=2)
-        srv = HealthServicer(pool=pool)
-        # Pool is ok
-        self.assertTrue(srv._check_pool())
+    def setUp(self):
+        self.ok = True
+        self.monitor = HealthMonitor()
+        self.monitor.add_check('workers', lambda: (self.ok, ''))
+        self.monitor.add_service('', ['workers'])
+        self.monitor.refresh()
+        self.srv = HealthServicer(self.monitor)
 
-        # Pool Broken
-        self.assertRaises(BrokenExecutor, lambda: pool.submit(HealthServicerTestCase._poison).result(timeout=5))
+    def test_check(self):
+        self.assertEqual(SERVING, self.srv.Check(health_pb2.HealthCheckRequest(), MagicMock()).status)
+        self.assertEqual(SERVING, self.srv.Check(health_pb2.HealthCheckRequest(service='workers'), MagicMock()).status)
+        context = MagicMock()
+        self.srv.Check(health_pb2.HealthCheckRequest(service='unknown'), context)
+        context.set_code.assert_called_with(grpc.StatusCode.NOT_FOUND)
 
-        self.assertFalse(srv._check_pool())
+    def test_watch_pushes_changes(self):
+        callbacks = []
+        context = MagicMock()
+        context.add_callback.side_effect = callbacks.append
+        received = Queue()
+        def watch():
+            for res in self.srv.Watch(health_pb2.HealthCheckRequest(), context):
+                received.put(res.status)
+            received.put(None)
+        thread = threading.Thread(target=watch, daemon=True)
+        thread.start()
+        self.assertEqual(SERVING, received.get(timeout=5))
+        self.ok = False
+        self.monitor._due['workers'] = 0
+        self.monitor.refresh()
+        self.assertEqual(NOT_SERVING, received.get(timeout=5))
+        callbacks[0]()
+        self.assertIsNone(received.get(timeout=5))
+        thread.join(timeout=5)
 
+    def test_watch_unknown(self):
+        res = list(self.srv.Watch(health_pb2.HealthCheckRequest(service='unknown'), MagicMock()))
+        self.assertEqual([health_pb2.HealthCheckResponse.ServingStatus.SERVICE_UNKNOWN], [r.status for r in res])
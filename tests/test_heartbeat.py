@@ -0,0 +1,40 @@
+import unittest
+import os
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
+from cgrcompute.components.heartbeat import WorkerHeartbeats
+
+
+def _start(heartbeats):
+    heartbeats.start()
+
+def _pid():
+    return os.getpid()
+
+
+class WorkerHeartbeatsTest(unittest.TestCase):
+
+    def test_workers_beat(self):
+        heartbeats = WorkerHeartbeats(4, interval=0.05, timeout=0.5)
+        self.assertEqual([], heartbeats.alive())
+        with ProcessPoolExecutor(max_workers=2, initializer=_start, initargs=(heartbeats, )) as pool:
+            pids = set(pool.submit(_pid).result(timeout=5) for _ in range(10))
+            time.sleep(0.3)
+            self.assertTrue(pids.issubset(heartbeats.alive()))
+            for pid in heartbeats.alive():
+                os.kill(pid, signal.SIGKILL)
+            time.sleep(0.7)
+            self.assertEqual([], heartbeats.alive())
+
+    def test_slots_are_reused(self):
+        heartbeats = WorkerHeartbeats(1, interval=0.05, timeout=0.2)
+        for _ in range(2):
+            with ProcessPoolExecutor(max_workers=1, initializer=_start, initargs=(heartbeats, )) as pool:
+                pid = pool.submit(_pid).result(timeout=5)
+                self.assertEqual([pid], heartbeats.alive())
+            time.sleep(0.3)
+
+
+if __name__ == '__main__':
+    unittest.main()
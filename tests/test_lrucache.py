@@ -0,0 +1,45 @@
+import unittest
+from cgrcompute.components.lrucache import LRUCache, MISSING
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.cache = LRUCache(maxsize=2, ttl=10, clock=lambda: self.now)
+
+    def test_get_put(self):
+        self.assertIs(MISSING, self.cache.get('a'))
+        self.assertIsNone(self.cache.get('a', None))
+        self.cache.put('a', 1)
+        self.assertEqual(1, self.cache.get('a'))
+        self.assertEqual((1, 2), (self.cache.hits, self.cache.misses))
+
+    def test_evict_least_recent(self):
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+        self.cache.get('a')
+        self.cache.put('c', 3)
+        self.assertEqual(1, self.cache.get('a'))
+        self.assertIs(MISSING, self.cache.get('b'))
+        self.assertEqual(2, len(self.cache))
+
+    def test_expire(self):
+        self.cache.put('a', 1)
+        self.now = 10
+        self.assertEqual(1, self.cache.get('a'))
+        self.now = 11
+        self.assertIs(MISSING, self.cache.get('a'))
+        self.assertEqual(0, len(self.cache))
+
+    def test_cache_none(self):
+        self.cache.put('a', None)
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_clear(self):
+        self.cache.put('a', 1)
+        self.cache.clear()
+        self.assertIs(MISSING, self.cache.get('a'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import unittest
+import os
+import tempfile
+import urllib.request
+from multiprocessing import Process
+from unittest.mock import patch
+from cgrcompute.components.metrics import Registry, Counter, Gauge, Histogram, MappedValues, METRICS_DIR_ENV, start_metrics_server
+
+
+def _write_in_child(counter, histogram, gauge):
+    counter.inc(2, pool='training')
+    histogram.observe(0.3, stage='model')
+    gauge.set(7)
+
+
+class MetricsTest(unittest.TestCase):
+
+    def create(self):
+        registry = Registry()
+        return (registry,
+            Counter('restarts_total', 'Restarts', ('pool', ), registry=registry),
+            Histogram('stage_seconds', 'Stages', ('stage', ), buckets=(0.1, 1), registry=registry),
+            Gauge('version', 'Version', registry=registry))
+
+    def test_render(self):
+        with patch.dict(os.environ, {METRICS_DIR_ENV: ''}):
+            registry, counter, histogram, gauge = self.create()
+            counter.inc(pool='training')
+            histogram.observe(0.05, stage='model')
+            histogram.observe(0.5, stage='model')
+            gauge.set_function(lambda: 3)
+            self.assertEqual('\n'.join([
+                '# HELP restarts_total Restarts',
+                '# TYPE restarts_total counter',
+                'restarts_total{pool="training"} 1',
+                '# HELP stage_seconds Stages',
+                '# TYPE stage_seconds histogram',
+                'stage_seconds_bucket{stage="model",le="0.1"} 1',
+                'stage_seconds_bucket{stage="model",le="1"} 2',
+                'stage_seconds_bucket{stage="model",le="+Inf"} 2',
+                'stage_seconds_sum{stage="model"} 0.55',
+                'stage_seconds_count{stage="model"} 2',
+                '# HELP version Version',
+                '# TYPE version gauge',
+                'version 3',
+            ]) + '\n', registry.render())
+            self.assertRaises(ValueError, lambda: counter.inc(stage='x'))
+
+    def test_sum_across_processes(self):
+        with tempfile.TemporaryDirectory() as d, patch.dict(os.environ, {METRICS_DIR_ENV: d}):
+            registry, counter, histogram, gauge = self.create()
+            counter.inc(pool='training')
+            gauge.set(5)
+            p = Process(target=_write_in_child, args=(counter, histogram, gauge))
+            p.start()
+            p.join()
+            values = registry.collect()
+            self.assertEqual(2, len(os.listdir(d)))
+        self.assertEqual(3, values['restarts_total{pool="training"}'][0])
+        self.assertEqual(1, values['stage_seconds_count{stage="model"}'][0])
+        # Gauges take the latest write
+        self.assertEqual(7, values['version'][0])
+
+    def test_fold_exited_processes(self):
+        with tempfile.TemporaryDirectory() as d, patch.dict(os.environ, {METRICS_DIR_ENV: d}):
+            registry, counter, histogram, gauge = self.create()
+            counter.inc(pool='training')
+            for _ in range(3):
+                p = Process(target=_write_in_child, args=(counter, histogram, gauge))
+                p.start()
+                p.join()
+            values = registry.collect()
+            # Only this process's file is left besides the aggregate of the exited ones
+            self.assertEqual(['{}.metrics'.format(os.getpid()), 'aggregate.metrics'], sorted(os.listdir(d)))
+            self.assertEqual(values, registry.collect())
+        self.assertEqual(7, values['restarts_total{pool="training"}'][0])
+        self.assertEqual(3, values['stage_seconds_count{stage="model"}'][0])
+        self.assertEqual(7, values['version'][0])
+
+    def test_mapped_values_grow(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'values')
+            values = MappedValues(path)
+            for i in range(5000):
+                values.add('key_{}'.format(i), i)
+            values.add('key_1', 1)
+            read = MappedValues.read(path)
+            self.assertEqual(5000, len(read))
+            self.assertEqual(2, read['key_1'][0])
+            self.assertEqual(4999, read['key_4999'][0])
+            self.assertEqual(2, MappedValues(path).get('key_1')[0])
+
+    def test_http(self):
+        httpd = start_metrics_server(0, host='127.0.0.1')
+        try:
+            with urllib.request.urlopen('http://127.0.0.1:{}/metrics'.format(httpd.server_address[1])) as res:
+                body = res.read().decode()
+        finally:
+            httpd.shutdown()
+        self.assertIn('# TYPE cgrcompute_request_stage_seconds histogram', body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,13 @@
 import unittest
+import gc
+import os
+import pickle
+import tempfile
+import weakref
+import numpy as np
 from multiprocessing import Manager, Process
-from cgrcompute.components.multiprocess import SharableCache
+from unittest.mock import patch
+from cgrcompute.components.multiprocess import SharableCache, MappedSharableCache, dump_mapped, load_mapped
 
 class SharableCacheTest(unittest.TestCase):
 
@@ -13,5 +20,115 @@ class SharableCacheTest(unittest.TestCase):
             c.update('k', 'val2')
             self.assertEqual('val2', c.get('k'))
 
+    def test_local_cache_survives_pickling(self):
+        with Manager() as m:
+            c = SharableCache(m)
+            c.update('k', ['val'])
+            first = c.get('k')
+            self.assertIs(first, pickle.loads(pickle.dumps(c)).get('k'))
+
+
+def _update_in_child(cache, key, val):
+    cache.update(key, val)
+
+
+class MappedSharableCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = Manager()
+        self.cache = MappedSharableCache(self.manager)
+
+    def tearDown(self):
+        self.cache.close()
+        self.manager.shutdown()
+
+    def test_can_cache(self):
+        c = self.cache
+        self.assertRaises(KeyError, lambda: c.get('k'))
+        self.assertEqual('val', c.get_or_create('k', lambda : 'val'))
+        c.update('k', 'val2')
+        self.assertEqual('val2', c.get('k'))
+
+    def test_update_from_other_process(self):
+        self.cache.update('k', 'val')
+        self.assertEqual('val', self.cache.get('k'))
+        p = Process(target=_update_in_child, args=(self.cache, 'k', 'val2'))
+        p.start()
+        p.join()
+        self.assertEqual('val2', self.cache.get('k'))
+        self.assertEqual(2, self.cache.generation())
+
+    def test_miss_is_cached_until_update(self):
+        self.assertRaises(KeyError, lambda: self.cache.get('k'))
+        with patch.object(self.cache, 'shared_cache') as shared:
+            self.assertRaises(KeyError, lambda: self.cache.get('k'))
+            shared.get.assert_not_called()
+        p = Process(target=_update_in_child, args=(self.cache, 'k', 'val'))
+        p.start()
+        p.join()
+        self.assertEqual('val', self.cache.get('k'))
+
+    def test_arrays_are_mapped(self):
+        self.cache.update('k/1', {'arr': np.arange(1000, dtype=np.int32)})
+        arr = self.cache.get('k/1')['arr']
+        np.testing.assert_array_equal(np.arange(1000, dtype=np.int32), arr)
+        self.assertFalse(arr.flags.owndata)
+        self.assertFalse(arr.flags.writeable)
+
+    def test_old_version_is_removed(self):
+        self.cache.update('k', 'val')
+        self.cache.update('k', 'val2')
+        self.assertEqual(['generation', 'k.2'], sorted(os.listdir(self.cache.directory)))
+
+    def test_removed_file_fails(self):
+        self.cache.update('k', 'val')
+        os.unlink(os.path.join(self.cache.directory, 'k.1'))
+        copy = pickle.loads(pickle.dumps(self.cache))
+        self.assertRaises(FileNotFoundError, lambda: copy.get('k'))
+
+    def test_retry_when_replaced_while_reading(self):
+        self.cache.update('k', 'val')
+        current = dict(self.cache.shared_cache)['k']
+        gone = (0, os.path.join(self.cache.directory, 'k.0'))
+        copy = pickle.loads(pickle.dumps(self.cache))
+        with patch.object(copy, 'shared_cache') as shared:
+            shared.get.side_effect = [gone, current, current]
+            self.assertEqual('val', copy.get('k'))
+
+    def test_missing_key_does_not_leak_proxies(self):
+        copy = pickle.loads(pickle.dumps(self.cache))
+        try:
+            copy.get('k')
+            self.fail()
+        except KeyError:
+            pass
+        ref = weakref.ref(copy.shared_cache)
+        gc.disable()
+        try:
+            del copy
+            self.assertIsNone(ref())
+        finally:
+            gc.enable()
+
+
+class MappedFileTest(unittest.TestCase):
+
+    def test_roundtrip(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'f')
+            dump_mapped({'a': np.ones(3, dtype=np.float32), 'b': [np.arange(5)], 'c': 'x'}, path)
+            res = load_mapped(path)
+            np.testing.assert_array_equal(np.ones(3), res['a'])
+            np.testing.assert_array_equal(np.arange(5), res['b'][0])
+            self.assertEqual('x', res['c'])
+
+    def test_reject_truncated(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'f')
+            dump_mapped(np.arange(1000), path)
+            with open(path, 'r+b') as f:
+                f.truncate(os.path.getsize(path) - 100)
+            self.assertRaises(ValueError, lambda: load_mapped(path))
+
 if __name__ == '__main__':
     unittest.main()
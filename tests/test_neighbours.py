@@ -0,0 +1,53 @@
+import unittest
+import random
+import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix
+from cgrcompute.components.neighbours import exact_neighbours, LSHNeighbours, recall_at_k
+
+
+def random_itemobsv(n_items=60, n_obsv=400, cluster=10, seed=5):
+    # Baskets mostly draw from one cluster of items, so every item has clearly closer neighbours
+    rng = random.Random(seed)
+    obsv = []
+    for _ in range(n_obsv):
+        start = rng.randrange(0, n_items, cluster)
+        obsv.append(set(rng.sample(range(start, start + cluster), rng.randint(2, 6)) + [rng.randrange(n_items)]))
+    rows = [c for o in obsv for c in o]
+    cols = [i for (i, o) in enumerate(obsv) for _ in o]
+    return coo_matrix((np.ones(len(rows)), (rows, cols)), shape=(n_items, n_obsv)).tocsr()
+
+
+class LSHNeighboursTest(unittest.TestCase):
+
+    def test_scores_are_exact(self):
+        itemobsv = random_itemobsv()
+        exact = exact_neighbours(itemobsv, 100).toarray()
+        approx = LSHNeighbours(bits=4, tables=2)(itemobsv, 100).toarray()
+        found = approx != 0
+        self.assertTrue(found.diagonal().all())
+        np.testing.assert_allclose(exact[found], approx[found])
+
+    def test_recall_grows_with_tables(self):
+        itemobsv = random_itemobsv()
+        exact = exact_neighbours(itemobsv, 10)
+        recalls = [recall_at_k(exact, LSHNeighbours(bits=4, tables=t)(itemobsv, 10)) for t in (1, 4, 32)]
+        self.assertLess(recalls[0], recalls[2])
+        self.assertLessEqual(recalls[0], recalls[1])
+        self.assertGreater(recalls[2], 0.9)
+
+    def test_one_bucket_is_exact(self):
+        itemobsv = random_itemobsv()
+        exact = exact_neighbours(itemobsv, 100)
+        approx = LSHNeighbours(bits=0, tables=1)(itemobsv, 100)
+        self.assertEqual(1.0, recall_at_k(exact, approx))
+
+class RecallTest(unittest.TestCase):
+
+    def test_recall_at_k(self):
+        exact = csr_matrix(np.array([[1, 1, 0], [0, 1, 1], [0, 0, 0]]))
+        approx = csr_matrix(np.array([[1, 0, 0], [0, 1, 1], [1, 0, 0]]))
+        self.assertAlmostEqual(0.75, recall_at_k(exact, approx))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+import os
+import signal
+import tempfile
+import time
+from concurrent.futures import BrokenExecutor
+from cgrcompute.components.pool import SupervisedPool, anonymous_memory
+
+_initialized = None
+
+
+def _initialize(value):
+    global _initialized
+    _initialized = value
+
+def _initialized_value():
+    return _initialized
+
+def _pid():
+    return os.getpid()
+
+def _crash_once(marker):
+    # Killed like by the OOM killer on the first try only
+    if not os.path.exists(marker):
+        open(marker, 'w').close()
+        os.kill(os.getpid(), signal.SIGKILL)
+    return 'ok'
+
+def _crash():
+    os.kill(os.getpid(), signal.SIGKILL)
+
+def _slow(value):
+    time.sleep(0.5)
+    return value
+
+
+class SupervisedPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.pools = []
+
+    def tearDown(self):
+        for pool in self.pools:
+            pool.shutdown()
+        self.dir.cleanup()
+
+    def create(self, **kwargs):
+        pool = SupervisedPool(**kwargs)
+        self.pools.append(pool)
+        return pool
+
+    def test_initializer_runs_before_tasks(self):
+        pool = self.create(max_workers=2, initializer=_initialize, initargs=('warm', ))
+        self.assertEqual(2, len(pool.pids()))
+        self.assertEqual('warm', pool.submit(_initialized_value).result(timeout=5))
+
+    def test_workers_beat(self):
+        pool = self.create(max_workers=2)
+        self.assertEqual(sorted(pool.pids()), sorted(pool.heartbeats.alive()))
+
+    def test_retry_after_crash(self):
+        pool = self.create(max_workers=2, initializer=_initialize, initargs=('warm', ))
+        before = set(pool.pids())
+        self.assertEqual('ok', pool.submit(_crash_once, os.path.join(self.dir.name, 'crashed')).result(timeout=10))
+        self.assertTrue(before.isdisjoint(pool.pids()))
+        self.assertEqual('warm', pool.submit(_initialized_value).result(timeout=5))
+
+    def test_in_flight_tasks_are_retried(self):
+        pool = self.create(max_workers=2)
+        slow = pool.submit(_slow, 'slow')
+        time.sleep(0.1)
+        crashed = pool.submit(_crash_once, os.path.join(self.dir.name, 'crashed'))
+        self.assertEqual('slow', slow.result(timeout=10))
+        self.assertEqual('ok', crashed.result(timeout=10))
+
+    def test_retries_are_limited(self):
+        pool = self.create(max_workers=1, retries=1)
+        self.assertRaises(BrokenExecutor, lambda: pool.submit(_crash).result(timeout=10))
+        self.assertEqual('ok', pool.submit(_slow, 'ok').result(timeout=10))
+
+    def test_max_tasks_per_child(self):
+        pool = self.create(max_workers=1, max_tasks_per_child=3)
+        pids = [pool.submit(_pid).result(timeout=10) for _ in range(3)]
+        self.assertEqual(1, len(set(pids)))
+        deadline = time.time() + 10
+        while pool.submit(_pid).result(timeout=10) == pids[0]:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.05)
+
+    def test_memory_limit(self):
+        pool = self.create(max_workers=1, memory_limit=1, check_interval=0.05)
+        first = pool.submit(_pid).result(timeout=5)
+        deadline = time.time() + 10
+        while pool.submit(_pid).result(timeout=10) == first:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.05)
+
+    def test_shutdown(self):
+        pool = self.create(max_workers=1)
+        pool.shutdown()
+        self.assertRaises(RuntimeError, lambda: pool.submit(_pid))
+
+    def test_anonymous_memory(self):
+        if not os.path.exists('/proc/self/status'):
+            self.skipTest('needs /proc')
+        self.assertGreater(anonymous_memory(os.getpid()), 0)
+        self.assertIsNone(anonymous_memory(-1))
+
+
+if __name__ == '__main__':
+    unittest.main()
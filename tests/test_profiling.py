@@ -0,0 +1,124 @@
+import unittest
+import os
+import pstats
+import tempfile
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from unittest.mock import MagicMock, patch
+from cgrcompute.components.admin import AdminServicer
+from cgrcompute.components.profiling import PROFILE_DIR_ENV, PROFILING, Profiling
+from cgrcompute.grpc import admin_pb2
+
+
+def _burn(n=200000):
+    return sum(i * i for i in range(n))
+
+
+def _settings():
+    return PROFILING.settings()
+
+
+class ProfilingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.env = patch.dict(os.environ, {PROFILE_DIR_ENV: self.dir.name})
+        self.env.start()
+        self.profiling = Profiling()
+
+    def tearDown(self):
+        self.env.stop()
+        self.dir.cleanup()
+
+    def files(self, sub):
+        path = os.path.join(self.dir.name, sub)
+        return sorted(os.listdir(path)) if os.path.exists(path) else []
+
+    def test_unsampled_request_writes_nothing(self):
+        with self.profiling.request('Recommend', lambda: self.fail()):
+            _burn(10)
+        self.assertEqual([], self.files('requests'))
+
+    def test_sampled_request(self):
+        self.profiling.configure(request_rate=1)
+        with self.profiling.request('Recommend', lambda: b'req'):
+            _burn()
+        names = self.files('requests')
+        self.assertEqual(2, len(names))
+        prof, pb = sorted(names, key=lambda n: n.endswith('.pb'))
+        self.assertTrue(prof.startswith('Recommend-') and prof.endswith('.prof'))
+        self.assertEqual(prof[:-len('.prof')] + '.pb', pb)
+        with open(os.path.join(self.dir.name, 'requests', pb), 'rb') as f:
+            self.assertEqual(b'req', f.read())
+        stats = pstats.Stats(os.path.join(self.dir.name, 'requests', prof))
+        self.assertTrue(any(fn == '_burn' for (_, _, fn) in stats.stats))
+
+    def test_sampling_profiler(self):
+        self.profiling.configure(request_rate=1, profiler='sampling')
+        with self.profiling.request('Recommend', lambda: b''):
+            _burn(2000000)
+        folded = [n for n in self.files('requests') if n.endswith('.folded')]
+        self.assertEqual(1, len(folded))
+        with open(os.path.join(self.dir.name, 'requests', folded[0])) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines)
+        self.assertTrue(any('_burn (test_profiling.py' in l for l in lines))
+
+    def test_no_directory(self):
+        self.profiling.configure(request_rate=1, training=True)
+        with patch.dict(os.environ, {PROFILE_DIR_ENV: ''}):
+            with self.profiling.request('Recommend', lambda: b''), self.profiling.training():
+                _burn(10)
+        self.assertEqual([], os.listdir(self.dir.name))
+
+    def test_training_tracemalloc(self):
+        self.profiling.configure(training=True, tracemalloc=True)
+        with self.profiling.training():
+            data = [bytes(1000) for _ in range(1000)]
+        del data
+        self.assertFalse(tracemalloc.is_tracing())
+        names = self.files('training')
+        self.assertEqual(1, len([n for n in names if n.endswith('.prof')]))
+        snapshot = [n for n in names if n.endswith('.tracemalloc') and '.latest' not in n]
+        self.assertEqual(1, len(snapshot))
+        tracemalloc.Snapshot.load(os.path.join(self.dir.name, 'training', snapshot[0]))
+
+    def test_rejects_invalid_settings(self):
+        self.assertRaises(ValueError, lambda: self.profiling.configure(request_rate=2))
+        self.assertRaises(ValueError, lambda: self.profiling.configure(profiler='perf'))
+        self.assertEqual('cprofile', self.profiling.settings()['profiler'])
+
+    def test_settings_reach_forked_workers(self):
+        before = PROFILING.settings()
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            self.assertEqual(0, pool.submit(_settings).result()['request_rate'])
+            PROFILING.configure(request_rate=0.25, training=True)
+            try:
+                res = pool.submit(_settings).result()
+            finally:
+                PROFILING.configure(request_rate=before['request_rate'], training=before['training'])
+        self.assertEqual(0.25, res['request_rate'])
+        self.assertTrue(res['training'])
+
+
+class AdminServicerTest(unittest.TestCase):
+
+    def test_set_profiling(self):
+        profiling = Profiling()
+        srv = AdminServicer(profiling)
+        res = srv.SetProfiling(admin_pb2.ProfilingSettings(requestRate=0.5, tracemalloc=True), MagicMock())
+        self.assertEqual(0.5, res.requestRate)
+        self.assertEqual('cprofile', res.profiler)
+        self.assertTrue(res.tracemalloc)
+        res = srv.SetProfiling(admin_pb2.ProfilingSettings(profiler='sampling'), MagicMock())
+        self.assertEqual(0.5, res.requestRate)
+        self.assertEqual('sampling', res.profiler)
+
+    def test_invalid_settings(self):
+        context = MagicMock()
+        AdminServicer(Profiling()).SetProfiling(admin_pb2.ProfilingSettings(requestRate=3), context)
+        self.assertEqual('INVALID_ARGUMENT', context.abort.call_args[0][0].name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+from cgrcompute.components.lrucache import MISSING
+from cgrcompute.components.resultcache import ResultCache
+import cgrcompute.grpc.cgrcompute_pb2 as grpcmsg
+
+
+def request(variant='COSINE', *course_nos):
+    req = grpcmsg.CourseRecommendationRequest(variant=variant)
+    req.semesterKey.studyProgram = 'S'
+    req.semesterKey.semester = '1'
+    req.semesterKey.academicYear = '2565'
+    for c in course_nos:
+        e = req.selectedCourses.add()
+        e.courseNo = c
+        e.semesterKey.CopyFrom(req.semesterKey)
+    return req
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.version = 1
+        self.cache = ResultCache(lambda: self.version)
+
+    def test_key_is_normalized(self):
+        self.assertEqual(self.cache.key(request('COSINE', 'a', 'b')), self.cache.key(request('COSINE', 'b', 'a', 'b')))
+        self.assertNotEqual(self.cache.key(request('COSINE', 'a')), self.cache.key(request('COSINE', 'a', 'b')))
+        self.assertIsNone(self.cache.key(request('RANDOM', 'a')))
+
+    def test_cleared_on_new_version(self):
+        key = self.cache.key(request('COSINE', 'a'))
+        self.cache.put(key, b'res')
+        self.assertEqual(b'res', self.cache.get(self.cache.key(request('COSINE', 'a'))))
+        self.version = 2
+        new_key = self.cache.key(request('COSINE', 'a'))
+        self.assertIs(MISSING, self.cache.get(new_key))
+        # A result computed against the old model is not stored
+        self.cache.put(key, b'old')
+        self.assertEqual(0, self.cache.stats()['size'])
+        self.assertEqual({'hits': 1, 'misses': 1, 'size': 0}, self.cache.stats())
+
+
+if __name__ == '__main__':
+    unittest.main()
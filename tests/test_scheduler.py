@@ -0,0 +1,71 @@
+import unittest
+import os
+import signal
+import time
+from multiprocessing import Manager
+from cgrcompute.components.multiprocess import MappedSharableCache
+from cgrcompute.components.scheduler import ModelRefresher
+
+
+def _publish(cache):
+    try:
+        v = cache.get('m') + 1
+    except KeyError:
+        v = 1
+    cache.update('m', v)
+    return v
+
+def _fail(cache):
+    raise RuntimeError('no elastic')
+
+def _crash(cache):
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+class ModelRefresherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = Manager()
+        self.cache = MappedSharableCache(self.manager)
+
+    def tearDown(self):
+        self.cache.close()
+        self.manager.shutdown()
+
+    def test_refresh_publish(self):
+        r = ModelRefresher(_publish, (self.cache, ))
+        self.assertTrue(r.refresh())
+        self.assertTrue(r.refresh())
+        self.assertEqual(2, self.cache.get('m'))
+        self.assertEqual(2, r.last_result)
+        r.stop()
+
+    def test_failure_keeps_model(self):
+        self.cache.update('m', 1)
+        r = ModelRefresher(_fail, (self.cache, ))
+        self.assertFalse(r.refresh())
+        self.assertEqual(1, self.cache.get('m'))
+        self.assertIsNone(r.last_success)
+        r.stop()
+
+    def test_recover_from_crash(self):
+        r = ModelRefresher(_crash, (self.cache, ))
+        self.assertFalse(r.refresh())
+        r.task = _publish
+        self.assertTrue(r.refresh())
+        r.stop()
+
+    def test_background_and_trigger(self):
+        r = ModelRefresher(_publish, (self.cache, ), interval=3600)
+        r.start()
+        deadline = time.time() + 10
+        while r.last_result != 1 and time.time() < deadline:
+            time.sleep(0.05)
+        r.trigger()
+        while r.last_result != 2 and time.time() < deadline:
+            time.sleep(0.05)
+        r.stop()
+        self.assertEqual(2, self.cache.get('m'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,222 @@
+import unittest
+import asyncio
+import configparser
+import time
+import grpc
+from concurrent.futures import Future, ThreadPoolExecutor
+from unittest.mock import MagicMock, AsyncMock, patch
+import cgrcompute.server as server
+from cgrcompute.components.courserecommendation import ModelNotReadyError
+from cgrcompute.components.batching import MicroBatcher
+from cgrcompute.components.admission import AdmissionController
+from cgrcompute.components.resultcache import ResultCache
+import cgrcompute.grpc.cgrcompute_pb2 as grpcmsg
+
+
+def _serialized_response(req, cache, submitted_at=None, deadline=None):
+    res = grpcmsg.CourseRecommendationResponse()
+    res.courses.add().courseNameEn = 'hello'
+    return res.SerializeToString()
+
+def _slow_response(req, cache, submitted_at=None, deadline=None):
+    time.sleep(0.5)
+    return _serialized_response(req, cache)
+
+def _not_ready(req, cache, submitted_at=None, deadline=None):
+    raise ModelNotReadyError('not ready')
+
+def _echo_batch(reqs, cache, submitted_at=None, deadlines=None):
+    res = []
+    for r in reqs:
+        req = grpcmsg.CourseRecommendationRequest()
+        req.ParseFromString(r)
+        resp = grpcmsg.CourseRecommendationResponse()
+        resp.courses.add().courseNameEn = req.variant
+        res.append(resp.SerializeToString())
+    return res
+
+def _failing_batch(reqs, cache, submitted_at=None, deadlines=None):
+    res = _echo_batch(reqs, cache)
+    return [ModelNotReadyError('not ready') if r.variant == 'X' else RuntimeError('boom') if r.variant == 'Y' else res[i]
+        for (i, r) in enumerate(grpcmsg.CourseRecommendationRequest.FromString(r) for r in reqs)]
+
+def _requests(*variants):
+    return [grpcmsg.CourseRecommendationRequest(variant=v) for v in variants]
+
+def _context(time_remaining=None):
+    context = MagicMock()
+    context.time_remaining.return_value = time_remaining
+    return context
+
+def _async_context(time_remaining=None):
+    context = AsyncMock()
+    context.time_remaining = MagicMock(return_value=time_remaining)
+    return context
+
+async def _aiter(items):
+    for e in items:
+        yield e
+
+
+class CourseRecommendationServicerTest(unittest.TestCase):
+
+    def setUp(self):
+        server.pool = ThreadPoolExecutor(max_workers=2)
+
+    def tearDown(self):
+        server.pool.shutdown()
+        server.pool = None
+
+    def test_recommend(self):
+        with patch('cgrcompute.server.recommend_course_serialized', _serialized_response):
+            res = server.CourseRecommendationServicer(None).Recommend(grpcmsg.CourseRecommendationRequest(), _context())
+        self.assertEqual('hello', res.courses[0].courseNameEn)
+
+    def test_recommend_not_ready(self):
+        context = _context()
+        with patch('cgrcompute.server.recommend_course_serialized', _not_ready):
+            server.CourseRecommendationServicer(None).Recommend(grpcmsg.CourseRecommendationRequest(), context)
+        context.abort.assert_called_with(grpc.StatusCode.UNAVAILABLE, 'not ready')
+
+    def test_async_recommend(self):
+        with patch('cgrcompute.server.recommend_course_serialized', _serialized_response):
+            res = asyncio.run(server.AsyncCourseRecommendationServicer(None).Recommend(grpcmsg.CourseRecommendationRequest(), _async_context()))
+        self.assertEqual('hello', res.courses[0].courseNameEn)
+
+    def test_async_recommend_not_ready(self):
+        context = _async_context()
+        with patch('cgrcompute.server.recommend_course_serialized', _not_ready):
+            asyncio.run(server.AsyncCourseRecommendationServicer(None).Recommend(grpcmsg.CourseRecommendationRequest(), context))
+        context.abort.assert_awaited_with(grpc.StatusCode.UNAVAILABLE, 'not ready')
+
+    def test_result_cache(self):
+        calls = []
+        def recommend(req, cache, submitted_at=None, deadline=None):
+            calls.append(req)
+            return _serialized_response(req, cache)
+        req = grpcmsg.CourseRecommendationRequest(variant='COSINE')
+        srv = server.CourseRecommendationServicer(None, result_cache=ResultCache(lambda: 1))
+        with patch('cgrcompute.server.recommend_course_serialized', recommend):
+            srv.Recommend(req, _context())
+            # The result is stored by a done callback that may run just after Recommend returns
+            for _ in range(100):
+                if srv.result_cache.stats()['size']:
+                    break
+                time.sleep(0.01)
+            for _ in range(2):
+                res = srv.Recommend(req, _context())
+        self.assertEqual('hello', res.courses[0].courseNameEn)
+        self.assertEqual(1, len(calls))
+        self.assertEqual(2, srv.result_cache.stats()['hits'])
+
+    def test_degraded_not_cached(self):
+        calls = []
+        def recommend(req, cache, submitted_at=None, deadline=None):
+            calls.append(req)
+            return grpcmsg.CourseRecommendationResponse(degraded=True).SerializeToString()
+        req = grpcmsg.CourseRecommendationRequest(variant='COSINE')
+        srv = server.CourseRecommendationServicer(None, result_cache=ResultCache(lambda: 1))
+        with patch('cgrcompute.server.recommend_course_serialized', recommend):
+            for _ in range(2):
+                self.assertTrue(srv.Recommend(req, _context()).degraded)
+        self.assertEqual(2, len(calls))
+        self.assertEqual(0, srv.result_cache.stats()['size'])
+
+    def test_rejected(self):
+        admission = AdmissionController(max_in_flight=1)
+        admission.track(Future())
+        context = _context()
+        with patch('cgrcompute.server.recommend_course_serialized', _serialized_response):
+            server.CourseRecommendationServicer(None, admission=admission).Recommend(grpcmsg.CourseRecommendationRequest(), context)
+        context.abort.assert_called_once()
+        self.assertEqual(grpc.StatusCode.RESOURCE_EXHAUSTED, context.abort.call_args[0][0])
+
+    def test_deadline_exceeded(self):
+        context = _context(time_remaining=0.05)
+        with patch('cgrcompute.server.recommend_course_serialized', _slow_response):
+            server.CourseRecommendationServicer(None).Recommend(grpcmsg.CourseRecommendationRequest(), context)
+        context.abort.assert_called_once()
+        self.assertEqual(grpc.StatusCode.DEADLINE_EXCEEDED, context.abort.call_args[0][0])
+
+    def test_async_deadline_exceeded(self):
+        context = _async_context(time_remaining=0.05)
+        with patch('cgrcompute.server.recommend_course_serialized', _slow_response):
+            asyncio.run(server.AsyncCourseRecommendationServicer(None).Recommend(grpcmsg.CourseRecommendationRequest(), context))
+        self.assertEqual(grpc.StatusCode.DEADLINE_EXCEEDED, context.abort.await_args[0][0])
+
+class BatchRecommendTest(unittest.TestCase):
+
+    def setUp(self):
+        server.pool = ThreadPoolExecutor(max_workers=2)
+        self.patch = patch('cgrcompute.server.recommend_course_batch_serialized', _echo_batch)
+        self.patch.start()
+        self.batcher = MicroBatcher(server.batch_dispatcher(None), max_delay=0.01)
+
+    def tearDown(self):
+        self.batcher.close()
+        self.patch.stop()
+        server.pool.shutdown()
+        server.pool = None
+
+    def test_batch(self):
+        req = grpcmsg.CourseRecommendationBatchRequest()
+        req.requests.extend(_requests('A', 'B', 'C'))
+        res = server.CourseRecommendationServicer(None, batch_size=2).RecommendBatch(req, _context())
+        self.assertEqual(['A', 'B', 'C'], [r.courses[0].courseNameEn for r in res.responses])
+
+    def test_async_batch(self):
+        req = grpcmsg.CourseRecommendationBatchRequest()
+        req.requests.extend(_requests('A', 'B', 'C'))
+        res = asyncio.run(server.AsyncCourseRecommendationServicer(None, batch_size=2).RecommendBatch(req, _async_context()))
+        self.assertEqual(['A', 'B', 'C'], [r.courses[0].courseNameEn for r in res.responses])
+
+    def test_batch_item_errors(self):
+        req = grpcmsg.CourseRecommendationBatchRequest()
+        req.requests.extend(_requests('A', 'X', 'B', 'Y'))
+        context = _context()
+        with patch('cgrcompute.server.recommend_course_batch_serialized', _failing_batch):
+            res = server.CourseRecommendationServicer(None, batch_size=2).RecommendBatch(req, context)
+        context.abort.assert_not_called()
+        self.assertEqual([['A'], [], ['B'], []], [[c.courseNameEn for c in r.courses] for r in res.responses])
+        self.assertEqual([(1, grpc.StatusCode.UNAVAILABLE.value[0], 'not ready'), (3, grpc.StatusCode.UNKNOWN.value[0], 'boom')],
+            [(e.index, e.code, e.message) for e in res.errors])
+
+    def test_micro_batched_recommend(self):
+        res = server.CourseRecommendationServicer(None, batcher=self.batcher).Recommend(_requests('A')[0], _context())
+        self.assertEqual('A', res.courses[0].courseNameEn)
+
+    def test_stream(self):
+        srv = server.CourseRecommendationServicer(None, batcher=self.batcher)
+        res = list(srv.RecommendStream(iter(_requests('A', 'B', 'C')), _context()))
+        self.assertEqual(['A', 'B', 'C'], [r.courses[0].courseNameEn for r in res])
+
+    def test_async_stream(self):
+        srv = server.AsyncCourseRecommendationServicer(None, batcher=self.batcher)
+        async def collect():
+            return [r async for r in srv.RecommendStream(_aiter(_requests('A', 'B', 'C')), _async_context())]
+        res = asyncio.run(collect())
+        self.assertEqual(['A', 'B', 'C'], [r.courses[0].courseNameEn for r in res])
+
+class HealthChecksTest(unittest.TestCase):
+
+    def tearDown(self):
+        server.refresher = None
+
+    def test_training(self):
+        server.refresher = MagicMock(last_success=None)
+        self.assertFalse(server.check_training(60)[0])
+        server.refresher.last_success = time.time() - 30
+        self.assertTrue(server.check_training(60)[0])
+        server.refresher.last_success = time.time() - 90
+        self.assertFalse(server.check_training(60)[0])
+
+class ComponentOptionsTest(unittest.TestCase):
+
+    def test_study_programs(self):
+        cfg = configparser.ConfigParser()
+        self.assertIsNone(server.create_study_programs(cfg))
+        cfg.read_string('[recommendation]\nstudy_programs = S, T,\n')
+        self.assertEqual(['S', 'T'], server.create_study_programs(cfg))
+
+if __name__ == '__main__':
+    unittest.main()
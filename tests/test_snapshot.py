@@ -0,0 +1,42 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+from cgrcompute.components.snapshot import save_snapshot, load_snapshot, load_latest_snapshot, list_snapshots
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_save_and_load(self):
+        path = save_snapshot(self.dir.name, {'arr': np.arange(10)}, {'trained_at': 1000.5, 'observation_count': 3, 'item_count': 10})
+        header, model = load_snapshot(path)
+        self.assertEqual(1000.5, header['trained_at'])
+        self.assertEqual(3, header['observation_count'])
+        self.assertEqual(10, header['item_count'])
+        np.testing.assert_array_equal(np.arange(10), model['arr'])
+
+    def test_latest_valid(self):
+        save_snapshot(self.dir.name, 'old', {'trained_at': 1})
+        save_snapshot(self.dir.name, 'mid', {'trained_at': 2})
+        newest = save_snapshot(self.dir.name, 'new', {'trained_at': 3})
+        self.assertEqual('new', load_latest_snapshot(self.dir.name)[1])
+        with open(newest, 'r+b') as f:
+            f.write(b'garbage!')
+        self.assertEqual('mid', load_latest_snapshot(self.dir.name)[1])
+
+    def test_keep(self):
+        for t in range(5):
+            save_snapshot(self.dir.name, t, {'trained_at': t}, keep=2)
+        self.assertEqual(['model-4000.snap', 'model-3000.snap'], [os.path.basename(p) for p in list_snapshots(self.dir.name)])
+
+    def test_empty(self):
+        self.assertIsNone(load_latest_snapshot(os.path.join(self.dir.name, 'missing')))
+
+if __name__ == '__main__':
+    unittest.main()